@@ -0,0 +1,73 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+
+class ClusterAdjacency:
+    """
+    Clusters whose squares share an edge, as a symmetric CSR matrix over the positions of the clusters in names.
+    Paths only go through occupied squares, so k-hop neighborhoods and hop distances follow the clusters that
+    exist. Both are computed once per k and kept.
+    """
+    def __init__(self, names: list[int], horizontal_squares: int, vertical_squares: int):
+        """
+        :param names: cluster names, x + y * horizontal_squares, in the order of the rows of every matrix
+        :param horizontal_squares: width of the grid
+        :param vertical_squares: height of the grid
+        """
+        self.names = np.asarray(list(names), dtype=int)
+        self.index = {name: i for i, name in enumerate(self.names.tolist())}  # {cluster_name (int) : row}
+        self.horizontal_squares = horizontal_squares
+        self.vertical_squares = vertical_squares
+        self.neighborhoods = {}  # {k : CSR matrix of the clusters within k hops}
+        self.hops = {}  # {k : hop distance matrix up to k hops}
+        num_clusters = len(self.names)
+        order = np.argsort(self.names)
+        sorted_names = self.names[order]
+        x = self.names % horizontal_squares
+        y = self.names // horizontal_squares
+        starts, ends = [], []
+        # Right and lower neighbors, the transpose adds the left and upper ones
+        for dx, dy in ((1, 0), (0, 1)):
+            inside = (x + dx < horizontal_squares) & (y + dy < vertical_squares)
+            target = x + dx + (y + dy) * horizontal_squares
+            positions = np.minimum(np.searchsorted(sorted_names, target), max(num_clusters - 1, 0))
+            found = inside & (sorted_names[positions] == target) if num_clusters else inside
+            starts.append(np.flatnonzero(found))
+            ends.append(order[positions[found]])
+        starts, ends = np.concatenate(starts), np.concatenate(ends)
+        self.matrix = sparse.csr_matrix((np.ones(2 * len(starts), dtype=np.int8),
+                                         (np.concatenate([starts, ends]), np.concatenate([ends, starts]))),
+                                        shape=(num_clusters, num_clusters))
+
+    def get_neighborhood(self, k=1) -> sparse.csr_matrix:
+        # Boolean CSR matrix of the clusters within k hops of each cluster, not including itself
+        if k not in self.neighborhoods:
+            reach = sparse.identity(len(self.names), dtype=bool, format='csr')
+            step = self.matrix.astype(bool)
+            for _ in range(k):
+                reach = (reach + reach @ step).astype(bool)
+            reach.setdiag(False)
+            reach.eliminate_zeros()
+            reach.sort_indices()
+            self.neighborhoods[k] = reach
+        return self.neighborhoods[k]
+
+    def get_hops(self, k=None) -> np.ndarray:
+        # (clusters, clusters) number of squares walked between clusters, -1 past k hops or without a path
+        if k not in self.hops:
+            hops = csgraph.dijkstra(self.matrix, directed=False, unweighted=True, limit=np.inf if k is None else k)
+            self.hops[k] = np.where(np.isinf(hops), -1, hops).astype(np.int32)
+        return self.hops[k]
+
+    def get_neighbors(self, name: int, k=1) -> list[int]:
+        neighborhood = self.get_neighborhood(k)
+        i = self.index[name]
+        return self.names[neighborhood.indices[neighborhood.indptr[i]:neighborhood.indptr[i + 1]]].tolist()
+
+    def to_dict(self, k=1) -> dict[int: list[int]]:
+        # {cluster_name : names of the clusters within k hops}
+        neighborhood = self.get_neighborhood(k)
+        ends = self.names[neighborhood.indices].tolist()
+        indptr = neighborhood.indptr.tolist()
+        return {name: ends[indptr[i]:indptr[i + 1]] for i, name in enumerate(self.names.tolist())}
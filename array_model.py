@@ -0,0 +1,410 @@
+import copy
+from datetime import timedelta
+from math import floor
+
+import numpy as np
+
+from cluster_model import ClusterModel
+from metrics import MetricsRecorder
+from trip import Trip
+
+
+class ArrayModel:
+    """
+    Array backed simulation of a ClusterModel. Cluster state lives in numpy arrays indexed by position in
+    self.names, departures for every cluster are drawn at once each tick and in flight bikes are kept as
+    counts per (arrival tick, destination) in a ring buffer.
+
+    Several replicas of the network can be simulated together by passing a (replicas, clusters) matrix of
+    initial bikes. State arrays are then flat over cells, cell = replica * clusters + cluster index.
+    """
+    guide_bins = 64
+
+    def __init__(self, model: ClusterModel, seed=None, num_neighbors=None, initial_bikes=None, choices=4):
+        """
+        :param model: ClusterModel to simulate, it is only written to by sync
+        :param seed: seed or SeedSequence of the generator
+        :param num_neighbors: number of nearest neighbors a trip can be rerouted to, defaults to model.reroute_radius
+        :param initial_bikes: (replicas, clusters) bikes in the order of model.cluster_dict, defaults to the
+        model state as a single replica
+        :param choices: a reroute picks uniformly among this many nearest available neighbors
+        """
+        self.model = model
+        self.rng = np.random.default_rng(seed)
+        self.num_neighbors = model.reroute_radius if num_neighbors is None else num_neighbors
+        self.choices = choices
+        self.tph = model.tph
+        self.curr_tick = model.curr_tick
+        self.curr_time = model.curr_time
+        self.step = 0  # Ticks simulated since construction, used to index the ring buffer
+        self.replicas = 1 if initial_bikes is None else len(initial_bikes)
+        self.failures = model.failures  # Totals over all replicas
+        self.total_trips = model.total_trips
+        self.critical_failures = model.critical_failures
+        # Counts of the model at construction, which every replica starts from
+        self.initial_counts = (model.failures, model.total_trips, model.critical_failures)
+        self.replica_failures = np.zeros(self.replicas, dtype=int)  # Counted since construction
+        self.replica_total_trips = np.zeros(self.replicas, dtype=int)
+        self.replica_critical_failures = np.zeros(self.replicas, dtype=int)
+        self.names = np.array([], dtype=int)  # Cluster name for each array index
+        self.index = {}  # {cluster_name (int) : array index (int)}
+        self.max_docks = np.array([], dtype=int)  # Per cell
+        self.curr_bikes = np.array([], dtype=int)  # Per cell
+        self.rate = np.zeros((0, 0))  # (ticks, clusters) expected departures
+        self.dest_index = []  # Per tick, concatenated destination indices of every cluster
+        self.cdf = []  # Per tick, cumulative transition probabilities shifted by the origin index
+        self.guide = []  # Per tick, searchsorted of cdf at guide_bins evenly spaced points per cluster
+        self.neighbors = np.zeros((0, 0), dtype=int)  # (clusters, num_neighbors), -1 padded
+        self.travel_ticks = np.zeros((0, 0), dtype=int)  # ClusterModel.travel_ticks in self.names order
+        self.arrival_failures = np.zeros((0, 0), dtype=int)  # (ticks, clusters) summed over replicas
+        self.departure_failures = np.zeros((0, 0), dtype=int)
+        self.replica_arrival_failures = np.zeros((0, 0), dtype=int)  # (replicas, clusters) since construction
+        self.replica_departure_failures = np.zeros((0, 0), dtype=int)
+        self.pending = np.zeros((0, 0), dtype=int)  # (slots, cells) bikes arriving at step % slots
+        self.recorder = None  # MetricsRecorder with a column per cell, None when off
+        self.build()
+        if initial_bikes is not None:
+            self.curr_bikes = np.asarray(initial_bikes, dtype=int).reshape(self.max_docks.shape).copy()
+        self.load_in_transit(model.in_transit)
+
+    @property
+    def empty(self) -> np.ndarray:
+        return self.curr_bikes <= 0
+
+    @property
+    def full(self) -> np.ndarray:
+        return self.curr_bikes >= self.max_docks
+
+    @property
+    def bikes(self) -> np.ndarray:
+        # (replicas, clusters) view of curr_bikes
+        return self.curr_bikes.reshape((self.replicas, len(self.names)))
+
+    def build(self):
+        clusters = list(self.model.cluster_dict.values())
+        num_clusters = len(clusters)
+        ticks = 24 * self.tph
+        self.names = np.array([cluster.name for cluster in clusters], dtype=int)
+        self.index = {cluster.name: i for i, cluster in enumerate(clusters)}
+        self.max_docks = np.tile(np.array([cluster.max_docks for cluster in clusters], dtype=int), self.replicas)
+        self.curr_bikes = np.tile(np.array([cluster.curr_bikes for cluster in clusters], dtype=int), self.replicas)
+        self.arrival_failures = np.array([cluster.arrival_failures for cluster in clusters], dtype=int)
+        self.departure_failures = np.array([cluster.departure_failures for cluster in clusters], dtype=int)
+        self.arrival_failures = self.arrival_failures.reshape((num_clusters, ticks)).T.copy()
+        self.departure_failures = self.departure_failures.reshape((num_clusters, ticks)).T.copy()
+        self.replica_arrival_failures = np.zeros((self.replicas, num_clusters), dtype=int)
+        self.replica_departure_failures = np.zeros((self.replicas, num_clusters), dtype=int)
+        self.rate = np.array([cluster.tick_rate for cluster in clusters], dtype=float).reshape((num_clusters, ticks))
+        self.rate = np.ascontiguousarray(self.rate.T)
+
+        self.dest_index = []
+        self.cdf = []
+        self.guide = []
+        for tick in range(ticks):
+            if tick and all(cluster.transition_cdf[tick] is cluster.transition_cdf[tick - 1] for cluster in clusters):
+                # Ticks inside the same data tick share their samplers
+                self.dest_index.append(self.dest_index[-1])
+                self.cdf.append(self.cdf[-1])
+                self.guide.append(self.guide[-1])
+                continue
+            dest_index = []
+            cdf = []
+            for i, cluster in enumerate(clusters):
+                dest_index.append([self.index.get(end_cluster, -1) for end_cluster in cluster.transition_keys[tick]])
+                cdf.append(cluster.transition_cdf[tick] + i)
+            self.dest_index.append(np.concatenate(dest_index).astype(int) if dest_index else np.array([], dtype=int))
+            self.cdf.append(np.concatenate(cdf) if cdf else np.array([]))
+            points = np.arange(num_clusters * self.guide_bins) / self.guide_bins
+            self.guide.append(np.searchsorted(self.cdf[-1], points, side='right').astype(np.int32))
+
+        self.neighbors = np.full((num_clusters, self.num_neighbors), -1, dtype=int)
+        reroute_neighbors = self.model.get_reroute_neighbors(self.num_neighbors)
+        for i, cluster in enumerate(clusters):
+            neighbors = [self.index[neighbor] for neighbor in reroute_neighbors[cluster.name]]
+            self.neighbors[i, :len(neighbors)] = neighbors
+
+        if any(cluster.name not in self.model.cluster_index for cluster in clusters):
+            self.model.init_travel_matrix()
+        rows = np.array([self.model.cluster_index[cluster.name] for cluster in clusters], dtype=int)
+        if np.array_equal(rows, np.arange(len(self.model.cluster_index))):
+            self.travel_ticks = self.model.travel_ticks
+        else:
+            self.travel_ticks = self.model.travel_ticks[np.ix_(rows, rows)]
+        slots = int(self.travel_ticks.max()) + 1 if num_clusters else 1
+        self.pending = np.zeros((slots, self.replicas * num_clusters), dtype=int)
+
+    def load_in_transit(self, in_transit: list[Trip]):
+        # Every replica gets the same trips
+        tick_length = timedelta(hours=1 / self.tph)
+        arrivals = []
+        for trip in in_transit:
+            if trip.end_cluster not in self.index:
+                continue
+            ticks = max(floor((trip.end_time - trip.curr_time) / tick_length) + 1, 1)
+            arrivals.append((ticks, self.index[trip.end_cluster]))
+        if arrivals and max(arrivals)[0] >= len(self.pending):
+            self.resize_pending(max(arrivals)[0] + 1)
+        for ticks, destination in arrivals:
+            self.pending[(self.step + ticks) % len(self.pending), destination::len(self.names)] += 1
+
+    def resize_pending(self, slots: int):
+        pending = np.zeros((slots, self.curr_bikes.size), dtype=int)
+        for i in range(len(self.pending)):
+            pending[(self.step + i) % slots] = self.pending[(self.step + i) % len(self.pending)]
+        self.pending = pending
+
+    def sim(self):
+        self.curr_tick += 1
+        self.curr_time += timedelta(hours=1 / self.tph)
+        self.step += 1
+        if self.curr_tick % (24 * self.tph) == 0:
+            self.curr_tick = 0
+        self.sim_trips()
+        self.sim_clusters()
+        if self.recorder is not None:
+            self.recorder.end_tick(self.step, self.curr_tick, self.curr_bikes)
+
+    def start_recording(self, path=None, chunk_ticks=None) -> MetricsRecorder:
+        # Records per tick metrics of every cell until stop_recording
+        if chunk_ticks is None:
+            chunk_ticks = 24 * self.tph
+        self.recorder = MetricsRecorder(self.names, path=path, chunk_ticks=chunk_ticks, replicas=self.replicas)
+        return self.recorder
+
+    def stop_recording(self) -> MetricsRecorder:
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.close()
+        self.recorder = None
+        return recorder
+
+    def record(self, field: str, cells: np.ndarray):
+        row = getattr(self.recorder, field)
+        row += np.bincount(cells, minlength=self.curr_bikes.size).astype(row.dtype)
+
+    def run(self, ticks: int) -> np.ndarray:
+        # Simulates ticks and returns the failures of each replica since construction
+        for _ in range(ticks):
+            self.sim()
+        return self.replica_failures.copy()
+
+    def sim_trips(self):
+        slot = self.step % len(self.pending)
+        arrivals = self.pending[slot].copy()
+        self.pending[slot] = 0
+        docked = np.minimum(arrivals, np.maximum(self.max_docks - self.curr_bikes, 0))
+        self.curr_bikes += docked
+        self.total_trips += int(docked.sum())
+        self.replica_total_trips += docked.reshape((self.replicas, len(self.names))).sum(axis=1)
+        if self.recorder is not None:
+            self.recorder.arrivals += docked.astype(self.recorder.arrivals.dtype)
+        failed = arrivals - docked
+        if not failed.any():
+            return
+        # Bikes that could not dock ride on to a neighbor with room
+        origins = np.repeat(np.arange(self.curr_bikes.size), failed)
+        self.add_failures(origins, arrival=True)
+        destinations = self.reroute(origins, self.full)
+        if self.recorder is not None:
+            self.record('reroutes', origins[destinations >= 0])
+        self.add_critical_failures(origins[destinations < 0])
+        self.dispatch(origins[destinations >= 0], destinations[destinations >= 0])
+
+    def sim_clusters(self):
+        num_clusters = len(self.names)
+        departures = self.rng.poisson(self.rate[self.curr_tick] * self.replicas)
+        if not departures.any():
+            return
+        if self.replicas > 1:
+            # Summed over replicas the departures of a cluster are Poisson(replicas * rate), split uniformly
+            # among the replicas they are independent Poisson(rate) again, without a draw for every cell
+            clusters = np.repeat(np.arange(num_clusters), departures)
+            cells = self.rng.integers(self.replicas, size=len(clusters)) * num_clusters + clusters
+            departures = np.bincount(cells, minlength=self.curr_bikes.size)
+        origins = np.repeat(np.arange(self.curr_bikes.size), departures)
+        clusters = origins % num_clusters
+        destinations = self.dest_index[self.curr_tick][self.sample(clusters + self.rng.random(len(origins)))]
+        # Destination indices are -1 for clusters outside the model, otherwise shifted to the origin's replica
+        offsets = origins - clusters
+        destinations += offsets
+        known = destinations >= offsets
+        if not known.all():
+            origins, destinations = origins[known], destinations[known]
+
+        # Trips heading to a full cluster are sent to a neighbor with room before leaving
+        full_destination = self.full[destinations]
+        if full_destination.any():
+            full_cells = destinations[full_destination]
+            self.add_failures(full_cells, arrival=True)
+            destinations[full_destination] = self.reroute(full_cells, self.full)
+            if self.recorder is not None:
+                self.record('reroutes', full_cells[destinations[full_destination] >= 0])
+            routed = destinations >= 0
+            self.add_critical_failures(origins[~routed])
+            origins, destinations = origins[routed], destinations[routed]
+
+        # Departures are served in draw order until the cluster runs out of bikes
+        served = self.take_bikes(origins)
+        failed_origins = origins[~served]
+        failed_destinations = destinations[~served]
+        origins, destinations = origins[served], destinations[served]
+        if len(failed_origins):
+            self.add_failures(failed_origins, arrival=False)
+            # Retry against the updated empty flags until every failed departure found a bike or ran out of
+            # neighbors, like the sequential engine where a rerouted departure always sees current state
+            remaining = np.arange(len(failed_origins))
+            while len(remaining):
+                new_origins = self.reroute(failed_origins[remaining], self.empty)
+                rerouted = new_origins >= 0
+                self.add_critical_failures(failed_origins[remaining[~rerouted]])
+                remaining, new_origins = remaining[rerouted], new_origins[rerouted]
+                taken = self.take_bikes(new_origins)
+                origins = np.concatenate([origins, new_origins[taken]])
+                destinations = np.concatenate([destinations, failed_destinations[remaining[taken]]])
+                if self.recorder is not None:
+                    self.record('reroutes', failed_origins[remaining[taken]])
+                remaining = remaining[~taken]
+        if self.recorder is not None:
+            self.record('departures', origins)
+        self.dispatch(origins, destinations)
+
+    def add_failures(self, cells: np.ndarray, arrival: bool):
+        # Counts are scattered for the failed cells only, every array here is over all cells or clusters
+        num_clusters = len(self.names)
+        self.failures += len(cells)
+        self.replica_failures += np.bincount(cells // num_clusters, minlength=self.replicas)
+        if arrival:
+            np.add.at(self.arrival_failures[self.curr_tick], cells % num_clusters, 1)
+            np.add.at(self.replica_arrival_failures.reshape(-1), cells, 1)
+        else:
+            np.add.at(self.departure_failures[self.curr_tick], cells % num_clusters, 1)
+            np.add.at(self.replica_departure_failures.reshape(-1), cells, 1)
+        if self.recorder is not None:
+            np.add.at(self.recorder.failed_arrivals if arrival else self.recorder.failed_departures, cells, 1)
+
+    def add_critical_failures(self, cells: np.ndarray):
+        self.critical_failures += len(cells)
+        self.replica_critical_failures += np.bincount(cells // len(self.names), minlength=self.replicas)
+
+    def sample(self, draws: np.ndarray) -> np.ndarray:
+        # searchsorted(cdf, draws, side='right'), started from the guide point below each draw and stepped forward
+        cdf = self.cdf[self.curr_tick]
+        positions = self.guide[self.curr_tick][(draws * self.guide_bins).astype(int)].astype(int)
+        active = np.arange(len(draws))
+        while len(active):
+            step = positions[active]
+            active = active[(step < len(cdf)) & (cdf[np.minimum(step, len(cdf) - 1)] <= draws[active])]
+            positions[active] += 1
+        return positions
+
+    def take_bikes(self, origins: np.ndarray) -> np.ndarray:
+        # Returns which of the requested departures found a bike, earlier requests are served first
+        # Origins usually come sorted from np.repeat, the sort is only done when they are not
+        order = np.argsort(origins, kind='stable') if np.any(origins[1:] < origins[:-1]) else None
+        sorted_origins = origins if order is None else origins[order]
+        # Runs of the same origin in sorted order, so only the requested cells are touched
+        starts = np.flatnonzero(np.diff(sorted_origins, prepend=-1))
+        counts = np.diff(np.append(starts, len(origins)))
+        cells = sorted_origins[starts]
+        bikes = np.maximum(self.curr_bikes[cells], 0)
+        # A departure is served when fewer than bikes requests of its cell come before it
+        served = np.arange(len(origins)) < np.repeat(starts + bikes, counts)
+        self.curr_bikes[cells] -= np.minimum(counts, bikes)
+        if order is not None:
+            served[order] = served.copy()
+        return served
+
+    def reroute(self, cells: np.ndarray, unavailable: np.ndarray) -> np.ndarray:
+        # Random neighbor among the nearest available ones, like RerouteIndex.find
+        clusters = cells % len(self.names)
+        neighbors = self.neighbors[clusters]
+        neighbor_cells = np.where(neighbors >= 0, neighbors + (cells - clusters)[:, None], 0)
+        available = (neighbors >= 0) & ~unavailable[neighbor_cells]
+        available &= np.cumsum(available, axis=1) <= self.choices
+        keys = self.rng.random(neighbors.shape)
+        keys[~available] = 2
+        new_cells = neighbor_cells[np.arange(len(cells)), keys.argmin(axis=1)]
+        new_cells[~available.any(axis=1)] = -1
+        return new_cells
+
+    def dispatch(self, origins: np.ndarray, destinations: np.ndarray):
+        num_clusters = len(self.names)
+        arrival = self.step + self.travel_ticks[origins % num_clusters, destinations % num_clusters]
+        # Only the new trips are scattered, a dense count over every slot and cell costs more than the trips
+        np.add.at(self.pending.reshape(-1), (arrival % len(self.pending)) * self.curr_bikes.size + destinations, 1)
+
+    def snapshot(self) -> dict:
+        # Copy of the mutable arrays only, the rate, sampler, neighbor and travel tables are shared
+        return {'curr_bikes': self.curr_bikes.copy(),
+                'pending': self.pending.copy(),
+                'arrival_failures': self.arrival_failures.copy(),
+                'departure_failures': self.departure_failures.copy(),
+                'replica_arrival_failures': self.replica_arrival_failures.copy(),
+                'replica_departure_failures': self.replica_departure_failures.copy(),
+                'replica_failures': self.replica_failures.copy(),
+                'replica_total_trips': self.replica_total_trips.copy(),
+                'replica_critical_failures': self.replica_critical_failures.copy(),
+                'step': self.step,
+                'curr_tick': self.curr_tick,
+                'curr_time': self.curr_time,
+                'failures': self.failures,
+                'total_trips': self.total_trips,
+                'critical_failures': self.critical_failures,
+                'rng': self.rng.bit_generator.state}
+
+    def restore(self, snapshot: dict):
+        for key in ['curr_bikes', 'pending', 'arrival_failures', 'departure_failures', 'replica_arrival_failures',
+                    'replica_departure_failures', 'replica_failures', 'replica_total_trips',
+                    'replica_critical_failures']:
+            setattr(self, key, snapshot[key].copy())
+        for key in ['step', 'curr_tick', 'curr_time', 'failures', 'total_trips', 'critical_failures']:
+            setattr(self, key, snapshot[key])
+        self.rng = np.random.default_rng()
+        self.rng.bit_generator.state = snapshot['rng']
+
+    def fork(self, snapshot=None, seed=None) -> 'ArrayModel':
+        # Forks of the same snapshot replay the same random draws unless seeded
+        if snapshot is None:
+            snapshot = self.snapshot()
+        model = copy.copy(self)
+        model.recorder = None
+        model.restore(snapshot)
+        if seed is not None:
+            model.rng = np.random.default_rng(seed)
+        return model
+
+    def get_in_transit(self, replica=0) -> list[Trip]:
+        # Origins are not tracked, trips are rebuilt at their destination with the remaining travel time
+        tick_length = timedelta(hours=1 / self.tph)
+        num_clusters = len(self.names)
+        in_transit = []
+        slots = len(self.pending)
+        for ticks in range(1, slots + 1):
+            counts = self.pending[(self.step + ticks) % slots, replica * num_clusters:(replica + 1) * num_clusters]
+            for i in np.nonzero(counts)[0]:
+                name = int(self.names[i])
+                for _ in range(counts[i]):
+                    in_transit.append(Trip(start_cluster=name,
+                                           end_cluster=name,
+                                           start_time=self.curr_time,
+                                           trip_time=tick_length * (ticks - 0.5)))
+        return in_transit
+
+    def sync(self, replica=0):
+        # Writes the state of a replica back to the ClusterModel, per tick failures only exist for a single replica
+        bikes = self.bikes[replica]
+        for i, name in enumerate(self.names):
+            cluster = self.model.cluster_dict[name]
+            cluster.curr_bikes = int(bikes[i])
+            cluster.update()
+            if self.replicas == 1:
+                cluster.arrival_failures[:] = self.arrival_failures[:, i]
+                cluster.departure_failures[:] = self.departure_failures[:, i]
+        self.model.in_transit = self.get_in_transit(replica)
+        self.model.curr_tick = self.curr_tick
+        self.model.curr_time = self.curr_time
+        # Totals of the replica, so syncing again never counts anything twice
+        failures, total_trips, critical_failures = self.initial_counts
+        self.model.failures = failures + int(self.replica_failures[replica])
+        self.model.total_trips = total_trips + int(self.replica_total_trips[replica])
+        self.model.critical_failures = critical_failures + int(self.replica_critical_failures[replica])
@@ -0,0 +1,129 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from array_model import ArrayModel
+from cluster_model import ClusterModel
+from snapshot_store import SnapshotStore
+
+_model = None  # ArrayModel or ClusterModel the runs of this process fork
+
+
+def init_worker(model: ClusterModel, engine: str):
+    global _model
+    _model = ArrayModel(model) if engine == 'array' else model
+
+
+def run_backtest(bikes: np.ndarray, seconds: int, ticks: int, seed: np.random.SeedSequence) -> np.ndarray:
+    # Bikes of every cluster after simulating ticks from bikes at seconds since midnight
+    sim = _model.fork(seed=seed)
+    curr_time = timedelta(seconds=int(seconds))
+    if isinstance(sim, ArrayModel):
+        sim.curr_bikes = bikes.copy()
+        sim.max_docks = np.maximum(sim.max_docks, bikes)
+        sim.curr_time = curr_time
+        sim.curr_tick = int(seconds * sim.tph / 3600)
+        sim.run(ticks)
+        return sim.curr_bikes.copy()
+    for cluster, num_bikes in zip(sim.cluster_dict.values(), bikes.tolist()):
+        cluster.curr_bikes = num_bikes
+        cluster.max_docks = max(cluster.max_docks, num_bikes)
+        cluster.update()
+    sim.change_time(curr_time)
+    for _ in range(ticks):
+        sim.sim()
+    return np.array([cluster.curr_bikes for cluster in sim.cluster_dict.values()], dtype=int)
+
+
+def get_errors(predicted: np.ndarray, truth: np.ndarray) -> dict[str: np.ndarray]:
+    # Per run (row) errors over the clusters (columns), mse like ClusterModel.mean_sq_error
+    error = predicted - truth
+    return {'mse': (error ** 2).mean(axis=1),
+            'mae': np.abs(error).mean(axis=1),
+            'bias': error.mean(axis=1),
+            'max_error': np.abs(error).max(axis=1, initial=0)}
+
+
+class Backtest:
+    """
+    Compares the model to a SnapshotStore: each run starts from the cluster bikes of a snapshot, simulates the
+    horizon and is scored against the snapshot closest to its end. Runs start with no trips in transit. The
+    persistence columns score predicting no change at all, the baseline a model has to beat.
+    """
+    def __init__(self, model: ClusterModel, store: SnapshotStore, engine='array'):
+        """
+        :param model: ClusterModel of the stations in store, it is not modified by the runs
+        :param store: history the runs start from and are scored against
+        :param engine: 'array' to run ArrayModels, 'object' to run forks of the ClusterModel
+        """
+        self.model = model.fork()
+        self.model.in_transit = []  # The fork keeps the trips of model, runs start without them
+        self.model.fix_max_docks()  # Drops clusters without docks once, instead of in every run
+        self.store = store
+        self.engine = engine
+        self.predicted = np.zeros((0, 0), dtype=int)  # (runs, clusters) bikes at the end of the last run() runs
+        self.truth = np.zeros((0, 0), dtype=int)  # (runs, clusters) bikes of the end snapshots
+        names, station_rows = self.model.get_state_index()
+        # Store stations x clusters, the first store station of a name counts like in ClusterModel.get_cluster_bikes
+        positions = names.get_indexer(store.name)
+        stations, first = np.unique(positions, return_index=True)
+        first = first[stations >= 0]
+        clusters = station_rows[positions[first]]
+        first, clusters = first[clusters >= 0], clusters[clusters >= 0]
+        self.membership = sparse.csr_matrix((np.ones(len(first), dtype=np.int32), (first, clusters)),
+                                            shape=(len(store.name), len(self.model.cluster_index)))
+
+    def get_cluster_bikes(self, snapshots) -> np.ndarray:
+        # (snapshots, clusters) bikes in cluster_index order, stations without a status count as empty
+        bikes = np.maximum(self.store.bikes[np.asarray(snapshots, dtype=int)], 0).astype(np.int32)
+        return np.asarray((self.membership.T @ bikes.T).T)
+
+    def run(self, starts, horizons, seed=None, processes=None) -> pd.DataFrame:
+        """
+        Runs every (start, horizon) pair
+        :param starts: indices of the start snapshots, see SnapshotStore.find
+        :param horizons: timedeltas simulated from each start
+        :param seed: seed of the SeedSequence the run generators are spawned from
+        :param processes: size of the process pool, 1 runs in this process, None uses every core
+        :return: one row per run with its start and end snapshots, times, ticks and errors of the model and of
+        persistence
+        """
+        tph = self.model.tph
+        starts = np.repeat(np.asarray(starts, dtype=int), len(horizons))
+        ticks = np.tile([int(round(horizon.total_seconds() * tph / 3600)) for horizon in horizons],
+                        len(starts) // max(len(horizons), 1))
+        ends = self.store.find(self.store.times[starts] + ticks * 3600 // tph)
+        start_bikes = self.get_cluster_bikes(starts)
+        seconds = self.store.get_seconds()[starts]
+        seeds = np.random.SeedSequence(seed).spawn(len(starts))
+        if processes == 1:
+            init_worker(self.model, self.engine)
+            predicted = [run_backtest(*args) for args in zip(start_bikes, seconds, ticks, seeds)]
+        else:
+            chunksize = max(1, len(starts) // (4 * (processes or os.cpu_count() or 1)))
+            with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                     initargs=(self.model, self.engine)) as pool:
+                predicted = list(pool.map(run_backtest, start_bikes, seconds, ticks, seeds, chunksize=chunksize))
+        predicted = np.array(predicted, dtype=int).reshape(start_bikes.shape)
+        truth = self.get_cluster_bikes(ends)
+
+        runs = pd.DataFrame({'start': starts,
+                             'end': ends,
+                             'start_time': pd.to_datetime(self.store.times[starts], unit='s', utc=True),
+                             'end_time': pd.to_datetime(self.store.times[ends], unit='s', utc=True),
+                             'ticks': ticks})
+        for name, values in get_errors(predicted, truth).items():
+            runs[name] = values
+        for name, values in get_errors(start_bikes, truth).items():
+            runs['persistence_' + name] = values
+        self.predicted, self.truth = predicted, truth
+        return runs
+
+    @staticmethod
+    def summary(runs: pd.DataFrame) -> pd.DataFrame:
+        # Mean errors of each horizon
+        return runs.drop(columns=['start', 'end', 'start_time', 'end_time']).groupby('ticks').mean()
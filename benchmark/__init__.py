@@ -0,0 +1,2 @@
+from benchmark.bench import BENCHMARKS, run
+from benchmark.synthetic import make_station_data, make_trips
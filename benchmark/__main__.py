@@ -0,0 +1,16 @@
+import argparse
+
+from benchmark.bench import BENCHMARKS, run
+
+parser = argparse.ArgumentParser(description='Time the model on synthetic cities, run from the repository root')
+parser.add_argument('--scales', type=float, nargs='+', default=[1, 5, 20], help='station counts as multiples of NYC')
+parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS), choices=BENCHMARKS)
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--tph', type=int, default=4)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--sparse', action='store_true', help='grow the city area with the station count')
+parser.add_argument('--square-length', type=float, default=0.005)
+parser.add_argument('--output', default='benchmark.json')
+args = parser.parse_args()
+run(scales=args.scales, benchmarks=args.benchmarks, repeat=args.repeat, tph=args.tph, seed=args.seed,
+    dense=not args.sparse, square_length=args.square_length, output=args.output)
@@ -0,0 +1,162 @@
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import parameter
+from benchmark.synthetic import make_station_data, make_trips
+from cluster_model import ClusterModel
+from state_optimization import StateOptimization
+
+BENCHMARKS = ('init_clusters', 'sim_day', 'optimize', 'expected_change', 'get_transition', 'get_rate', 'ip_build')
+
+
+class City:
+    # Everything the benchmarks of one scale share, built once
+    def __init__(self, scale: float, tph: int, seed: int, dense: bool, square_length: float):
+        self.scale = scale
+        self.tph = tph
+        self.seed = seed
+        self.square_length = square_length
+        self.station_data = make_station_data(scale=scale, seed=seed, dense=dense)
+        self.model = None
+        self.origin = None  # Snapshot of self.model with every cluster half full
+        self.trips = None
+        self.days = []
+
+    def get_model(self) -> ClusterModel:
+        if self.model is None:
+            self.model = self.build_model()
+            for cluster in self.model.cluster_dict.values():
+                cluster.curr_bikes = cluster.max_docks // 2
+                cluster.update()
+            self.origin = self.model.snapshot()
+        return self.model
+
+    def build_model(self) -> ClusterModel:
+        return ClusterModel(self.station_data, square_length=self.square_length, seed=self.seed, tph=self.tph)
+
+    def get_trips(self):
+        # Four weeks of trips from the busiest station
+        if self.trips is None:
+            station = max(self.station_data, key=lambda name: sum(self.station_data[name]['rate'].values()))
+            start = datetime(2023, 6, 1)
+            self.days = parameter.get_weekdays_and_weekends(start, start + timedelta(days=27))[0]
+            self.trips = make_trips(self.station_data, station, self.days, seed=self.seed)
+        return self.trips
+
+
+def bench_init_clusters(city: City):
+    # ClusterModel construction: cluster_stations, init_clusters and the travel matrix
+    city.build_model()
+
+
+def bench_sim_day(city: City):
+    model = city.get_model().fork(city.origin, seed=city.seed)
+    for _ in range(24 * model.tph):
+        model.sim()
+
+
+def bench_optimize(city: City):
+    model = city.get_model().fork(city.origin, seed=city.seed)
+    StateOptimization(model).optimize(timedelta(hours=4), steps=1)
+
+
+def bench_expected_change(city: City):
+    model = city.get_model()
+    StateOptimization(model).expected_change(4 * model.tph)
+
+
+def bench_get_transition(city: City):
+    parameter.get_transition(city.get_trips().copy(), city.days, city.tph)
+
+
+def bench_get_rate(city: City):
+    parameter.get_rate(city.get_trips(), city.days, city.tph)
+
+
+def bench_ip_build(city: City):
+    # Builds the overnight rebalancing program over every cluster without solving it
+    import integer_programming
+    model = city.get_model()
+    stations = list(model.cluster_dict)
+    start_levels = {s: model.cluster_dict[s].curr_bikes for s in stations}
+    optimal_levels = {s: model.cluster_dict[s].max_docks // 3 for s in stations}
+    positions = {s: (model.cluster_dict[s].lon, model.cluster_dict[s].lat) for s in stations}
+    neighbors = integer_programming.get_neighbors(stations, model.cluster_index, model.travel_minutes, 15)
+    integer_programming.create_model(6, 2, 20, stations, start_levels, optimal_levels, positions, neighbors,
+                                     optimize=False)
+
+
+def time_benchmark(function, city: City, repeat: int) -> dict:
+    seconds = []
+    try:
+        function(city)  # Warm up, builds anything the city caches
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(city)
+            seconds.append(time.perf_counter() - start)
+    except ImportError as e:
+        return {'skipped': str(e)}
+    except Exception as e:
+        return {'error': f'{type(e).__name__}: {e}', 'traceback': traceback.format_exc()}
+    return {'seconds': seconds, 'min': min(seconds), 'median': float(np.median(seconds))}
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales=(1, 5, 20), benchmarks=BENCHMARKS, repeat=3, tph=4, seed=0, dense=True, square_length=0.005,
+        output=None, verbose=True) -> dict:
+    """
+    Times every benchmark on a synthetic city at each scale
+    :param scales: station counts as multiples of NYC
+    :param benchmarks: names from BENCHMARKS
+    :param repeat: timed runs of each benchmark after one warm up run
+    :param tph: ticks per hour of the models
+    :param seed: seed of the cities and simulations
+    :param dense: see make_station_data
+    :param square_length: cluster size of the models
+    :param output: path of the JSON file the results are written to
+    :param verbose: print each result as it finishes
+    :return: {commit, python, numpy, date, settings, results: [{benchmark, scale, stations, clusters, ...}]}
+    """
+    results = {'commit': get_commit(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'machine': platform.machine(),
+               'date': datetime.now().isoformat(timespec='seconds'),
+               'settings': {'repeat': repeat, 'tph': tph, 'seed': seed, 'dense': dense,
+                            'square_length': square_length},
+               'results': []}
+    for scale in scales:
+        with contextlib.redirect_stdout(io.StringIO()):
+            city = City(scale, tph, seed, dense, square_length)
+        for name in benchmarks:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = time_benchmark(globals()[f'bench_{name}'], city, repeat)
+            result = {'benchmark': name,
+                      'scale': scale,
+                      'stations': len(city.station_data),
+                      'clusters': len(city.model.cluster_dict) if city.model is not None else None,
+                      **result}
+            results['results'].append(result)
+            if verbose:
+                if 'min' in result:
+                    print(f"{name:<16} {scale:>4}x {result['min']:>10.4f} s")
+                else:
+                    print(f"{name:<16} {scale:>4}x {result.get('skipped') or result.get('error')}")
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+NYC_STATIONS = 2212  # Stations in station_information.json
+NYC_BOUNDS = (40.57, 40.88, -74.05, -73.85)  # Min lat, max lat, min lon, max lon
+NUM_PROFILES = 4  # Night, morning, midday and evening transition profiles of a station
+TRIPS_PER_STATION = 45  # Mean departures per station per day, about 100k trips over NYC
+
+
+def make_station_data(scale=1.0, neighbors=10, data_ticks=96, seed=0, dense=True) -> dict:
+    """
+    Synthetic station_data in the format ClusterModel takes
+    :param scale: number of stations as a multiple of NYC
+    :param neighbors: number of nearest stations each station sends trips to
+    :param data_ticks: rate and transition ticks per day
+    :param seed: seed of the generator, the same arguments always build the same city
+    :param dense: keep the NYC area, so the number of clusters stays the same and each holds more stations. Otherwise
+    the area grows with the station count at the density of NYC
+    :return: {station_name: {lat, lon, max_docks, curr_bikes, rate, transition, dist}}
+    """
+    rng = np.random.default_rng(seed)
+    num_stations = int(NYC_STATIONS * scale)
+    min_lat, max_lat, min_lon, max_lon = NYC_BOUNDS
+    side = 1 if dense else np.sqrt(scale)  # Same station density as NYC unless dense
+    lat = min_lat + rng.random(num_stations) * (max_lat - min_lat) * side
+    lon = min_lon + rng.random(num_stations) * (max_lon - min_lon) * side
+    names = [f'Synthetic Station {i}' for i in range(num_stations)]
+
+    k = min(neighbors, num_stations)
+    dists, nearest = cKDTree(np.column_stack([lat, lon])).query(np.column_stack([lat, lon]), k=k)
+    dists = dists.reshape((num_stations, k))
+    nearest = nearest.reshape((num_stations, k))
+    # Travel time like ClusterModel.init_travel_matrix, with some noise
+    minutes = dists * 428 + 3 + rng.random((num_stations, k)) * 4
+
+    # Two commute peaks on top of a base rate, scaled per station
+    hours = (np.arange(data_ticks) + 0.5) * 24 / data_ticks
+    profile = 0.2 + np.exp(-(hours - 8.5) ** 2 / 2) + np.exp(-(hours - 17.5) ** 2 / 3) + 0.3 * (
+            (hours > 10) & (hours < 16))
+    profile *= TRIPS_PER_STATION / profile.sum()
+    busyness = rng.gamma(2, 0.5, num_stations)  # Mean 1
+    profile_of_tick = np.minimum((hours // 6).astype(int), NUM_PROFILES - 1)
+
+    station_data = {}
+    for i, name in enumerate(names):
+        transitions = []
+        for _ in range(NUM_PROFILES):
+            probs = rng.random(k) ** 2
+            probs /= probs.sum()
+            transitions.append({names[j]: float(p) for j, p in zip(nearest[i], probs)})
+        rate = busyness[i] * profile
+        station_data[name] = {'lat': float(lat[i]),
+                              'lon': float(lon[i]),
+                              'max_docks': int(rng.integers(11, 60)),
+                              'curr_bikes': 0,
+                              'rate': {tick: float(rate[tick]) for tick in range(data_ticks)},
+                              # Ticks of the same profile share one dict to keep 20x cities in memory
+                              'transition': {tick: transitions[profile_of_tick[tick]] for tick in range(data_ticks)},
+                              'dist': {names[j]: timedelta(minutes=float(m)) for j, m in zip(nearest[i], minutes[i])}}
+    return station_data
+
+
+def make_trips(station_data: dict, station: str, days: list[datetime], seed=0) -> pd.DataFrame:
+    """
+    Trip records leaving one station, drawn from its rate and transition, in the columns of the Citibike data
+    :return: DataFrame with started_at, ended_at, start_station_name and end_station_name
+    """
+    rng = np.random.default_rng(seed)
+    data = station_data[station]
+    data_ticks = len(data['rate'])
+    tick_length = timedelta(days=1) / data_ticks
+    rows = []
+    for day in days:
+        for tick in range(data_ticks):
+            departures = rng.poisson(data['rate'][tick])
+            if not departures:
+                continue
+            transition = data['transition'][tick]
+            ends = rng.choice(list(transition), size=departures, p=list(transition.values()))
+            for end, offset in zip(ends, rng.random(departures)):
+                started_at = day + tick_length * (tick + offset)
+                rows.append((started_at, started_at + data['dist'][end], station, end))
+    return pd.DataFrame(rows, columns=['started_at', 'ended_at', 'start_station_name', 'end_station_name'])
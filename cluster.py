@@ -1,6 +1,59 @@
+from collections.abc import Mapping
+from itertools import accumulate
+
+import numpy as np
+
 from trip import Trip
 
 
+def resample_rate(rate, tph: int, interpolate=True) -> np.ndarray:
+    """
+    Expected departures per tick at tph ticks per hour from rates per tick of the data (first axis covers a day)
+    :param rate: rates of the data, the data ticks must divide 60 minutes
+    :param tph: ticks per hour, must divide 60
+    :param interpolate: when ticks are finer than the data, interpolate linearly between data tick centers
+    instead of splitting each data tick evenly
+    """
+    rate = np.asarray(rate, dtype=float)
+    data_ticks = len(rate)
+    if data_ticks == 24 * tph:
+        return rate.copy()
+    data_length = 1440 // data_ticks  # Minutes per data tick
+    tick_length = 60 // tph
+    if interpolate and tick_length < data_length:
+        position = (np.arange(1440) + 0.5 - data_length / 2) / data_length
+        lower = np.floor(position).astype(int)
+        weight = (position - lower).reshape((1440,) + (1,) * (rate.ndim - 1))
+        per_minute = ((1 - weight) * rate[lower % data_ticks] + weight * rate[(lower + 1) % data_ticks]) / data_length
+    else:
+        per_minute = np.repeat(rate / data_length, data_length, axis=0)
+    return per_minute.reshape((24 * tph, tick_length) + rate.shape[1:]).sum(axis=1)
+
+
+class TransitionRows(Mapping):
+    """
+    {tick: {end_cluster: probability}} over rows of a CSR transition matrix, each tick's dict is built on first
+    access and kept, so it can be edited like a plain transition dict
+    """
+    def __init__(self, keys: list[np.ndarray], probs: list[np.ndarray]):
+        self.keys = keys  # Per tick, end cluster names
+        self.probs = probs  # Per tick, probabilities
+        self.rows = {}
+
+    def __getitem__(self, tick: int) -> dict[int: float]:
+        if tick not in self.rows:
+            if not 0 <= tick < len(self.keys):
+                raise KeyError(tick)
+            self.rows[tick] = dict(zip(self.keys[tick].tolist(), self.probs[tick].tolist()))
+        return self.rows[tick]
+
+    def __iter__(self):
+        return iter(range(len(self.keys)))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
 class StationCluster:
     def __init__(self,
                  name: int,
@@ -11,6 +64,10 @@ class StationCluster:
                  transition: dict[int: [dict[str: float]]],
                  lat: float,
                  lon: float,
+                 keep_trips=False,
+                 tph=4,
+                 interpolate=True,
+                 samplers=None,
                  ):
         self.name = name
         self.neighbors_dist = neighbors_dist
@@ -19,42 +76,140 @@ class StationCluster:
         self.curr_bikes = curr_bikes
         self.empty = curr_bikes <= 0
         self.full = curr_bikes >= max_docks
-        self.rate = rate
-        self.transition = transition
+        self.reroute_index = None  # RerouteIndex told when full or empty changes
+        self.rate = rate  # Per tick of the data
+        self.transition = transition  # Per tick of the data
+        self.samplers = samplers  # Per tick of the data, (keys, cdf) of transition when it was built with it
+        self.tph = tph  # Ticks per hour of the simulation, every array below is per tick of the simulation
+        self.interpolate = interpolate
+        self.tick_rate = np.zeros(0)  # Expected departures
+        self.arrival_failures = np.zeros(0, dtype=int)  # Failed arrivals per tick of the day
+        self.departure_failures = np.zeros(0, dtype=int)  # Failed departures per tick of the day
+        self.keep_trips = keep_trips  # Keep the failed Trip objects as well as the counts
         self.bad_arrivals = []
         self.bad_departures = []
         self.lat = lat
         self.lon = lon
+        self.transition_keys = []  # Per tick, destination cluster names of the transition
+        self.transition_cdf = []  # Per tick, normalized cumulative transition probabilities
+        self.init_ticks()
 
-    def get_bike(self, trip: Trip) -> bool:
+    def get_bike(self, trip: Trip, tick=0) -> bool:
         self.update()
         if not self.empty:
             self.curr_bikes -= 1
-            if self.curr_bikes == 0:
-                self.empty = True
+            self.update()
             return True
-        self.bad_departures.append(trip)
+        self.add_bad_departure(trip, tick)
         return False
 
-    def return_bike(self, trip: Trip) -> bool:
+    def return_bike(self, trip: Trip, tick=0) -> bool:
         self.update()
         if not self.full:
             self.curr_bikes += 1
-            if self.curr_bikes == self.max_docks:
-                self.full = True
+            self.update()
             return True
-        self.bad_arrivals.append(trip)
+        self.add_bad_arrival(trip, tick)
         return False
 
+    def add_bad_arrival(self, trip: Trip, tick: int):
+        self.arrival_failures[tick] += 1
+        if self.keep_trips:
+            self.bad_arrivals.append(trip)
+
+    def add_bad_departure(self, trip: Trip, tick: int):
+        self.departure_failures[tick] += 1
+        if self.keep_trips:
+            self.bad_departures.append(trip)
+
+    def num_failures(self) -> int:
+        return int(self.arrival_failures.sum() + self.departure_failures.sum())
+
+    def reset_failures(self):
+        self.arrival_failures[:] = 0
+        self.departure_failures[:] = 0
+        self.bad_arrivals = []
+        self.bad_departures = []
+
     def update(self):
-        self.empty = self.curr_bikes <= 0
-        self.full = self.curr_bikes >= self.max_docks
+        empty = self.curr_bikes <= 0
+        full = self.curr_bikes >= self.max_docks
+        if empty != self.empty or full != self.full:
+            self.empty = empty
+            self.full = full
+            if self.reroute_index is not None:
+                self.reroute_index.update(self.name, full, empty)
+
+    def init_ticks(self, tph=None):
+        # Builds every per tick table of the simulation, resets the failure counts
+        if tph is not None:
+            self.tph = tph
+        rate = [self.rate[tick] for tick in range(len(self.rate))]
+        self.tick_rate = resample_rate(rate, self.tph, self.interpolate)
+        self.arrival_failures = np.zeros(24 * self.tph, dtype=int)
+        self.departure_failures = np.zeros(24 * self.tph, dtype=int)
+        self.init_sampler()
+
+    def init_sampler(self):
+        # Must be called again whenever self.transition changes, with self.samplers set to None
+        data_ticks = len(self.rate)
+        ticks = 24 * self.tph
+        data_length = 1440 // data_ticks  # Minutes per data tick
+        tick_length = 60 // self.tph
+        if self.samplers is not None:
+            keys, cdfs = self.samplers
+        else:
+            keys, cdfs = [None] * data_ticks, [None] * data_ticks  # Built on first use
+        self.transition_keys = []
+        self.transition_cdf = []
+        for tick in range(ticks):
+            start, end = tick * tick_length, (tick + 1) * tick_length
+            first, last = start // data_length, (end - 1) // data_length
+            if first == last:
+                # Ticks inside one data tick share its sampler
+                if keys[first] is None:
+                    keys[first], cdfs[first] = self.get_sampler(self.transition.get(first, {}))
+                self.transition_keys.append(keys[first])
+                self.transition_cdf.append(cdfs[first])
+                continue
+            # Ticks over several data ticks mix their transitions, weighted by the departures of each data tick
+            # inside the tick like resample_rate
+            overlap = {data_tick: min(end, (data_tick + 1) * data_length) - max(start, data_tick * data_length)
+                       for data_tick in range(first, last + 1)}
+            total_rate = sum(self.rate[data_tick] * minutes for data_tick, minutes in overlap.items())
+            transition = {}
+            for data_tick, minutes in overlap.items():
+                if total_rate > 0:
+                    weight = self.rate[data_tick] * minutes / total_rate
+                else:
+                    weight = minutes / tick_length
+                for end_cluster, prob in self.transition.get(data_tick, {}).items():
+                    transition[end_cluster] = transition.get(end_cluster, 0) + prob * weight
+            key, cdf = self.get_sampler(transition)
+            self.transition_keys.append(key)
+            self.transition_cdf.append(cdf)
+
+    def get_sampler(self, transition: dict[int: float]) -> tuple[np.ndarray, np.ndarray]:
+        # Destination names and normalized cumulative probabilities, staying put when there is no transition
+        total = sum(transition.values())
+        if not transition or total <= 0:
+            return np.array([self.name], dtype=int), np.ones(1)
+        cdf = np.fromiter(accumulate(transition.values()), dtype=float, count=len(transition))
+        cdf /= total
+        cdf[-1] = 1
+        return np.fromiter(transition, dtype=int, count=len(transition)), cdf
+
+    def get_destinations(self, tick: int, departures: int, rng: np.random.Generator) -> np.ndarray:
+        return self.transition_keys[tick][np.searchsorted(self.transition_cdf[tick], rng.random(departures),
+                                                          side='right')]
 
     def truncate_transition(self, method='uniform*1/2'):
         if method == 'uniform*1/2':
             self.truncate_transition_uniform()
         else:
             self.truncate_transition_fixed(method)
+        self.samplers = None
+        self.init_sampler()
 
     def truncate_transition_fixed(self, method):
         pass
@@ -0,0 +1,119 @@
+import numpy as np
+from scipy import sparse
+
+from cluster_model import ClusterModel
+
+
+class ClusterHierarchy:
+    """
+    ClusterModels of the same stations at square lengths doubling from the finest one. Only the finest level is
+    built from station_data, each coarser level merges 2 x 2 squares of the level below it: rates and dock counts
+    are summed, flows (rate * transition) are summed and renormalized, and travel times keep the shortest. So a
+    level is the same model as one built from scratch at its square length, and a model of any level is a fork of
+    one built once.
+    """
+    def __init__(self, station_data: dict, square_length=0.0025, levels=3, cache=None, **kwargs):
+        """
+        :param station_data: see ClusterModel
+        :param square_length: square length of the finest level, level l has square_length * 2 ** l
+        :param levels: number of levels
+        :param cache: ModelCache (or its directory) of the finest level
+        :param kwargs: other arguments of ClusterModel (tph, seed, reroute_radius...) shared by every level
+        """
+        self.station_data = station_data
+        self.kwargs = kwargs
+        self.square_lengths = [square_length * 2 ** level for level in range(levels)]
+        self.models = [ClusterModel(station_data, square_length=square_length, cache=cache, **kwargs)]
+        self.models += [None] * (levels - 1)
+        self.arrays = [self.models[0].cluster_arrays]  # get_cluster_arrays of every level
+        self.parents = []  # Per level, position in the next level's cells of each of its cells
+        for _ in range(levels - 1):
+            arrays, parents = self.coarsen(self.arrays[-1])
+            self.arrays.append(arrays)
+            self.parents.append(parents)
+
+    def get_level(self, square_length: float) -> int:
+        for level, length in enumerate(self.square_lengths):
+            if np.isclose(length, square_length):
+                return level
+        raise ValueError(f'No level with square length {square_length}, levels have {self.square_lengths}')
+
+    def get_model(self, level: int, seed=None) -> ClusterModel:
+        # Fork of the level's model, which is only built the first time the level is asked for
+        if self.models[level] is None:
+            self.models[level] = ClusterModel(self.station_data, square_length=self.square_lengths[level],
+                                              arrays=self.arrays[level], **self.kwargs)
+        return self.models[level].fork(seed=seed)
+
+    def get_parents(self, level: int) -> dict[int: int]:
+        # {cluster at level : cluster at level + 1 containing it}
+        cells = self.arrays[level]['cells']
+        return dict(zip(cells.tolist(), self.arrays[level + 1]['cells'][self.parents[level]].tolist()))
+
+    def get_children(self, level: int) -> dict[int: list[int]]:
+        # {cluster at level : clusters at level - 1 inside it}
+        children = {cluster: [] for cluster in self.arrays[level]['cells'].tolist()}
+        for child, parent in self.get_parents(level - 1).items():
+            children[parent].append(child)
+        return children
+
+    @staticmethod
+    def coarsen(arrays: dict[str: np.ndarray]) -> tuple[dict[str: np.ndarray], np.ndarray]:
+        """
+        Cluster arrays at twice the square length of arrays, with the same grid origin
+        :return: the arrays and the position of the parent of each cell of arrays in the new cells
+        """
+        horizontal_squares, vertical_squares = (int(n) for n in arrays['grid'])
+        lat_max, lon_min, square_length = (float(n) for n in arrays['grid_origin'])
+        coarse_horizontal = (horizontal_squares - 1) // 2 + 1
+        coarse_vertical = (vertical_squares - 1) // 2 + 1
+        square_length *= 2
+        # Rows are counted from the top but squares are binned from the bottom, so pairs of rows start at the bottom
+        cells = arrays['cells']
+        rows = coarse_vertical - 1 - (vertical_squares - 1 - cells // horizontal_squares) // 2
+        columns = cells % horizontal_squares // 2
+        coarse_cells, parents = np.unique(columns + rows * coarse_horizontal, return_inverse=True)
+        num_cells, num_clusters = len(cells), len(coarse_cells)
+        membership = sparse.csr_matrix((np.ones(num_cells), (np.arange(num_cells), parents)),
+                                       shape=(num_cells, num_clusters))
+
+        rates = arrays['rates']
+        data_ticks = len(rates)
+        cluster_rates = np.asarray(rates @ membership)
+        # Flows of the finer level, undoing the division by the rate and the renormalization of its transitions
+        counts = np.diff(arrays['transition_indptr'])
+        flow_rows = np.repeat(np.arange(len(counts)), counts)
+        totals = arrays['transition_totals']
+        flows = arrays['transition_probs'] * rates.ravel()[flow_rows] * np.where(totals < 0.9999, totals, 1)[flow_rows]
+        ends = parents[np.searchsorted(cells, arrays['transition_indices'])]
+        starts = flow_rows // num_cells * num_clusters + parents[flow_rows % num_cells]
+        cluster_flows = sparse.csr_matrix((flows, (starts, ends)), shape=(data_ticks * num_clusters, num_clusters))
+        cluster_flows.eliminate_zeros()
+        transition_indptr, transition_indices, transition_probs, transition_cdf, transition_totals = \
+            ClusterModel.get_cluster_transitions(cluster_flows, cluster_rates)
+
+        dist_counts = np.diff(arrays['dist_indptr'])
+        dist_starts = parents[np.repeat(np.arange(num_cells), dist_counts)]
+        dist_ends = parents[np.searchsorted(cells, arrays['dist_indices'])]
+        dist_indptr, dist_indices, dist_minutes = ClusterModel.group_dists(
+            dist_starts, dist_ends, np.asarray(arrays['dist_minutes'], dtype=float), num_clusters)
+
+        lat = lat_max - square_length / 2 - coarse_cells // coarse_horizontal * square_length
+        lon = lon_min + square_length / 2 + coarse_cells % coarse_horizontal * square_length
+        max_docks = membership.T @ np.asarray(arrays['max_docks'], dtype=float)
+        return {'station_names': arrays['station_names'],
+                'station_clusters': parents[arrays['station_clusters']],
+                'cells': coarse_cells,
+                'grid': np.array([coarse_horizontal, coarse_vertical], dtype=int),
+                'grid_origin': np.array([lat_max, lon_min, square_length], dtype=float),
+                'clusters_lat_lon': np.column_stack([lat, lon]).astype(float),
+                'max_docks': np.rint(max_docks).astype(int),
+                'rates': cluster_rates,
+                'transition_indptr': transition_indptr,
+                'transition_indices': coarse_cells[transition_indices],
+                'transition_probs': transition_probs,
+                'transition_cdf': transition_cdf,
+                'transition_totals': transition_totals,
+                'dist_indptr': dist_indptr,
+                'dist_indices': coarse_cells[dist_indices],
+                'dist_minutes': dist_minutes}, parents
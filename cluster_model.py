@@ -1,145 +1,226 @@
-import random
+import copy
 from datetime import timedelta
 from typing import List
 
 import matplotlib.pyplot as plt
 import seaborn as sns
-from math import floor
 
 import simplejson
-from numpy.random import poisson, choice
 import pandas as pd
 import numpy as np
-from cluster import StationCluster
+from scipy import sparse
+from adjacency import ClusterAdjacency
+from cluster import StationCluster, TransitionRows
+from metrics import MetricsRecorder
+from model_cache import ModelCache
+from profiler import PHASES, PhaseProfiler
+from reroute_index import RerouteIndex
+from station_registry import StationRegistry
 from trip import Trip
 
 
 class ClusterModel:
-    def __init__(self, station_data: dict[str: dict[str: float]], in_transit=None, square_length=0.005):
+    def __init__(self, station_data: dict[str: dict[str: float]], in_transit=None, square_length=0.005,
+                 keep_failed_trips=False, seed=None, tph=4, interpolate=True, reroute_radius=4, cache=None,
+                 arrays=None, reroute_hops=None, station_information='../station_information.json'):
         if in_transit is None:
             in_transit = []
+        if 60 % tph != 0:
+            raise ValueError(f'tph must divide 60, got {tph}')
         self.cluster_dict = {}  # {cluster_name (int) : StationCluster}
-        self.in_transit = in_transit  # List of Trip objects
-        self.tph = 4  # Ticks per hour (int) must divide 60
+        self.tph = tph  # Ticks per hour (int) must divide 60
+        self.interpolate = interpolate  # Interpolate rates between data ticks when ticks are shorter than the data's
         self.curr_tick = 0  # Current tick in the day
         self.curr_time = timedelta(hours=0)  # Current time in the day
+        self.step = 0  # Ticks simulated so far, never wraps
+        self.arrivals = {}  # {step (int) : list of Trip objects docking at that step}
+        self.in_transit = in_transit  # List of Trip objects, stored in self.arrivals
         self.failures = 0  # Number of failed trips (includes rerouting)
         self.total_trips = 0  # Total number of trips
         self.critical_failures = 0  # Number of trips that could not be rerouted
-        self.clusters = []  # List of lists of station names
-        self.clusters_lat_lon = []  # List of lists of lat/lon
+        self.keep_failed_trips = keep_failed_trips  # Keep failed Trip objects on each cluster, not just counts
+        self.rng = np.random.default_rng(seed)  # All randomness of the simulation comes from this generator
+        self.clusters = {}  # {cluster_name (int) : list of station names}, occupied squares only
+        self.clusters_lat_lon = {}  # {cluster_name (int) : (lat, lon) of the square centroid}
         self.station_data = station_data
         # {station_name (str) :
         # {lat (float), lon (float), max_docks (int), curr_bikes (int), rate (dict{int: int}),
         # transition (dict{int: dict{str: float}})}
         self.station_clusters = {}  # {station_name (str) : cluster_name (int)}
-        self.station_information = {}
-        self.station_id_to_name = {}
+        # StationRegistry, or the path of a GBFS station_information.json or of a saved StationRegistry. Pass
+        # StationRegistry.open(path, registry_path) to convert the JSON once and keep the result
+        self.station_information = station_information
+        self.registry = None  # StationRegistry of station_information, opened when first needed
+        self.registry_index = None  # See get_registry_index
+        self.state_index = None  # See get_state_index
         self.horizontal_squares = 0  # Number of horizontal squares
         self.vertical_squares = 0  # Number of vertical squares
         self.square_length = 0  # Length of each square in lat/lon
-        self.init_station_info()
-        self.init_clusters(square_length)
+        self.grid_origin = (0.0, 0.0)  # Lat/lon of the top left corner of the grid
+        self.cluster_index = {}  # {cluster_name (int) : row/column in travel_minutes}
+        self.travel_minutes = np.zeros((0, 0), dtype=np.float32)  # Travel time between clusters in minutes
+        self.travel_ticks = np.zeros((0, 0), dtype=np.int32)  # Ticks until a trip between two clusters docks
+        self.reroute_radius = reroute_radius  # Number of nearest neighbors a failed trip can be rerouted to
+        self.reroute_hops = reroute_hops  # Reroutes stay within this many squares of the cluster, None for any
+        self.reroute_index = None  # RerouteIndex of the clusters
+        self.adjacency = None  # ClusterAdjacency of cluster_dict in cluster_index order, built on first use
+        self.recorder = None  # MetricsRecorder with a column per cluster in cluster_index order, None when off
+        self.profiler = None  # PhaseProfiler timing the phases of sim, None when off
+        # ModelCache (or its directory) the cluster arrays are loaded from and saved to, None to always build them
+        self.cache = ModelCache(cache) if isinstance(cache, str) else cache
+        self.cluster_arrays = {}  # Arrays cluster_dict was built from, see get_cluster_arrays
+        # arrays (e.g. a level of a ClusterHierarchy) replace building the clusters from station_data
+        self.init_clusters(square_length, arrays)
 
     def init_station_info(self):
+        if isinstance(self.station_information, StationRegistry):
+            self.registry = self.station_information
+            return
         try:
-            with open('../station_information.json', 'r') as f:
-                self.station_information = simplejson.load(f)['data']['stations']
-            self.station_id_to_name = {station['station_id']: station['name'] for station in
-                                       self.station_information}
+            self.registry = StationRegistry.open(self.station_information)
         except FileNotFoundError:
             print('station information not found, save station_information.json to model directory')
 
+    def get_registry(self) -> StationRegistry:
+        if self.registry is None:
+            self.init_station_info()
+        return self.registry
+
+    def __getstate__(self) -> dict:
+        # Copies and pickles drop the profiler, its timed wrappers are closures bound to this model
+        state = self.__dict__.copy()
+        if state.get('profiler') is not None:
+            for phase in PHASES:
+                state.pop(phase, None)
+            state['profiler'] = None
+        return state
+
+    @property
+    def station_id_to_name(self) -> dict[str: str]:
+        registry = self.get_registry()
+        return {} if registry is None else registry.get_id_to_name()
+
+    @property
+    def in_transit(self) -> List[Trip]:
+        # Copies of the trips in arrival order with their current time at the model time. The scheduled trips are
+        # shared with snapshots and forks, so they are never modified
+        in_transit = []
+        for step in sorted(self.arrivals):
+            for trip in self.arrivals[step]:
+                trip = copy.copy(trip)
+                trip.curr_time = self.curr_time
+                in_transit.append(trip)
+        return in_transit
+
+    @in_transit.setter
+    def in_transit(self, in_transit: List[Trip]):
+        self.arrivals = {}
+        for trip in in_transit:
+            self.schedule(trip)
+
+    def schedule(self, trip: Trip):
+        # A trip docks on the first tick where its time passes end_time, same as calling Trip.update every tick
+        ticks = max((trip.end_time - trip.curr_time) // timedelta(hours=1 / self.tph) + 1, 1)
+        if self.step + ticks in self.arrivals:
+            self.arrivals[self.step + ticks].append(trip)
+        else:
+            self.arrivals[self.step + ticks] = [trip]
+
     def sim(self):
         self.curr_tick += 1
         self.curr_time += timedelta(hours=1 / self.tph)
+        self.step += 1
         if self.curr_tick % (24 * self.tph) == 0:
             self.curr_tick = 0
-        transit = self.sim_trips()
-        transit += self.sim_clusters()
-        self.in_transit = transit
-
-    def sim_trips(self) -> List[Trip]:
-        transit = []
-        for trip in self.in_transit:
-            # updates the time for each trip
-            if trip.update(timedelta(hours=1 / self.tph)):
-                # park the bike
-                end_cluster = trip.end_cluster  # int reference to cluster
-                if not self.cluster_dict[end_cluster].return_bike(trip):  # if there is no room...
-                    # print('Bad arrival at ', end_cluster, self.cluster_dict[end_cluster].curr_bikes,
-                    #       self.cluster_dict[end_cluster].max_docks, self.cluster_dict[end_cluster].full)
-                    # print('Failure to dock')
-                    self.failures += 1
-                    new_destination = self.get_new_cluster(cluster=end_cluster, method='arrival')
-                    if new_destination > -1:
-                        distance = self.get_dist(end_cluster, new_destination)
-                        new_trip = Trip(start_cluster=trip.end_cluster,
-                                        end_cluster=new_destination,
-                                        start_time=self.curr_time,
-                                        trip_time=distance)
-                        transit.append(new_trip)
-                    else:
-                        self.critical_failures += 1
+        self.sim_trips()
+        self.sim_clusters()
+        if self.recorder is not None:
+            self.recorder.end_tick(self.step, self.curr_tick,
+                                   [cluster.curr_bikes for cluster in self.cluster_dict.values()])
+
+    def start_recording(self, path=None, chunk_ticks=None) -> MetricsRecorder:
+        # Records per tick metrics of every following sim until stop_recording
+        if chunk_ticks is None:
+            chunk_ticks = 24 * self.tph
+        self.recorder = MetricsRecorder(list(self.cluster_index), path=path, chunk_ticks=chunk_ticks)
+        return self.recorder
+
+    def stop_recording(self) -> MetricsRecorder:
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.close()
+        self.recorder = None
+        return recorder
+
+    def enable_profiling(self) -> PhaseProfiler:
+        # Times every phase of the following sims until disable_profiling, see PhaseProfiler.report
+        if self.profiler is None:
+            self.profiler = PhaseProfiler()
+            self.profiler.enable(self)
+        return self.profiler
+
+    def disable_profiling(self) -> PhaseProfiler:
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.disable()
+        self.profiler = None
+        return profiler
+
+    def sim_trips(self):
+        recorder = self.recorder
+        for trip in self.arrivals.pop(self.step, []):
+            # park the bike
+            end_cluster = trip.end_cluster  # int reference to cluster
+            if not self.cluster_dict[end_cluster].return_bike(trip, self.curr_tick):  # if there is no room...
+                self.failures += 1
+                new_destination = self.get_new_cluster(cluster=end_cluster, method='arrival')
+                if recorder is not None:
+                    recorder.failed_arrivals[self.cluster_index[end_cluster]] += 1
+                    recorder.reroutes[self.cluster_index[end_cluster]] += new_destination > -1
+                if new_destination > -1:
+                    distance = self.get_dist(end_cluster, new_destination)
+                    new_trip = Trip(start_cluster=trip.end_cluster,
+                                    end_cluster=new_destination,
+                                    start_time=self.curr_time,
+                                    trip_time=distance)
+                    self.schedule(new_trip)
                 else:
-                    self.total_trips += 1
+                    self.critical_failures += 1
             else:
-                transit.append(trip)
-        return transit
+                self.total_trips += 1
+                if recorder is not None:
+                    recorder.arrivals[self.cluster_index[end_cluster]] += 1
 
-    def sim_clusters(self) -> List[Trip]:
-        transit = []
+    def sim_clusters(self):
         for cluster in self.cluster_dict.values():
-            departures = poisson(cluster.rate[self.curr_tick])
-            transition_values = np.array(list(cluster.transition[self.curr_tick].values()))
-            transition_keys = np.array(list(cluster.transition[self.curr_tick].keys()))
-            try:
-                destinations = choice(transition_keys, departures, p=transition_values)
-            except ValueError:
-                print('Error in choice', cluster.name, departures, sum(transition_values), len(transition_keys))
-                destinations = []
-            transit += (self.sim_departures(cluster, destinations))
-        return transit
-
-    def sim_clusters_by_3(self) -> List[Trip]:
-        transit = []
+            departures = self.rng.poisson(cluster.tick_rate[self.curr_tick])
+            self.sim_departures(cluster, cluster.get_destinations(self.curr_tick, departures, self.rng))
+
+    def set_tph(self, tph: int):
+        # Rebuilds every per tick table for a new number of ticks per hour, resets the failure counts
+        if 60 % tph != 0:
+            raise ValueError(f'tph must divide 60, got {tph}')
+        in_transit = self.in_transit
+        self.tph = tph
+        self.change_time(self.curr_time)
         for cluster in self.cluster_dict.values():
-            if self.curr_tick % 3 == 0:
-                rate = cluster.rate[int(self.curr_tick / 3) - 1] / 3
-            elif self.curr_tick % 3 == 1:
-                rate = (cluster.rate[int(self.curr_tick / 3) - 1] * 2 / 3 +
-                        cluster.rate[int(self.curr_tick / 3)] * 1 / 3) / 3
-            else:
-                rate = (cluster.rate[int(self.curr_tick / 3) - 1] * 1 / 3 +
-                        cluster.rate[int(self.curr_tick / 3)] * 2 / 3) / 3
-            departures = poisson(rate)
-            transition_values = list(cluster.transition[int(self.curr_tick / 3)].values())
-            transition_keys = np.array(list(cluster.transition[int(self.curr_tick / 3)].keys()))
-            try:
-                destinations = choice(transition_keys, departures, p=transition_values)
-            except ValueError:
-                print('Error in choice', cluster.name, departures, sum(transition_values), len(transition_keys))
-                destinations = []
-            transit += (self.sim_departures(cluster, destinations))
-        return transit
+            cluster.init_ticks(tph)
+        self.init_travel_ticks()
+        self.in_transit = in_transit
+
+    def sim_clusters_by_3(self):
+        self.sim_clusters()
 
     def init_by_3(self):
-        self.tph = 12
-        self.curr_tick *= 3
+        self.set_tph(12)
 
     def sim_by_3(self):
-        self.curr_tick += 1
-        self.curr_time += timedelta(hours=1 / self.tph)
-        if self.curr_tick % (24 * self.tph) == 0:
-            self.curr_tick = 0
-        transit = self.sim_trips()
-        transit += self.sim_clusters_by_3()
-        self.in_transit = transit
+        self.sim()
 
-    def sim_departures(self, cluster: StationCluster, destinations: list[int]) -> List[Trip]:
-        transit = []
+    def sim_departures(self, cluster: StationCluster, destinations: list[int]):
         if destinations is None:
             destinations = []
+        recorder = self.recorder
         for destination in destinations:
             if destination not in self.cluster_dict:
                 print(destination, 'Destination not in cluster_dict')
@@ -150,96 +231,202 @@ class ClusterModel:
                         trip_time=self.get_dist(cluster.name, destination))
             if self.cluster_dict[destination].full:
                 self.failures += 1
-                self.cluster_dict[destination].bad_arrivals.append(trip)
+                self.cluster_dict[destination].add_bad_arrival(trip, self.curr_tick)
                 # print('Failure to arrive at ', station_name)
                 destination = self.get_new_cluster(cluster=destination, method='arrival')
+                if recorder is not None:
+                    recorder.failed_arrivals[self.cluster_index[trip.end_cluster]] += 1
+                    recorder.reroutes[self.cluster_index[trip.end_cluster]] += destination > -1
             if destination < 0:
                 self.critical_failures += 1
                 continue
-            if not cluster.get_bike(trip):
+            if destination != trip.end_cluster:
+                trip.end_cluster = destination
+                trip.end_time = trip.start_time + self.get_dist(cluster.name, destination)
+            if not cluster.get_bike(trip, self.curr_tick):
                 self.failures += 1
                 # print('Failure to depart from ', station_name)
                 new_departure_pt = self.get_new_cluster(cluster.name, method='departure')
                 # print('Failure rerouted to: ', new_departure_pt)
-                if not new_departure_pt < 0 and self.cluster_dict[new_departure_pt].get_bike(trip):
+                if not new_departure_pt < 0 and self.cluster_dict[new_departure_pt].get_bike(trip, self.curr_tick):
                     # print(new_departure_pt, ' has a bike to use')
-                    trip.start_station = new_departure_pt
-                    transit.append(trip)
+                    trip.start_cluster = new_departure_pt
+                    trip.end_time = trip.start_time + self.get_dist(new_departure_pt, trip.end_cluster)
+                    self.schedule(trip)
+                    if recorder is not None:
+                        recorder.reroutes[self.cluster_index[cluster.name]] += 1
+                        recorder.departures[self.cluster_index[new_departure_pt]] += 1
                 else:
                     # print('No bikes available at ', new_departure_pt)
                     self.critical_failures += 1
+                if recorder is not None:
+                    recorder.failed_departures[self.cluster_index[cluster.name]] += 1
             else:
-                transit.append(trip)
-        return transit
+                self.schedule(trip)
+                if recorder is not None:
+                    recorder.departures[self.cluster_index[cluster.name]] += 1
 
     def get_dist(self, start_cluster: int, end_cluster: int) -> timedelta:
-        start_cluster = self.cluster_dict[start_cluster]
-        if end_cluster in start_cluster.neighbors_dist:
-            return start_cluster.neighbors_dist[end_cluster]
-        end_cluster = self.cluster_dict[end_cluster]
-        minutes = np.sqrt(
-            (start_cluster.lat - end_cluster.lat) ** 2 + (start_cluster.lon - end_cluster.lon) ** 2) * 428 + 5
-        return timedelta(minutes=minutes)
+        minutes = self.travel_minutes[self.cluster_index[start_cluster], self.cluster_index[end_cluster]]
+        return timedelta(minutes=float(minutes))
+
+    def init_travel_matrix(self):
+        # Travel time between every pair of clusters: the fastest observed station to station trip where there is
+        # one, otherwise straight line distance * 428 + 5 minutes. Rebuild whenever cluster_dict changes
+        clusters = list(self.cluster_dict.values())
+        self.cluster_index = {cluster.name: i for i, cluster in enumerate(clusters)}
+        lat = np.array([cluster.lat for cluster in clusters], dtype=float)
+        lon = np.array([cluster.lon for cluster in clusters], dtype=float)
+        minutes = np.sqrt((lat[:, None] - lat[None, :]) ** 2 + (lon[:, None] - lon[None, :]) ** 2) * 428 + 5
+        for i, cluster in enumerate(clusters):
+            for end_cluster, dist in cluster.neighbors_dist.items():
+                if end_cluster not in self.cluster_index:
+                    continue
+                dist_minutes = dist.total_seconds() / 60
+                if not np.isnan(dist_minutes):
+                    minutes[i, self.cluster_index[end_cluster]] = dist_minutes
+        self.travel_minutes = minutes.astype(np.float32)
+        self.init_travel_ticks()
+
+    def init_travel_ticks(self):
+        # A trip docks on the first tick after its travel time has passed
+        self.travel_ticks = (np.floor(self.travel_minutes * self.tph / 60) + 1).astype(np.int32)
+
+    def init_reroute_index(self):
+        self.reroute_index = RerouteIndex(self.cluster_dict, radius=self.reroute_radius,
+                                          neighbors=self.get_reroute_neighbors())
+
+    def set_reroute_radius(self, reroute_radius: int):
+        self.reroute_radius = reroute_radius
+        self.init_reroute_index()
+
+    def set_reroute_hops(self, reroute_hops: int):
+        self.reroute_hops = reroute_hops
+        self.init_reroute_index()
+
+    def get_reroute_neighbors(self, radius=None) -> dict[int: list[int]]:
+        """
+        Clusters a failed trip can be rerouted to, nearest first. Without reroute_hops these are the nearest other
+        clusters with an observed travel time, otherwise the clusters within reroute_hops squares by travel time
+        :param radius: number of neighbors of each cluster, defaults to reroute_radius
+        :return: {cluster_name (int) : list of cluster names}
+        """
+        if radius is None:
+            radius = self.reroute_radius
+        if self.reroute_hops is None:
+            return {name: [neighbor for neighbor in cluster.nearest_neighbors
+                           if neighbor != name and neighbor in self.cluster_dict][:radius]
+                    for name, cluster in self.cluster_dict.items()}
+        adjacency = self.get_adjacency()
+        neighborhood = adjacency.get_neighborhood(self.reroute_hops)
+        neighbors = {}
+        for i, name in enumerate(adjacency.names.tolist()):
+            ends = neighborhood.indices[neighborhood.indptr[i]:neighborhood.indptr[i + 1]]
+            nearest = ends[np.argsort(self.travel_minutes[i, ends], kind='stable')[:radius]]
+            neighbors[name] = adjacency.names[nearest].tolist()
+        return neighbors
+
+    def get_adjacency(self) -> ClusterAdjacency:
+        if self.adjacency is None:
+            self.adjacency = ClusterAdjacency(self.cluster_dict, self.horizontal_squares, self.vertical_squares)
+        return self.adjacency
 
     def get_new_cluster(self, cluster: int, method='arrival') -> int:
-        nearest_neighbors = self.cluster_dict[cluster].nearest_neighbors
-        random_range = [i for i in range(4)]
-        if len(random_range) > len(nearest_neighbors):
-            random_range = random_range[:len(nearest_neighbors)]
-        random.shuffle(random_range)
-        for num in random_range:
-            neighbor = nearest_neighbors[num]
-            if method == 'arrival' and not self.cluster_dict[neighbor].full:
-                return neighbor
-            elif method == 'departure' and not self.cluster_dict[neighbor].empty:
-                return neighbor
-        return -1
+        # Uniform among the 4 nearest available neighbors within the reroute radius
+        return self.reroute_index.find(cluster, self.rng.random(), method)
 
     def change_time(self, time: timedelta):
         self.curr_time = time
         self.curr_tick = int((time.total_seconds() * self.tph) / 3600)
 
     def init_state(self, path: str, time=None, flag=False):
-        station_info_flag = False
-        station_data_flag = False
-        if time:
-            self.change_time(time)
-        with open(path, 'r') as f:
-            station_state = simplejson.load(f)['data']['stations']
-        for cluster in self.cluster_dict.values():
-            cluster.curr_bikes = 0
-        for station in station_state:
-            if station['station_id'] not in self.station_id_to_name:
-                station_info_flag = True
-                continue
-            station_name = self.station_id_to_name[station['station_id']]
-            if station_name not in self.station_data:
-                station_data_flag = True
-                continue
-            self.cluster_dict[self.station_clusters[station_name]].curr_bikes += station['num_bikes_available']
-        self.fix_max_docks()
-        for cluster in self.cluster_dict.values():
-            cluster.update()
-
-        if station_data_flag and flag:
-            print('Please update your station data')
-        if station_info_flag and flag:
+        # GBFS station_status.json (or any state taken by get_station_bikes) matched by station_id
+        rows, bikes, unknown = self.get_station_bikes(path)
+        if flag and unknown.any():
             print('Please update your station information')
+        if flag and ((rows < 0) & ~unknown).any():
+            print('Please update your station data')
+        self.load_station_bikes(rows, bikes, time)
 
     def init_df_state(self, df: pd.DataFrame, time=None):
+        rows, bikes, _ = self.get_station_bikes(df)
+        self.load_station_bikes(rows, bikes, time)
+
+    def load_station_bikes(self, rows: np.ndarray, bikes: np.ndarray, time=None):
         if time:
             self.change_time(time)
-        for cluster in self.cluster_dict.values():
-            cluster.curr_bikes = 0
-        for station in self.station_data:
-            if station not in df['name'].values:
-                continue
-            num_bikes = df.loc[df['name'] == station]['num_bikes_available'].values[0]
-            self.cluster_dict[self.station_clusters[station]].curr_bikes += num_bikes
+        for cluster, num_bikes in zip(self.cluster_dict.values(), self.get_cluster_bikes(rows, bikes).tolist()):
+            cluster.curr_bikes = num_bikes
         self.fix_max_docks()
         for cluster in self.cluster_dict.values():
             cluster.update()
 
+    def get_station_bikes(self, state) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Stations of a status snapshot joined to the stations of the model
+        :param state: DataFrame with num_bikes_available and name (or station_id) columns, a GBFS station_status
+        feed, the path of either (.csv or .json), or an array of bikes per station in station_data order
+        :return: position of each snapshot station in station_data (-1 when it is not in the model), its bikes, and
+        whether its station_id is missing from the station registry
+        """
+        if isinstance(state, str):
+            if state.endswith('.csv'):
+                state = pd.read_csv(state)
+            else:
+                with open(state, 'r') as f:
+                    state = simplejson.load(f)
+        if isinstance(state, pd.DataFrame):
+            bikes = state['num_bikes_available'].to_numpy()
+            if 'name' in state:
+                names, _ = self.get_state_index()
+                rows = names.get_indexer(state['name'])
+                return rows, bikes, np.zeros(len(rows), dtype=bool)
+            station_ids = state['station_id'].astype(str)
+        elif isinstance(state, dict):
+            stations = state['data']['stations']
+            bikes = np.fromiter((station['num_bikes_available'] for station in stations), dtype=int,
+                                count=len(stations))
+            station_ids = [station['station_id'] for station in stations]
+        else:
+            bikes = np.asarray(state)
+            return np.arange(len(bikes)), bikes, np.zeros(len(bikes), dtype=bool)
+        registry_rows = self.get_registry_index()
+        if not len(registry_rows):
+            unknown = np.ones(len(bikes), dtype=bool)
+            return np.full(len(bikes), -1), bikes, unknown
+        registry = self.get_registry().get_indices([str(station_id) for station_id in station_ids])
+        unknown = registry < 0
+        return np.where(unknown, -1, registry_rows[np.maximum(registry, 0)]), bikes, unknown
+
+    def get_cluster_bikes(self, rows: np.ndarray, bikes: np.ndarray) -> np.ndarray:
+        # Bikes in each cluster in cluster_index order, the first row of a station counts when it appears twice
+        _, station_rows = self.get_state_index()
+        stations, first = np.unique(rows, return_index=True)
+        keep = first[stations >= 0]
+        clusters = station_rows[rows[keep]]
+        valid = clusters >= 0
+        return np.bincount(clusters[valid], weights=bikes[keep][valid],
+                           minlength=len(self.cluster_index)).round().astype(int)
+
+    def get_state_index(self) -> tuple[pd.Index, np.ndarray]:
+        # Index of the station names and the cluster_index row of each station (-1 once its cluster is removed),
+        # rebuilt when cluster_index is
+        if self.state_index is None or self.state_index[0] is not self.cluster_index:
+            names = list(self.station_data)
+            rows = [self.cluster_index.get(self.station_clusters.get(station), -1) for station in names]
+            self.state_index = (self.cluster_index, pd.Index(names), np.array(rows, dtype=int))
+        return self.state_index[1], self.state_index[2]
+
+    def get_registry_index(self) -> np.ndarray:
+        # Position in station_data of each row of the registry, -1 when missing
+        if self.registry_index is None:
+            registry = self.get_registry()
+            if registry is None:
+                return np.zeros(0, dtype=int)
+            names = pd.Index(list(self.station_data))
+            self.registry_index = names.get_indexer(registry.name)
+        return self.registry_index
+
     def fix_max_docks(self):
         remove = []
         for cluster in self.cluster_dict.values():
@@ -249,6 +436,10 @@ class ClusterModel:
                 remove.append(cluster.name)
         for cluster in remove:
             del self.cluster_dict[cluster]
+        if remove:
+            self.init_travel_matrix()
+            self.adjacency = None
+            self.init_reroute_index()
 
     def mean_sq_error(self, cluster_dict=None, other_clusters=None, path=None):
         if other_clusters is None and path is None:
@@ -274,16 +465,10 @@ class ClusterModel:
             self.cluster_dict[i].curr_bikes = bikes_in_clusters[i]
             self.cluster_dict[i].update()
 
-    def get_state(self, path: str):
-        df = pd.read_csv(path)
-        other_clusters = {i: 0 for i in self.cluster_dict}
-        for i, cluster in zip(range(len(self.clusters)), self.clusters):
-            for station in cluster:
-                if station not in df['name'].values:
-                    # print(station, 'not in df')
-                    continue
-                other_clusters[i] += df.loc[df['name'] == station]['num_bikes_available'].values[0]
-        return other_clusters
+    def get_state(self, path) -> dict[int: int]:
+        # {cluster_name : bikes} of a snapshot, path is anything get_station_bikes takes
+        rows, bikes, _ = self.get_station_bikes(path)
+        return dict(zip(self.cluster_index, self.get_cluster_bikes(rows, bikes).tolist()))
 
     def truncate_transitions(self):
         done = 0
@@ -296,134 +481,307 @@ class ClusterModel:
         print('StationClusters truncated')
 
     def cluster_stations(self, square_length: float):
-        # Create clusters based on square_length and station lat/lon
-        lat_min = np.inf
-        lat_max = -np.inf
-        lon_min = np.inf
-        lon_max = -np.inf
-        for station_name in self.station_data:
-            station = self.station_data[station_name]
-            if station['lat'] < lat_min:
-                lat_min = station['lat']
-            if station['lat'] > lat_max:
-                lat_max = station['lat']
-            if station['lon'] < lon_min:
-                lon_min = station['lon']
-            if station['lon'] > lon_max:
-                lon_max = station['lon']
+        # Create clusters based on square_length and station lat/lon. Only squares holding stations are stored, a
+        # square is named by its position x + y * horizontal_squares in the grid read from the top left
+        names = list(self.station_data)
+        lat = np.array([self.station_data[station]['lat'] for station in names], dtype=float)
+        lon = np.array([self.station_data[station]['lon'] for station in names], dtype=float)
+        lat_min, lat_max = lat.min(), lat.max()
+        lon_min, lon_max = lon.min(), lon.max()
         self.vertical_squares = int((lat_max - lat_min) / square_length) + 1
         self.horizontal_squares = int((lon_max - lon_min) / square_length) + 1
+        self.square_length = square_length
+        self.grid_origin = (float(lat_max), float(lon_min))
         squares = self.horizontal_squares * self.vertical_squares
         print(f'{self.horizontal_squares} horizontal squares and '
               f'{self.vertical_squares} vertical squares. Total squares: {squares}')
-        self.clusters = [[] for _ in range(squares)]
 
         # Put each station in a cluster
-        for station_name in self.station_data:
-            station = self.station_data[station_name]
-            x = floor((station['lon'] - lon_min) / square_length)
-            y = -floor((station['lat'] - lat_min) / square_length) - 1
-            self.clusters[x + y * self.horizontal_squares].append(station_name)
-
-        # Create a tuple of the lat, lon centroid for each cluster
-        lat = lat_max - square_length / 2
-        for i in range(self.vertical_squares):
-            lon = lon_min + square_length / 2
-            for j in range(self.horizontal_squares):
-                self.clusters_lat_lon.append((lat, lon))
-                lon += square_length
-            lat -= square_length
+        x = np.floor((lon - lon_min) / square_length).astype(int)
+        y = self.vertical_squares - 1 - np.floor((lat - lat_min) / square_length).astype(int)
+        self.clusters = {}
+        for station, cluster in zip(names, (x + y * self.horizontal_squares).tolist()):
+            if cluster in self.clusters:
+                self.clusters[cluster].append(station)
+            else:
+                self.clusters[cluster] = [station]
+        self.clusters = dict(sorted(self.clusters.items()))
+        self.clusters_lat_lon = {cluster: self.get_square_lat_lon(cluster) for cluster in self.clusters}
 
         return self.horizontal_squares, self.vertical_squares, self.clusters
 
-    def init_clusters(self, square_length=0.005):
+    def get_dense_clusters(self) -> list[list[str]]:
+        # Stations of every square of the grid in name order, empty squares included, like clusters used to be
+        dense = [[] for _ in range(self.horizontal_squares * self.vertical_squares)]
+        for cluster, stations in self.clusters.items():
+            dense[cluster] = stations
+        return dense
+
+    def get_square_lat_lon(self, cluster: int) -> tuple[float, float]:
+        # Centroid of a square of the grid
+        lat = self.grid_origin[0] - self.square_length / 2 - (cluster // self.horizontal_squares) * self.square_length
+        lon = self.grid_origin[1] + self.square_length / 2 + (cluster % self.horizontal_squares) * self.square_length
+        return lat, lon
+
+    def get_grid(self, values: dict[int: float]) -> np.ndarray:
+        # Dense (vertical_squares, horizontal_squares) array of per cluster values, 0 where there is no cluster
+        grid = np.zeros(self.vertical_squares * self.horizontal_squares)
+        if values:
+            grid[np.fromiter(values, dtype=int, count=len(values))] = list(values.values())
+        return grid.reshape((self.vertical_squares, self.horizontal_squares))
+
+    def init_clusters(self, square_length=0.005, arrays=None):
+        key = None
+        if arrays is None and self.cache is not None:
+            # Squares already built are reused whatever square_length is, so they decide the key
+            if self.clusters:
+                square_length = self.square_length
+            key = self.cache.get_key(self.station_data, square_length)
+            arrays = self.cache.load(key)
+            # grid_origin holds the square length the arrays were built at
+            if arrays is not None and arrays['grid_origin'][2] != square_length:
+                self.cache.remove(key)
+                arrays = None
+        if arrays is None:
+            arrays = self.get_cluster_arrays(square_length)
+        self.init_clusters_from_arrays(arrays)
+        if 'travel_minutes' in arrays:
+            self.cluster_index = {name: i for i, name in enumerate(self.cluster_dict)}
+            self.travel_minutes = arrays['travel_minutes']
+            self.init_travel_ticks()
+        else:
+            self.init_travel_matrix()
+            if key is not None:
+                arrays['travel_minutes'] = self.travel_minutes
+                self.cache.save(key, arrays)
+        self.cluster_arrays = arrays
+        self.init_reroute_index()
+
+    def get_cluster_arrays(self, square_length=0.005) -> dict[str: np.ndarray]:
+        """
+        Cluster parameters at the resolution of the data as arrays. Clusters are numbered by their position in
+        cells, the occupied squares, and rows of the CSR matrices are tick * number of cells + cell for transitions
+        and cell for distances. End clusters are cluster names
+        :return: {station_names, station_clusters, cells, grid, grid_origin, clusters_lat_lon, max_docks, rates,
+        transition_indptr, transition_indices, transition_probs, transition_cdf, transition_totals, dist_indptr,
+        dist_indices, dist_minutes}
+        """
         if not self.clusters:
             self.cluster_stations(square_length)
         if not self.station_clusters:
-            self.station_clusters = {station: i for i in range(len(self.clusters)) for station in self.clusters[i]}
-        for i, cluster in zip(range(len(self.clusters)), self.clusters):
-            if cluster:
-                rate = [0 for i in range(24 * 4)]
-                max_docks = 0
-                transition = {i: {} for i in range(24 * 4)}
-                neighbors_dist = {}
-                for station in cluster:
-                    max_docks += self.station_data[station]['max_docks']
-                    for end_station in self.station_data[station]['dist']:  # Get the nearest neighbor for each station
-                        if end_station in neighbors_dist:
-                            if self.station_data[station]['dist'][end_station] < neighbors_dist[end_station]:
-                                neighbors_dist[end_station] = self.station_data[station]['dist'][end_station]
-                        else:
-                            neighbors_dist[end_station] = self.station_data[station]['dist'][end_station]
-                    for tick in self.station_data[station]['rate']:
-                        station_rate = self.station_data[station]['rate'][tick]
-                        rate[tick] += station_rate
-                        for end_station in self.station_data[station]['transition'][tick]:
-                            if end_station in transition[tick]:
-                                transition[tick][end_station] += (
-                                        self.station_data[station]['transition'][tick][end_station] * station_rate)
-                            else:
-                                transition[tick][end_station] = (
-                                        self.station_data[station]['transition'][tick][end_station] * station_rate)
-                for tick in range(24 * 4):
-                    for end_station in transition[tick]:
-                        transition[tick][end_station] /= rate[tick]
-                cluster_transition = self.get_cluster_transition(transition, i)
-                cluster_dist = {}
-                for station in neighbors_dist:
-                    if station not in self.station_data:
-                        continue
-                    if self.station_clusters[station] in cluster_dist:
-                        if neighbors_dist[station] < cluster_dist[self.station_clusters[station]]:
-                            cluster_dist[self.station_clusters[station]] = neighbors_dist[station]
-                    else:
-                        cluster_dist[self.station_clusters[station]] = neighbors_dist[station]
-                self.cluster_dict[i] = StationCluster(name=i,
-                                                      neighbors_dist=cluster_dist,
-                                                      max_docks=max_docks,
-                                                      curr_bikes=0,
-                                                      rate=rate,
-                                                      transition=cluster_transition,
-                                                      lat=self.clusters_lat_lon[i][0],
-                                                      lon=self.clusters_lat_lon[i][1])
-
-    def get_cluster_transition(self, transition: dict[int: dict[str: float]], cluster: int):
-        cluster_transition = {i: {} for i in range(24 * 4)}
-        for tick in transition:
-            for end_station in transition[tick]:
-                if end_station not in self.station_clusters:
-                    # print(end_station, 'not in station_clusters')
-                    continue
-                if self.station_clusters[end_station] in cluster_transition[tick]:
-                    cluster_transition[tick][self.station_clusters[end_station]] += transition[tick][end_station]
-                else:
-                    cluster_transition[tick][self.station_clusters[end_station]] = transition[tick][end_station]
-
-            if len(cluster_transition[tick]) < 1:
-                cluster_transition[tick] = {cluster: 1}
-            prob_total = sum(cluster_transition[tick].values())
-            if prob_total < 0.9999:
-                for end_cluster in cluster_transition[tick]:
-                    cluster_transition[tick][end_cluster] /= prob_total
-        return cluster_transition
-
-    def get_num_open_docks_in_clusters(self) -> List[int]:
-        dock_cluster = []
+            self.station_clusters = {station: i for i in self.clusters for station in self.clusters[i]}
+        names = list(self.station_data)
+        station_index = {station: i for i, station in enumerate(names)}
+        num_stations = len(names)
+        data_ticks = max(len(station['rate']) for station in self.station_data.values())  # Rate ticks per day
+        cells, station_cluster = np.unique(np.array([self.station_clusters[station] for station in names], dtype=int),
+                                           return_inverse=True)
+        num_clusters = len(cells)
+
+        # Station x cluster membership, every station level quantity is summed into its cluster through it
+        membership = sparse.csr_matrix((np.ones(num_stations), (np.arange(num_stations), station_cluster)),
+                                       shape=(num_stations, num_clusters))
+        max_docks = membership.T @ np.array([self.station_data[station]['max_docks'] for station in names], dtype=float)
+        rates, flows = self.get_station_flows(names, station_index, data_ticks)
+        cluster_rates = np.asarray(rates @ membership)  # (data ticks, clusters)
+        # Rows tick * num_stations + station become tick * num_clusters + cluster for all ticks at once
+        aggregate = sparse.kron(sparse.identity(data_ticks, format='csr'), membership.T, format='csr')
+        cluster_flows = (aggregate @ flows @ membership).tocsr()
+        transition_indptr, transition_indices, transition_probs, transition_cdf, transition_totals = \
+            self.get_cluster_transitions(cluster_flows, cluster_rates)
+        dist_indptr, dist_indices, dist_minutes = self.get_cluster_dists(names, station_index, station_cluster,
+                                                                         num_clusters)
+        return {'station_names': np.array(names, dtype=str),
+                'station_clusters': station_cluster,
+                'cells': cells,
+                'grid': np.array([self.horizontal_squares, self.vertical_squares], dtype=int),
+                'grid_origin': np.array([*self.grid_origin, self.square_length], dtype=float),
+                'clusters_lat_lon': np.array([self.clusters_lat_lon[cell] for cell in cells.tolist()],
+                                             dtype=float).reshape((num_clusters, 2)),
+                'max_docks': np.rint(max_docks).astype(int),
+                'rates': cluster_rates,
+                'transition_indptr': transition_indptr,
+                'transition_indices': cells[transition_indices],
+                'transition_probs': transition_probs,
+                'transition_cdf': transition_cdf,
+                'transition_totals': transition_totals,
+                'dist_indptr': dist_indptr,
+                'dist_indices': cells[dist_indices],
+                'dist_minutes': dist_minutes}
+
+    def init_clusters_from_arrays(self, arrays: dict[str: np.ndarray]):
+        # Builds cluster_dict from get_cluster_arrays, transition dicts are only built when read
+        names = arrays['station_names'].tolist()
+        cells = arrays['cells'].tolist()
+        station_clusters = arrays['cells'][arrays['station_clusters']].tolist()
+        num_clusters = len(cells)
+        self.horizontal_squares, self.vertical_squares = (int(n) for n in arrays['grid'])
+        lat_max, lon_min, self.square_length = (float(n) for n in arrays['grid_origin'])
+        self.grid_origin = (lat_max, lon_min)
+        if not self.clusters:
+            self.clusters = {cluster: [] for cluster in cells}
+            for station, cluster in zip(names, station_clusters):
+                self.clusters[cluster].append(station)
+            self.clusters_lat_lon = {cluster: tuple(lat_lon)
+                                     for cluster, lat_lon in zip(cells, arrays['clusters_lat_lon'].tolist())}
+        if not self.station_clusters:
+            self.station_clusters = dict(zip(names, station_clusters))
+        rates = arrays['rates']
+        data_ticks = len(rates)
+        transition_indptr = arrays['transition_indptr']
+        transition_indices = arrays['transition_indices']
+        transition_probs = arrays['transition_probs']
+        transition_cdf = arrays['transition_cdf']
+        dist_indptr = arrays['dist_indptr'].tolist()
+        dist_indices = arrays['dist_indices'].tolist()
+        dist_minutes = arrays['dist_minutes'].tolist()
+        for k, i in enumerate(cells):
+            rows = np.arange(data_ticks) * num_clusters + k
+            starts, ends = transition_indptr[rows], transition_indptr[rows + 1]
+            keys = [transition_indices[start:end] for start, end in zip(starts, ends)]
+            probs = [transition_probs[start:end] for start, end in zip(starts, ends)]
+            cdfs = [transition_cdf[start:end] for start, end in zip(starts, ends)]
+            neighbors_dist = {}
+            for j in range(dist_indptr[k], dist_indptr[k + 1]):
+                minutes = dist_minutes[j]
+                neighbors_dist[dist_indices[j]] = pd.NaT if minutes != minutes else timedelta(minutes=minutes)
+            self.cluster_dict[i] = StationCluster(name=i,
+                                                  neighbors_dist=neighbors_dist,
+                                                  max_docks=int(arrays['max_docks'][k]),
+                                                  curr_bikes=0,
+                                                  rate=rates[:, k].tolist(),
+                                                  transition=TransitionRows(keys, probs),
+                                                  lat=self.clusters_lat_lon[i][0],
+                                                  lon=self.clusters_lat_lon[i][1],
+                                                  keep_trips=self.keep_failed_trips,
+                                                  tph=self.tph,
+                                                  interpolate=self.interpolate,
+                                                  samplers=(keys, cdfs))
+
+    def get_station_flows(self, names: list[str], station_index: dict[str: int], data_ticks: int) \
+            -> tuple[np.ndarray, sparse.csr_matrix]:
+        # Station rates (data ticks, stations) and rate weighted transitions (data ticks * stations, stations).
+        # Transition dicts shared by several ticks or stations are only read once
+        num_stations = len(names)
+        rates = np.zeros((data_ticks, num_stations))
+        patterns = {}  # {id of a transition dict : pattern number}
+        ends, probs = [], []
+        pattern_starts = [0]
+        row_patterns, row_rates, rows = [], [], []
+        for i, station in enumerate(names):
+            station_rate = self.station_data[station]['rate']
+            station_transition = self.station_data[station]['transition']
+            for tick in station_rate:
+                rate = station_rate[tick]
+                rates[tick, i] += rate
+                transition = station_transition[tick]
+                pattern = patterns.get(id(transition))
+                if pattern is None:
+                    pattern = patterns[id(transition)] = len(pattern_starts) - 1
+                    for end_station, prob in transition.items():
+                        if end_station in station_index:
+                            ends.append(station_index[end_station])
+                            probs.append(prob)
+                    pattern_starts.append(len(ends))
+                row_patterns.append(pattern)
+                row_rates.append(rate)
+                rows.append(tick * num_stations + i)
+        ends = np.array(ends, dtype=int)
+        probs = np.array(probs, dtype=float)
+        pattern_starts = np.array(pattern_starts, dtype=int)
+        row_patterns = np.array(row_patterns, dtype=int)
+        lengths = np.diff(pattern_starts)[row_patterns]
+        # Position of every entry of every row in ends/probs
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        entries = np.repeat(pattern_starts[row_patterns], lengths) + offsets
+        flows = sparse.csr_matrix((probs[entries] * np.repeat(np.array(row_rates, dtype=float), lengths),
+                                   (np.repeat(np.array(rows, dtype=int), lengths), ends[entries])),
+                                  shape=(data_ticks * num_stations, num_stations))
+        return rates, flows
+
+    @staticmethod
+    def get_cluster_transitions(cluster_flows: sparse.csr_matrix, cluster_rates: np.ndarray) \
+            -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Transition probabilities from the (data ticks * clusters, clusters) flows: divided by the cluster rate,
+        renormalized when end stations outside the model took part of it, staying put when a tick has none
+        :return: indptr, indices (end clusters), probabilities and per row cumulative distributions of the CSR rows,
+        and the probability of each row before renormalizing, which turns the probabilities back into flows
+        """
+        data_ticks, num_clusters = cluster_rates.shape
+        cluster_flows.sort_indices()
+        counts = np.diff(cluster_flows.indptr)
+        rows = np.repeat(np.arange(len(counts)), counts)
+        rates = cluster_rates.ravel()[rows]
+        probs = np.divide(cluster_flows.data, rates, out=np.zeros_like(cluster_flows.data), where=rates > 0)
+        totals = np.bincount(rows, weights=probs, minlength=len(counts))
+        probs /= np.where((totals > 0) & (totals < 0.9999), totals, 1)[rows]
+        # Rows without any probability become a single entry to their own cluster
+        stay = np.flatnonzero(totals <= 0)
+        keep = totals[rows] > 0
+        rows = np.concatenate([rows[keep], stay])
+        indices = np.concatenate([cluster_flows.indices[keep], stay % num_clusters])
+        probs = np.concatenate([probs[keep], np.ones(len(stay))])
+        order = np.lexsort((indices, rows))
+        rows, indices, probs = rows[order], indices[order].astype(int), probs[order]
+        indptr = np.zeros(len(counts) + 1, dtype=int)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(counts)))
+
+        # Cumulative sums inside each row in one pass: the first entry of every row takes off the total of the row
+        # before so the running sum restarts near 0, then what is left of the previous rows is taken off each row
+        cdf = probs.copy()
+        if len(cdf):
+            starts = indptr[:-1]
+            cdf[starts[1:]] -= np.add.reduceat(probs, starts)[:-1]
+            np.cumsum(cdf, out=cdf)
+            cdf -= np.repeat(cdf[starts] - probs[starts], np.diff(indptr))
+        last = indptr[1:] - 1
+        cdf /= cdf[last][rows]
+        cdf[last] = 1
+        return indptr, indices, probs, cdf, totals
+
+    def get_cluster_dists(self, names: list[str], station_index: dict[str: int], station_cluster: np.ndarray,
+                          num_clusters: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Shortest station to station travel time between clusters, NaN when no time is known
+        :return: indptr, indices (end clusters) and minutes of the CSR rows of each cluster
+        """
+        starts, ends, minutes = [], [], []
+        for i, station in enumerate(names):
+            for end_station, dist in self.station_data[station]['dist'].items():
+                if end_station in station_index:
+                    starts.append(i)
+                    ends.append(station_index[end_station])
+                    minutes.append(dist.total_seconds() / 60)
+        return self.group_dists(station_cluster[np.array(starts, dtype=int)], station_cluster[np.array(ends, dtype=int)],
+                                np.array(minutes, dtype=float), num_clusters)
+
+    @staticmethod
+    def group_dists(starts: np.ndarray, ends: np.ndarray, minutes: np.ndarray, num_clusters: int) \
+            -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Shortest of the travel times between the same start and end clusters as CSR rows of the start clusters
+        keys = starts * num_clusters + ends
+        # Sorting by key then minutes puts the shortest first in each group, NaN sorts last
+        order = np.lexsort((minutes, keys))
+        keys, minutes = keys[order], minutes[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        keys, minutes = keys[first], minutes[first]
+        indptr = np.zeros(num_clusters + 1, dtype=int)
+        indptr[1:] = np.cumsum(np.bincount(keys // num_clusters, minlength=num_clusters))
+        return indptr, keys % num_clusters, minutes
+
+    def get_num_open_docks_in_clusters(self) -> dict[int: int]:
+        dock_cluster = {}
         for cluster in self.clusters:
             num_docks = 0
             for station in self.clusters[cluster]:
                 num_docks += self.station_data[station]['max_docks'] - self.station_data[station]['curr_bikes']
-            dock_cluster.append(num_docks)
+            dock_cluster[cluster] = num_docks
         return dock_cluster
 
     def get_num_bikes_in_clusters(self) -> np.ndarray:
-        num_bikes = []
-        for i in range(len(self.clusters)):
-            if i in self.cluster_dict:
-                num_bikes.append(self.cluster_dict[i].curr_bikes)
-            else:
-                num_bikes.append(0)
-        return np.array(num_bikes).reshape((self.vertical_squares, self.horizontal_squares))
+        return self.get_grid({name: cluster.curr_bikes for name, cluster in self.cluster_dict.items()}).astype(int)
 
     def show_bikes(self, save=False, name=None) -> sns.heatmap:
         plt.close()
@@ -437,13 +795,7 @@ class ClusterModel:
         return fig
 
     def get_max_docks_in_clusters(self) -> np.ndarray:
-        num_docks = []
-        for i in range(len(self.clusters)):
-            if i in self.cluster_dict:
-                num_docks.append(self.cluster_dict[i].max_docks)
-            else:
-                num_docks.append(0)
-        return np.array(num_docks).reshape((self.vertical_squares, self.horizontal_squares))
+        return self.get_grid({name: cluster.max_docks for name, cluster in self.cluster_dict.items()}).astype(int)
 
     def get_fill_percent(self) -> np.ndarray:
         num_bikes = self.get_num_bikes_in_clusters()
@@ -469,13 +821,7 @@ class ClusterModel:
 
     def show_failures(self, save=False, name=None) -> sns.heatmap:
         plt.close()
-        failures = []
-        for i in range(len(self.clusters)):
-            if i in self.cluster_dict:
-                failures.append(len(self.cluster_dict[i].bad_arrivals) + len(self.cluster_dict[i].bad_departures))
-            else:
-                failures.append(0)
-        failures = np.array(failures).reshape((self.vertical_squares, self.horizontal_squares))
+        failures = self.get_grid({name: cluster.num_failures() for name, cluster in self.cluster_dict.items()})
         fig = sns.heatmap(failures, cmap='Reds')
         plt.title(str(self.curr_time))
         if not name:
@@ -486,8 +832,7 @@ class ClusterModel:
 
     def reset_failures(self):
         for cluster in self.cluster_dict.values():
-            cluster.bad_arrivals = []
-            cluster.bad_departures = []
+            cluster.reset_failures()
 
     def reset_state(self, bike_state: dict[int: int], in_transit: List[Trip], time: timedelta):
         for i in bike_state:
@@ -500,25 +845,59 @@ class ClusterModel:
         self.total_trips = 0
         self.critical_failures = 0
 
-    def get_adjacent_clusters(self) -> dict[int: list[int]]:
-        adjacent_clusters = {}
-        for cluster in self.cluster_dict:
-            adjacent_cluster = []
-            if cluster % self.horizontal_squares != 0:
-                if cluster - 1 in self.cluster_dict:
-                    adjacent_cluster.append(cluster - 1)
-
-            if cluster > self.horizontal_squares:
-                if cluster - self.horizontal_squares in self.cluster_dict:
-                    adjacent_cluster.append(cluster - self.horizontal_squares)
-
-            if cluster % self.horizontal_squares - 1 != 0:
-                if cluster + 1 in self.cluster_dict:
-                    adjacent_cluster.append(cluster + 1)
-
-            if cluster < self.horizontal_squares * (self.vertical_squares - 1):
-                if cluster + self.horizontal_squares in self.cluster_dict:
-                    adjacent_cluster.append(cluster + self.horizontal_squares)
-
-            adjacent_clusters[cluster] = adjacent_cluster
-        return adjacent_clusters
+    def snapshot(self) -> dict:
+        # Copy of the mutable state only, static parameters (rates, transitions, distances) are not included
+        clusters = list(self.cluster_dict.values())
+        return {'names': [cluster.name for cluster in clusters],
+                'bikes': np.array([cluster.curr_bikes for cluster in clusters], dtype=int),
+                'arrival_failures': np.array([cluster.arrival_failures for cluster in clusters], dtype=int),
+                'departure_failures': np.array([cluster.departure_failures for cluster in clusters], dtype=int),
+                'bad_arrivals': [list(cluster.bad_arrivals) for cluster in clusters],
+                'bad_departures': [list(cluster.bad_departures) for cluster in clusters],
+                # Scheduled trips are never modified by the simulation, so they can be shared
+                'arrivals': {step: list(trips) for step, trips in self.arrivals.items()},
+                'step': self.step,
+                'curr_tick': self.curr_tick,
+                'curr_time': self.curr_time,
+                'failures': self.failures,
+                'total_trips': self.total_trips,
+                'critical_failures': self.critical_failures,
+                'rng': self.rng.bit_generator.state}
+
+    def restore(self, snapshot: dict):
+        if snapshot['names'] != list(self.cluster_dict):
+            raise ValueError('Snapshot was taken with different clusters')
+        for i, cluster in enumerate(self.cluster_dict.values()):
+            cluster.curr_bikes = int(snapshot['bikes'][i])
+            cluster.update()
+            cluster.arrival_failures = snapshot['arrival_failures'][i].copy()
+            cluster.departure_failures = snapshot['departure_failures'][i].copy()
+            cluster.bad_arrivals = list(snapshot['bad_arrivals'][i])
+            cluster.bad_departures = list(snapshot['bad_departures'][i])
+        self.arrivals = {step: list(trips) for step, trips in snapshot['arrivals'].items()}
+        self.step = snapshot['step']
+        self.curr_tick = snapshot['curr_tick']
+        self.curr_time = snapshot['curr_time']
+        self.failures = snapshot['failures']
+        self.total_trips = snapshot['total_trips']
+        self.critical_failures = snapshot['critical_failures']
+        self.rng = np.random.default_rng()
+        self.rng.bit_generator.state = snapshot['rng']
+
+    def fork(self, snapshot=None, seed=None) -> 'ClusterModel':
+        # New model sharing every static parameter with this one, starting from snapshot (default: current state).
+        # Forks of the same snapshot replay the same random draws unless seeded
+        if snapshot is None:
+            snapshot = self.snapshot()
+        model = copy.copy(self)
+        model.cluster_dict = {name: copy.copy(cluster) for name, cluster in self.cluster_dict.items()}
+        model.init_reroute_index()
+        model.recorder = None
+        model.restore(snapshot)
+        if seed is not None:
+            model.rng = np.random.default_rng(seed)
+        return model
+
+    def get_adjacent_clusters(self, k=1) -> dict[int: list[int]]:
+        # {cluster_name : clusters within k squares}, see get_adjacency for the CSR matrices
+        return self.get_adjacency().to_dict(k)
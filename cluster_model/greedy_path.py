@@ -1,7 +1,14 @@
+import numpy as np
+
+
 class GreedyPath:
 
-    def __init__(self, weight: dict[int: int], adjacency: dict[int: list[int]], vertical_squares: int,
-               horizontal_squares: int, curr_bikes: int, max_bikes: int, max_time: int):
+    def __init__(self, weight: dict[int: int], adjacency, vertical_squares: int,
+               horizontal_squares: int, curr_bikes: int, max_bikes: int, max_time: int, travel_ticks=None,
+               cluster_index=None):
+        # travel_ticks and cluster_index are ClusterModel.travel_ticks and ClusterModel.cluster_index, when given
+        # they replace the grid distance between clusters. Otherwise with adjacency a ClusterAdjacency
+        # (ClusterModel.get_adjacency()) the distance is the number of squares driven through occupied squares
         self.weight = weight
         self.adjacency = adjacency
         self.v_sq = vertical_squares
@@ -9,6 +16,8 @@ class GreedyPath:
         self.curr_bikes = curr_bikes
         self.max_bikes = max_bikes
         self.max_time = max_time
+        self.travel_ticks = travel_ticks
+        self.cluster_index = cluster_index
 
     def DFS(self, depth: int, path):
         if depth == 0:
@@ -17,25 +26,37 @@ class GreedyPath:
             path.append(self.find_max_route())
 
     def find_max_route(self, start: int, weight: dict[int: int], curr_bikes: int, max_time: int, drop: bool):
-        maximum = 0
-        dest = 0
-        time = 1
-        for cluster in self.weight:
-            dist = distance(start=start, end=cluster, h_sq=self.h_sq, v_sq=self.v_sq)
-            if dist > max_time and not drop:
-                continue
-            value = self.weight[cluster]
-            if value < curr_bikes - self.max_bikes:
-                value = curr_bikes - self.max_bikes
-            if value > self.curr_bikes:
-                value = self.curr_bikes
-            if value < 0 and drop:
-                continue
-            if abs(value / time_scale(dist)) > abs(maximum / time_scale(time)):
-                maximum = value
-                dest = cluster
-                time = dist
-        return dest, time, maximum
+        # The cluster with the largest change of bikes per time_scale of the distance to it, first one on ties
+        clusters = list(self.weight)
+        if not clusters:
+            return 0, 1, 0
+        dist = self.distances(start=start, ends=clusters)
+        value = np.array([self.weight[cluster] for cluster in clusters])
+        value = np.minimum(np.maximum(value, curr_bikes - self.max_bikes), self.curr_bikes)
+        keep = np.isfinite(dist)
+        if drop:
+            keep &= value >= 0
+        else:
+            keep &= dist <= max_time
+        score = np.where(keep, np.abs(value / time_scale(np.where(keep, dist, 1))), 0)
+        best = int(np.argmax(score))
+        if score[best] <= 0:
+            return 0, 1, 0
+        return clusters[best], int(dist[best]), value[best].item()
+
+    def distance(self, start: int, end: int):
+        return self.distances(start=start, ends=[end])[0]
+
+    def distances(self, start: int, ends: list[int]) -> np.ndarray:
+        # Distance from start to each cluster of ends, inf when no path joins them
+        if self.travel_ticks is not None:
+            return self.travel_ticks[self.cluster_index[start], [self.cluster_index[end] for end in ends]].astype(float)
+        if hasattr(self.adjacency, 'get_hops'):
+            index = self.adjacency.index
+            hops = self.adjacency.get_hops()[index[start], [index[end] for end in ends]].astype(float)
+            hops[hops < 0] = np.inf
+            return hops + 1
+        return distance(start=start, end=np.asarray(ends), h_sq=self.h_sq, v_sq=self.v_sq).astype(float)
 
 
 def time_scale(time):
@@ -43,7 +64,7 @@ def time_scale(time):
 
 
 def distance(start: int, end: int, h_sq: int, v_sq: int):
-    x_dist = abs((start - end) % h_sq)
+    x_dist = abs((start % h_sq) - (end % h_sq))
     y_dist = abs((start // h_sq) - (end // h_sq))
     return x_dist + y_dist + 1
 
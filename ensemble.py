@@ -0,0 +1,95 @@
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+
+import numpy as np
+
+from array_model import ArrayModel
+from cluster_model import ClusterModel
+
+_model = None  # ClusterModel the replicas of this process start from
+
+
+def init_worker(model: ClusterModel):
+    global _model
+    _model = model
+
+
+def run_replica(seed: np.random.SeedSequence, ticks: int, engine: str) -> tuple[int, int, int, np.ndarray]:
+    # Returns failures, critical failures and finished trips of the run plus the (ticks, clusters) fill percent
+    if engine == 'array':
+        sim = ArrayModel(_model, seed=seed)
+        max_docks = np.maximum(sim.max_docks, 1)
+        get_bikes = lambda: sim.curr_bikes
+    else:
+        sim = copy.deepcopy(_model)
+        sim.rng = np.random.default_rng(seed)
+        clusters = list(sim.cluster_dict.values())
+        max_docks = np.maximum(np.array([cluster.max_docks for cluster in clusters]), 1)
+        get_bikes = lambda: np.array([cluster.curr_bikes for cluster in clusters])
+    failures, critical_failures, total_trips = sim.failures, sim.critical_failures, sim.total_trips
+    fill = np.zeros((ticks, len(max_docks)))
+    for tick in range(ticks):
+        sim.sim()
+        fill[tick] = get_bikes() / max_docks
+    return (sim.failures - failures, sim.critical_failures - critical_failures, sim.total_trips - total_trips,
+            fill)
+
+
+def confidence_interval(samples: np.ndarray, confidence=0.95) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Normal approximation of the interval of the mean over the first axis
+    mean = samples.mean(axis=0)
+    if len(samples) < 2:
+        return mean, mean, mean
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    half_width = z * samples.std(axis=0, ddof=1) / np.sqrt(len(samples))
+    return mean, mean - half_width, mean + half_width
+
+
+class Ensemble:
+    def __init__(self, model: ClusterModel, engine='array'):
+        """
+        :param model: ClusterModel holding the starting state, it is not modified by the runs
+        :param engine: 'array' to run replicas with ArrayModel, 'object' to run copies of the ClusterModel
+        """
+        self.model = model
+        self.engine = engine
+
+    def run(self, replicas: int, ticks=None, seed=None, processes=None, confidence=0.95) -> dict:
+        """
+        Runs independent replicas of the model, each with its own generator spawned from seed
+        :param replicas: number of simulations
+        :param ticks: ticks simulated by each replica, defaults to one day
+        :param seed: seed of the SeedSequence the replica generators are spawned from
+        :param processes: size of the process pool, 1 runs in this process, None uses every core
+        :param confidence: confidence level of the returned intervals
+        :return: per replica results and their means with confidence intervals
+        """
+        if ticks is None:
+            ticks = 24 * self.model.tph
+        seeds = np.random.SeedSequence(seed).spawn(replicas)
+        if processes == 1:
+            init_worker(self.model)
+            results = [run_replica(replica_seed, ticks, self.engine) for replica_seed in seeds]
+        else:
+            with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                     initargs=(self.model,)) as pool:
+                results = list(pool.map(run_replica, seeds, [ticks] * replicas, [self.engine] * replicas))
+
+        failures = np.array([result[0] for result in results])
+        critical_failures = np.array([result[1] for result in results])
+        total_trips = np.array([result[2] for result in results])
+        fill = np.array([result[3] for result in results])
+        failures_mean, failures_low, failures_high = confidence_interval(failures, confidence)
+        critical_mean, critical_low, critical_high = confidence_interval(critical_failures, confidence)
+        fill_mean, fill_low, fill_high = confidence_interval(fill, confidence)
+        return {'names': list(self.model.cluster_dict),
+                'failures': failures,
+                'critical_failures': critical_failures,
+                'total_trips': total_trips,
+                'failures_mean': failures_mean,
+                'failures_ci': (failures_low, failures_high),
+                'critical_failures_mean': critical_mean,
+                'critical_failures_ci': (critical_low, critical_high),
+                'fill_mean': fill_mean,  # (ticks, clusters) in the order of names
+                'fill_ci': (fill_low, fill_high)}
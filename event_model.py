@@ -0,0 +1,218 @@
+import heapq
+from datetime import timedelta
+from itertools import count
+from math import inf
+
+import numpy as np
+
+from cluster_model import ClusterModel
+from trip import Trip
+
+
+class EventModel:
+    """
+    Continuous time simulation of a ClusterModel. Departure times are drawn from the piecewise constant rate of
+    the station data into a time ordered stream and arrivals go through an event heap, so the cost grows with the
+    number of trips instead of clusters * ticks. Times are minutes since midnight of the first day.
+    """
+    def __init__(self, model: ClusterModel, seed=None, num_neighbors=None, choices=4):
+        """
+        :param model: ClusterModel to simulate, it is only written to by sync
+        :param seed: seed or SeedSequence of the generator
+        :param num_neighbors: number of nearest neighbors a trip can be rerouted to, defaults to model.reroute_radius
+        :param choices: a reroute picks uniformly among this many nearest available neighbors
+        """
+        self.model = model
+        self.rng = np.random.default_rng(seed)
+        self.tph = model.tph
+        self.choices = choices
+        self.curr_tick = model.curr_tick
+        self.curr_time = model.curr_time
+        self.time = model.curr_time.total_seconds() / 60
+        self.failures = model.failures
+        self.total_trips = model.total_trips
+        self.critical_failures = model.critical_failures
+        self.events = []  # Heap of arrivals (time, sequence, origin index, destination index)
+        self.sequence = count()
+        self.departures = []  # Drawn departures (time, origin index, destination index) in time order
+        self.next_departure = 0  # Position of the next departure to handle in self.departures
+        self.uniforms = np.zeros(0)  # Buffer of uniform draws for reroutes
+        self.next_uniform = 0
+
+        clusters = list(model.cluster_dict.values())
+        num_clusters = len(clusters)
+        self.names = [cluster.name for cluster in clusters]
+        self.index = {cluster.name: i for i, cluster in enumerate(clusters)}
+        self.max_docks = [cluster.max_docks for cluster in clusters]
+        self.curr_bikes = [cluster.curr_bikes for cluster in clusters]
+        if num_neighbors is None:
+            num_neighbors = model.reroute_radius
+        reroute_neighbors = model.get_reroute_neighbors(num_neighbors)
+        self.neighbors = [[self.index[neighbor] for neighbor in reroute_neighbors[cluster.name]]
+                          for cluster in clusters]
+        self.arrival_failures = np.array([cluster.arrival_failures for cluster in clusters], dtype=int)
+        self.departure_failures = np.array([cluster.departure_failures for cluster in clusters], dtype=int)
+        self.arrival_failures = self.arrival_failures.reshape((num_clusters, 24 * self.tph)).T.copy()
+        self.departure_failures = self.departure_failures.reshape((num_clusters, 24 * self.tph)).T.copy()
+        if any(name not in model.cluster_index for name in self.names):
+            model.init_travel_matrix()
+        rows = np.array([model.cluster_index[name] for name in self.names], dtype=int)
+        self.travel_minutes = model.travel_minutes[np.ix_(rows, rows)].astype(float)
+
+        # Rates and samplers at the resolution of the data, a departure is uniform inside its data tick
+        self.data_ticks = len(clusters[0].rate) if clusters else 24 * self.tph
+        self.data_length = 1440 / self.data_ticks  # Minutes per data tick
+        rate = np.array([[cluster.rate[tick] for tick in range(self.data_ticks)] for cluster in clusters],
+                        dtype=float).reshape((num_clusters, self.data_ticks))
+        self.rate_cdf = np.cumsum(rate.T, axis=1)  # (data ticks, clusters) to pick origins of superposed departures
+        self.dest_index = []
+        self.cdf = []
+        for tick in range(self.data_ticks):
+            dest_index = []
+            cdf = []
+            for i, cluster in enumerate(clusters):
+                keys, cluster_cdf = cluster.get_sampler(cluster.transition[tick] if tick in cluster.transition else {})
+                dest_index.append([self.index.get(end_cluster, -1) for end_cluster in keys])
+                cdf.append(cluster_cdf + i)
+            self.dest_index.append(np.concatenate(dest_index).astype(int) if dest_index else np.array([], dtype=int))
+            self.cdf.append(np.concatenate(cdf) if cdf else np.array([]))
+        self.next_interval = int(self.time // self.data_length)  # Next data tick whose departures are not drawn
+
+        for trip in model.in_transit:
+            if trip.end_cluster in self.index:
+                minutes = max((trip.end_time - trip.curr_time).total_seconds() / 60, 0)
+                self.push(self.time + minutes, self.index.get(trip.start_cluster, -1), self.index[trip.end_cluster])
+
+    def push(self, time: float, origin: int, destination: int):
+        heapq.heappush(self.events, (time, next(self.sequence), origin, destination))
+
+    def uniform(self) -> float:
+        if self.next_uniform >= len(self.uniforms):
+            self.uniforms = self.rng.random(4096)
+            self.next_uniform = 0
+        self.next_uniform += 1
+        return self.uniforms[self.next_uniform - 1]
+
+    def draw_departures(self, interval: int):
+        # Superposes the departures of every cluster during one data tick
+        tick = interval % self.data_ticks
+        total_rate = self.rate_cdf[tick, -1] if self.rate_cdf.size else 0
+        departures = self.rng.poisson(total_rate) if total_rate > 0 else 0
+        if not departures:
+            return
+        origins = np.searchsorted(self.rate_cdf[tick], self.rng.random(departures) * total_rate, side='right')
+        origins = np.minimum(origins, len(self.names) - 1)
+        positions = np.searchsorted(self.cdf[tick], origins + self.rng.random(departures), side='right')
+        destinations = self.dest_index[tick][positions]
+        times = (interval + self.rng.random(departures)) * self.data_length
+        keep = (times >= self.time) & (destinations >= 0)
+        order = np.argsort(times[keep])
+        self.departures += zip(times[keep][order].tolist(), origins[keep][order].tolist(),
+                               destinations[keep][order].tolist())
+
+    def run_until(self, end: float):
+        if self.next_departure > 4096:
+            del self.departures[:self.next_departure]
+            self.next_departure = 0
+        while self.next_interval * self.data_length < end:
+            self.draw_departures(self.next_interval)
+            self.next_interval += 1
+        events = self.events
+        departures = self.departures
+        while True:
+            departure_time = departures[self.next_departure][0] if self.next_departure < len(departures) else inf
+            arrival_time = events[0][0] if events else inf
+            if min(departure_time, arrival_time) > end:
+                break
+            # Arrivals go first at equal times, like sim_trips running before sim_clusters
+            if arrival_time <= departure_time:
+                self.time, _, origin, destination = heapq.heappop(events)
+                self.arrive(destination)
+            else:
+                self.time, origin, destination = departures[self.next_departure]
+                self.next_departure += 1
+                self.depart(origin, destination)
+        self.time = end
+
+    def sim(self):
+        # Advances one tick of the model so the event mode can be driven like ClusterModel.sim
+        self.curr_tick += 1
+        self.curr_time += timedelta(hours=1 / self.tph)
+        if self.curr_tick % (24 * self.tph) == 0:
+            self.curr_tick = 0
+        self.run_until(self.time + 60 / self.tph)
+
+    def run(self, length: timedelta):
+        ticks = int(length / timedelta(hours=1 / self.tph))
+        for _ in range(ticks):
+            self.sim()
+
+    def get_tick(self) -> int:
+        return int((self.time % 1440) * self.tph / 60) % (24 * self.tph)
+
+    def reroute(self, cluster: int, arrival: bool) -> int:
+        # Uniform among the nearest available neighbors, like RerouteIndex.find
+        if arrival:
+            available = [n for n in self.neighbors[cluster] if self.curr_bikes[n] < self.max_docks[n]]
+        else:
+            available = [n for n in self.neighbors[cluster] if self.curr_bikes[n] > 0]
+        available = available[:self.choices]
+        if not available:
+            return -1
+        return available[int(self.uniform() * len(available))]
+
+    def arrive(self, destination: int):
+        if self.curr_bikes[destination] < self.max_docks[destination]:
+            self.curr_bikes[destination] += 1
+            self.total_trips += 1
+            return
+        self.failures += 1
+        self.arrival_failures[self.get_tick(), destination] += 1
+        new_destination = self.reroute(destination, arrival=True)
+        if new_destination < 0:
+            self.critical_failures += 1
+            return
+        self.push(self.time + self.travel_minutes[destination, new_destination], destination, new_destination)
+
+    def depart(self, origin: int, destination: int):
+        if self.curr_bikes[destination] >= self.max_docks[destination]:
+            self.failures += 1
+            self.arrival_failures[self.get_tick(), destination] += 1
+            destination = self.reroute(destination, arrival=True)
+            if destination < 0:
+                self.critical_failures += 1
+                return
+        if self.curr_bikes[origin] <= 0:
+            self.failures += 1
+            self.departure_failures[self.get_tick(), origin] += 1
+            origin = self.reroute(origin, arrival=False)
+            if origin < 0:
+                self.critical_failures += 1
+                return
+        self.curr_bikes[origin] -= 1
+        self.push(self.time + self.travel_minutes[origin, destination], origin, destination)
+
+    def get_in_transit(self) -> list[Trip]:
+        in_transit = []
+        for time, _, origin, destination in sorted(self.events):
+            start_cluster = self.names[origin] if origin >= 0 else self.names[destination]
+            in_transit.append(Trip(start_cluster=start_cluster,
+                                   end_cluster=self.names[destination],
+                                   start_time=self.curr_time,
+                                   trip_time=timedelta(minutes=time - self.time)))
+        return in_transit
+
+    def sync(self):
+        # Writes the state back to the ClusterModel
+        for i, name in enumerate(self.names):
+            cluster = self.model.cluster_dict[name]
+            cluster.curr_bikes = self.curr_bikes[i]
+            cluster.update()
+            cluster.arrival_failures[:] = self.arrival_failures[:, i]
+            cluster.departure_failures[:] = self.departure_failures[:, i]
+        self.model.in_transit = self.get_in_transit()
+        self.model.curr_tick = self.curr_tick
+        self.model.curr_time = self.curr_time
+        self.model.failures = self.failures
+        self.model.total_trips = self.total_trips
+        self.model.critical_failures = self.critical_failures
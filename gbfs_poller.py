@@ -0,0 +1,299 @@
+import asyncio
+import glob
+import gzip
+import http.client
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import numpy as np
+import simplejson
+
+STATUS_URL = 'https://gbfs.lyft.com/gbfs/2.3/bkn/en/station_status.json'
+INFORMATION_URL = 'https://gbfs.lyft.com/gbfs/2.3/bkn/en/station_information.json'
+DIFF_COLUMNS = ('last_updated', 'station', 'num_bikes_available', 'num_bikes_disabled', 'num_docks_available',
+                'num_docks_disabled', 'operating')
+
+logger = logging.getLogger(__name__)
+
+
+class FeedClient:
+    """
+    One GBFS feed over a kept alive HTTP connection, requests run in a thread so the event loop never blocks
+    """
+    def __init__(self, url: str, timeout=10):
+        self.url = url
+        self.timeout = timeout
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.path = parts.path + ('?' + parts.query if parts.query else '')
+        self.connection = None
+        self.requests = 0  # Requests sent, more than connections when they are reused
+        self.connections = 0
+
+    def connect(self):
+        connection = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection(self.host, timeout=self.timeout)
+        self.connections += 1
+
+    def fetch(self) -> dict:
+        # The server may close an idle connection, so a failed request is sent again once on a new one
+        for attempt in range(2):
+            if self.connection is None:
+                self.connect()
+            try:
+                self.connection.request('GET', self.path, headers={'Accept-Encoding': 'gzip'})
+                self.requests += 1
+                response = self.connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError, OSError):
+                self.close()
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise ConnectionError(f'{self.url} returned {response.status}')
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return simplejson.loads(body)
+
+    async def get(self) -> dict:
+        return await asyncio.to_thread(self.fetch)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+
+
+class GBFSPoller:
+    """
+    Polls station_status no faster than its ttl and appends only the stations whose counts changed since the
+    previous poll to path/diffs.bin, as int64 rows of DIFF_COLUMNS. The station of a row is its line in
+    path/stations.txt, and the first poll writes every station. load_snapshots rebuilds the full states.
+    """
+    def __init__(self, path: str, status_url=STATUS_URL, information_url=INFORMATION_URL, min_interval=30):
+        """
+        :param path: directory of the archive, appended to when it exists
+        :param status_url: station_status feed
+        :param information_url: station_information feed saved to path once on start, None to skip it
+        :param min_interval: shortest time between polls in seconds, whatever the ttl of the feed
+        """
+        self.path = path
+        self.status = FeedClient(status_url)
+        self.information = None if information_url is None else FeedClient(information_url)
+        self.min_interval = min_interval
+        self.station_index = {}  # {station_id : line in stations.txt}
+        self.last = np.zeros((0, len(DIFF_COLUMNS) - 2), dtype=np.int64)  # Counts of each station at the last poll
+        self.last_updated = None
+        self.polls = 0
+        self.records = 0  # Diff rows written
+        os.makedirs(path, exist_ok=True)
+        file = os.path.join(path, 'diffs.bin')
+        row_bytes = len(DIFF_COLUMNS) * np.dtype(np.int64).itemsize
+        if os.path.isfile(file) and os.path.getsize(file) % row_bytes:
+            # A row cut short by a crash is dropped before appending, every row written after it would be shifted
+            os.truncate(file, os.path.getsize(file) // row_bytes * row_bytes)
+        stations, diffs = load_diffs(path)
+        self.station_index = {station_id: i for i, station_id in enumerate(stations)}
+        if len(diffs):
+            # Carry on from the state the archive ends in
+            self.last = np.full((len(stations), self.last.shape[1]), -1, dtype=np.int64)
+            self.last[diffs[:, 1]] = diffs[:, 2:]
+            self.last_updated = int(diffs[-1, 0])
+
+    async def poll(self) -> float:
+        # Fetches the feed once, returns its ttl
+        if self.information is not None and self.polls == 0:
+            information = await self.information.get()
+            with open(os.path.join(self.path, 'station_information.json'), 'w') as f:
+                simplejson.dump(information, f)
+        feed = await self.status.get()
+        self.polls += 1
+        ttl = float(feed.get('ttl', self.min_interval))
+        last_updated = int(feed.get('last_updated', time.time()))
+        if self.last_updated is not None and last_updated <= self.last_updated:
+            # Unchanged, or an older copy from a cache
+            return ttl
+        self.write_diffs(last_updated, feed['data']['stations'])
+        self.last_updated = last_updated
+        return ttl
+
+    def write_diffs(self, last_updated: int, stations: list[dict]):
+        new = [station['station_id'] for station in stations if station['station_id'] not in self.station_index]
+        if new:
+            with open(os.path.join(self.path, 'stations.txt'), 'a') as f:
+                for station_id in new:
+                    self.station_index[station_id] = len(self.station_index)
+                    f.write(f'{station_id}\n')
+            last = np.full((len(self.station_index), self.last.shape[1]), -1, dtype=np.int64)
+            last[:len(self.last)] = self.last
+            self.last = last
+        rows = np.array([self.station_index[station['station_id']] for station in stations], dtype=np.int64)
+        counts = np.array([[station.get(column, 0) for column in DIFF_COLUMNS[2:-1]] +
+                           [bool(station.get('is_renting') and station.get('is_returning') and
+                                 station.get('is_installed'))] for station in stations], dtype=np.int64)
+        counts = counts.reshape((len(rows), self.last.shape[1]))
+        changed = np.any(counts != self.last[rows], axis=1)
+        records = np.column_stack([np.full(changed.sum(), last_updated, dtype=np.int64), rows[changed],
+                                   counts[changed]])
+        self.last[rows] = counts
+        with open(os.path.join(self.path, 'diffs.bin'), 'ab') as f:
+            f.write(records.astype(np.int64).tobytes())
+        self.records += len(records)
+
+    async def run(self, polls=None):
+        """
+        Polls until cancelled, or polls times
+        """
+        try:
+            while polls is None or self.polls < polls:
+                started = time.monotonic()
+                try:
+                    ttl = await self.poll()
+                except (ConnectionError, OSError, ValueError, KeyError, TypeError) as e:
+                    # A failed or malformed poll is skipped, the next one is tried after min_interval
+                    logger.warning('Poll of %s failed: %r', self.status.url, e)
+                    ttl = self.min_interval
+                if polls is not None and self.polls >= polls:
+                    break
+                await asyncio.sleep(max(self.min_interval, ttl) - (time.monotonic() - started))
+        finally:
+            self.close()
+
+    def close(self):
+        self.status.close()
+        if self.information is not None:
+            self.information.close()
+
+
+def load_diffs(path: str) -> tuple[list[str], np.ndarray]:
+    # Station ids and (records, DIFF_COLUMNS) diff rows of an archive written by GBFSPoller
+    stations = []
+    if os.path.isfile(os.path.join(path, 'stations.txt')):
+        with open(os.path.join(path, 'stations.txt'), 'r') as f:
+            stations = f.read().split()
+    diffs = np.zeros((0, len(DIFF_COLUMNS)), dtype=np.int64)
+    if os.path.isfile(os.path.join(path, 'diffs.bin')):
+        diffs = np.fromfile(os.path.join(path, 'diffs.bin'), dtype=np.int64)
+        # A row cut short by a crash while writing is dropped
+        diffs = diffs[:len(diffs) // len(DIFF_COLUMNS) * len(DIFF_COLUMNS)].reshape((-1, len(DIFF_COLUMNS)))
+    return stations, diffs
+
+
+def load_snapshots(path: str) -> tuple[list[str], np.ndarray, dict[str: np.ndarray]]:
+    """
+    Full states of an archive written by GBFSPoller, each station keeps its counts until they change
+    :return: station ids, last_updated of each poll that changed something, and {column : (polls, stations)
+    counts}, -1 before a station first appears
+    """
+    stations, diffs = load_diffs(path)
+    times, polls = np.unique(diffs[:, 0], return_inverse=True)
+    # Last poll at or before each poll where each station changed, carried forward by a running maximum
+    changed = np.full((len(times), len(stations)), -1, dtype=np.int64)
+    changed[polls, diffs[:, 1]] = np.arange(len(diffs))
+    changed = np.maximum.accumulate(changed, axis=0)
+    snapshots = {}
+    for i, column in enumerate(DIFF_COLUMNS[2:]):
+        values = np.append(diffs[:, i + 2], -1)
+        snapshots[column] = values[changed]
+    return stations, times, snapshots
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keeps connections alive like the live feed
+
+    def do_GET(self):
+        server = self.server
+        if self.path.endswith('station_information.json') and server.information is not None:
+            body = server.information
+        elif self.path.endswith('station_status.json') and server.files:
+            body = server.next_status()
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Local stand in for the GBFS feeds serving archived station_status files in order of last_updated at
+    /station_status.json, and station_information at /station_information.json. With speed, the files play back
+    against a clock running speed times faster than real time and ttl is shortened to match; without it, every
+    request gets the next file.
+    """
+    daemon_threads = True
+
+    def __init__(self, directory: str, pattern='*.json', information=None, speed=None, port=0):
+        """
+        :param directory: directory of the archived station_status files
+        :param pattern: glob of the files in directory
+        :param information: path of a station_information.json to serve
+        :param speed: playback speed against the last_updated of the files, None to step on each request
+        :param port: port on localhost, 0 picks a free one
+        """
+        super().__init__(('127.0.0.1', port), ReplayHandler)
+        self.files = sorted(file for file in glob.glob(os.path.join(directory, pattern)) if os.path.isfile(file))
+        self.information = None
+        if information is not None:
+            with open(information, 'rb') as f:
+                self.information = f.read()
+        # Served in order of last_updated, whatever the file names
+        times = np.array([self.load(file).get('last_updated', 0) for file in self.files], dtype=np.int64)
+        order = np.argsort(times, kind='stable')
+        self.files = [self.files[i] for i in order]
+        self.times = times[order]
+        self.speed = speed
+        self.served = 0
+        self.lock = threading.Lock()
+        self.started = None
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    @staticmethod
+    def load(file: str) -> dict:
+        with open(file, 'r') as f:
+            return simplejson.load(f)
+
+    def next_status(self) -> bytes:
+        with self.lock:
+            if self.speed is None:
+                i = min(self.served, len(self.files) - 1)
+            else:
+                now = self.times[0] + (time.monotonic() - self.started) * self.speed
+                i = max(int(np.searchsorted(self.times, now, side='right')) - 1, 0)
+            self.served += 1
+        feed = self.load(self.files[i])
+        if self.speed is not None:
+            feed['ttl'] = feed.get('ttl', 60) / self.speed
+        return simplejson.dumps(feed).encode()
+
+    def start(self) -> 'ReplayServer':
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -4,7 +4,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import networkx as nx
 
-def create_model(T, K, L, stations, start_levels, optimal_levels, positions, neighbors):
+def create_model(T, K, L, stations, start_levels, optimal_levels, positions, neighbors, optimize=True):
     '''
     creates AND optimizes the model for integer programming. solves for the truck routes that get the stations closest to optimal levels
     
@@ -17,6 +17,7 @@ def create_model(T, K, L, stations, start_levels, optimal_levels, positions, nei
     optimal_levels: dict, stations --> int, optimal number of bikes after overnight rebalancing
     positions: dict, stations --> tuple (lon, lat) of the coordinates of each stations/cluster
     neighbors: dict, stations --> list of stations, maps each station/cluster to a list of stations/clusters that can be moved to in 1 time step
+    optimize: bool, set to False to only build the model
     '''
     over_stations, under_stations, balanced_stations = [], [], []
     # Fill over and under stations
@@ -115,11 +116,40 @@ def create_model(T, K, L, stations, start_levels, optimal_levels, positions, nei
     model.addConstr(gp.quicksum(b[T, k] for k in range(1, K+1)) == 0)
     model.addConstr(gp.quicksum(b[1, k] for k in range(1, K+1)) == 0)
 
-    model.optimize()
+    if optimize:
+        model.optimize()
     model.update()
     
     return model, x, y, b
 
+def get_neighbors(stations, cluster_index, travel_minutes, step_minutes):
+    '''
+    builds the neighbors argument of create_model from a precomputed travel time matrix
+
+    stations: list of cluster names
+    cluster_index: dict, cluster name --> row/column of travel_minutes (ClusterModel.cluster_index)
+    travel_minutes: 2d array of travel times between clusters in minutes (ClusterModel.travel_minutes)
+    step_minutes: length of one time step in minutes, clusters reachable within it are neighbors
+    '''
+    rows = np.array([cluster_index[s] for s in stations], dtype=int)
+    reachable = travel_minutes[np.ix_(rows, rows)] <= step_minutes
+    np.fill_diagonal(reachable, False)
+    return {s: [stations[j] for j in np.nonzero(reachable[i])[0]] for i, s in enumerate(stations)}
+
+def get_grid_neighbors(stations, adjacency, hops=1):
+    '''
+    builds the neighbors argument of create_model from the grid adjacency of the clusters
+
+    stations: list of cluster names
+    adjacency: ClusterAdjacency of the clusters (ClusterModel.get_adjacency())
+    hops: clusters at most this many squares apart are neighbors
+    '''
+    rows = np.array([adjacency.index[s] for s in stations], dtype=int)
+    reachable = adjacency.get_neighborhood(hops)[rows][:, rows].tocsr()
+    reachable.sort_indices()
+    return {s: [stations[j] for j in reachable.indices[reachable.indptr[i]:reachable.indptr[i + 1]]]
+            for i, s in enumerate(stations)}
+
 def graph_model(x, b, K, T, stations, positions, node_size = 20, title = "Overnight Rebalancing"):
     '''
     graphs the solution that was computed in using the function create_model
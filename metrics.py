@@ -0,0 +1,119 @@
+import zipfile
+
+import numpy as np
+
+FIELDS = ('bikes', 'departures', 'arrivals', 'failed_departures', 'failed_arrivals', 'reroutes')
+
+
+class MetricsRecorder:
+    """
+    Per tick, per cluster counts of a run. The simulation adds to the current row of each field
+    (recorder.departures[column] += 1) and calls end_tick once per tick. Rows live in buffers of chunk_ticks ticks
+    allocated up front; full buffers are appended to a compressed .npz at path, or kept in memory without a path.
+    """
+    def __init__(self, names: list, path=None, chunk_ticks=96, replicas=1):
+        """
+        :param names: cluster name of each column, in the order the simulation indexes clusters
+        :param path: .npz file the chunks are written to, it is overwritten
+        :param chunk_ticks: number of ticks buffered before a flush
+        :param replicas: number of replicas of the columns, an ArrayModel with replicas has replicas * clusters
+        columns
+        """
+        self.names = np.asarray(names)
+        self.replicas = replicas
+        self.width = len(self.names) * replicas
+        self.path = path
+        self.chunk_ticks = chunk_ticks
+        self.chunk = 0  # Number of chunks flushed
+        self.row = 0  # Row of the current tick in the buffers
+        self.buffers = {field: np.zeros((chunk_ticks, self.width), dtype=np.int32) for field in FIELDS}
+        self.steps = np.zeros(chunk_ticks, dtype=np.int64)  # Step of the simulation recorded in each row
+        self.ticks = np.zeros(chunk_ticks, dtype=np.int32)  # Tick of the day of each row
+        self.chunks = []  # Flushed chunks when there is no path
+        self.set_row()
+        if path is not None:
+            with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as f:
+                self.write_array(f, 'names', self.names)
+                self.write_array(f, 'replicas', np.array(replicas))
+
+    def set_row(self):
+        # Current row views the simulation writes to
+        self.bikes = self.buffers['bikes'][self.row]
+        self.departures = self.buffers['departures'][self.row]
+        self.arrivals = self.buffers['arrivals'][self.row]
+        self.failed_departures = self.buffers['failed_departures'][self.row]
+        self.failed_arrivals = self.buffers['failed_arrivals'][self.row]
+        self.reroutes = self.buffers['reroutes'][self.row]
+
+    def end_tick(self, step: int, tick: int, bikes):
+        self.bikes[:] = bikes
+        self.steps[self.row] = step
+        self.ticks[self.row] = tick
+        self.row += 1
+        if self.row == self.chunk_ticks:
+            self.flush()
+        self.set_row()
+
+    def flush(self):
+        if not self.row:
+            return
+        chunk = {field: self.buffers[field][:self.row].copy() for field in FIELDS}
+        chunk['steps'] = self.steps[:self.row].copy()
+        chunk['ticks'] = self.ticks[:self.row].copy()
+        if self.path is None:
+            self.chunks.append(chunk)
+        else:
+            with zipfile.ZipFile(self.path, 'a', compression=zipfile.ZIP_DEFLATED) as f:
+                for key, array in chunk.items():
+                    self.write_array(f, f'{key}_{self.chunk:06d}', array)
+        self.chunk += 1
+        for buffer in self.buffers.values():
+            buffer[:] = 0
+        self.row = 0
+
+    def close(self):
+        self.flush()
+        self.set_row()
+
+    def to_arrays(self) -> dict:
+        # Everything recorded so far, flushing the partial chunk
+        self.close()
+        if self.path is not None:
+            return load_metrics(self.path)
+        return concatenate(self.chunks, self.names, self.replicas, self.width)
+
+    @staticmethod
+    def write_array(f: zipfile.ZipFile, key: str, array: np.ndarray):
+        with f.open(key + '.npy', 'w', force_zip64=True) as out:
+            np.lib.format.write_array(out, np.asanyarray(array), allow_pickle=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def concatenate(chunks: list[dict], names: np.ndarray, replicas: int, width: int) -> dict:
+    arrays = {'names': names, 'replicas': replicas}
+    for key in FIELDS + ('steps', 'ticks'):
+        if chunks:
+            arrays[key] = np.concatenate([chunk[key] for chunk in chunks])
+        elif key in FIELDS:
+            arrays[key] = np.zeros((0, width), dtype=np.int32)
+        else:
+            arrays[key] = np.zeros(0, dtype=np.int64)
+    return arrays
+
+
+def load_metrics(path: str) -> dict:
+    """
+    :param path: .npz written by a MetricsRecorder
+    :return: {field: (ticks, columns) array} plus names, replicas, steps and ticks
+    """
+    with np.load(path) as f:
+        names = f['names']
+        replicas = int(f['replicas'])
+        num_chunks = len([key for key in f.files if key.startswith('steps_')])
+        chunks = [{key: f[f'{key}_{i:06d}'] for key in FIELDS + ('steps', 'ticks')} for i in range(num_chunks)]
+    return concatenate(chunks, names, replicas, len(names) * replicas)
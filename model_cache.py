@@ -0,0 +1,119 @@
+import hashlib
+import os
+import pickle
+import shutil
+import time
+
+import numpy as np
+import simplejson
+
+CACHE_VERSION = 3  # Bump whenever the arrays built by ClusterModel.get_cluster_arrays change
+
+
+class ModelCache:
+    """
+    Content addressed store of the arrays ClusterModel builds its clusters from. Each entry is a directory named
+    by the hash of the inputs holding one .npy per array, loaded memory mapped, and a manifest.json. Entries
+    written by another CACHE_VERSION or with missing or truncated files are stale and removed on load. The
+    least recently used entries are evicted once the cache is larger than max_bytes.
+    Loading an entry takes milliseconds, but a ClusterModel built from one still creates a StationCluster with per
+    tick samplers for every cluster, about half a second for NYC at tph=4.
+    """
+    def __init__(self, path='model_cache', max_bytes=2 * 1024 ** 3):
+        """
+        :param path: directory of the cache, created when missing
+        :param max_bytes: size limit of the cache on disk
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def get_key(station_data: dict, square_length: float) -> str:
+        # Pickle is deterministic for the same dicts built in the same order, different orders only miss the cache.
+        # The arrays do not depend on tph, travel ticks are derived from them
+        data = pickle.dumps((CACHE_VERSION, station_data, float(square_length)), protocol=4)
+        return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+    def get_entry(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def load(self, key: str):
+        """
+        :return: {name: read only memory mapped array} of the entry, None when it is missing or stale
+        """
+        entry = self.get_entry(key)
+        try:
+            with open(os.path.join(entry, 'manifest.json'), 'r') as f:
+                manifest = simplejson.load(f)
+        except (FileNotFoundError, simplejson.JSONDecodeError):
+            if os.path.isdir(entry):
+                self.remove(key)
+            return None
+        if manifest.get('version') != CACHE_VERSION or manifest.get('key') != key:
+            self.remove(key)
+            return None
+        arrays = {}
+        try:
+            for name, size in manifest['files'].items():
+                file = os.path.join(entry, name + '.npy')
+                if os.path.getsize(file) != size:
+                    raise ValueError(f'{file} has the wrong size')
+                # Plain ndarray views of the mapping, slicing np.memmap objects is slow
+                arrays[name] = np.load(file, mmap_mode='r').view(np.ndarray)
+        except (OSError, ValueError):
+            self.remove(key)
+            return None
+        os.utime(os.path.join(entry, 'manifest.json'))  # Last use, for eviction
+        return arrays
+
+    def save(self, key: str, arrays: dict[str: np.ndarray]):
+        # Written to a temporary directory and renamed, so readers never see a partial entry
+        entry = self.get_entry(key)
+        if os.path.isdir(entry):
+            return
+        temp = f'{entry}.{os.getpid()}.tmp'
+        os.makedirs(temp, exist_ok=True)
+        files = {}
+        for name, array in arrays.items():
+            file = os.path.join(temp, name + '.npy')
+            np.save(file, np.ascontiguousarray(array), allow_pickle=False)
+            files[name] = os.path.getsize(file)
+        with open(os.path.join(temp, 'manifest.json'), 'w') as f:
+            simplejson.dump({'version': CACHE_VERSION, 'key': key, 'created': time.time(), 'files': files}, f)
+        try:
+            os.rename(temp, entry)
+        except OSError:
+            # Another process saved the same entry first
+            shutil.rmtree(temp, ignore_errors=True)
+        self.evict()
+
+    def remove(self, key: str):
+        shutil.rmtree(self.get_entry(key), ignore_errors=True)
+
+    def entries(self) -> list[tuple[float, int, str]]:
+        # (last use, bytes, key) of every complete entry, oldest first
+        entries = []
+        for key in os.listdir(self.path):
+            manifest = os.path.join(self.path, key, 'manifest.json')
+            if key.endswith('.tmp') or not os.path.isfile(manifest):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(os.path.join(self.path, key)))
+            entries.append((os.path.getmtime(manifest), size, key))
+        return sorted(entries)
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.remove(key)
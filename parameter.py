@@ -1,12 +1,15 @@
+import glob
 import os.path
 import time
 import urllib.request, simplejson
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
 import query
 import pickle
 from old_model.station import Station
+from station_registry import StationRegistry
 
 
 def cut(df: pd.DataFrame, start_time: datetime, stop_time: datetime, length: timedelta) \
@@ -34,16 +37,59 @@ def get_weekdays_and_weekends(start_date: datetime, end_date: datetime) -> list[
     return [weekdays, weekends]
 
 
+def bin_trips(data: pd.DataFrame, days: list[list[datetime]], tph: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Group of days and tick of every trip in one pass, with the trips cut counts: a trip is in the tick it starts in
+    when it also ends by the end of that tick
+    :param days: groups of days, like get_weekdays_and_weekends, each day starting at the same time of day
+    :return: (trips,) group, -1 for trips not counted, and (trips,) tick of the day
+    """
+    day = 86400 * 10 ** 9
+    length = 3600 * 10 ** 9 // tph
+    flat = [(d, g) for g, group in enumerate(days) for d in group]
+    if not flat or not len(data):
+        return np.full(len(data), -1, dtype=np.int64), np.zeros(len(data), dtype=np.int64)
+    # Nanoseconds since the first day
+    origin = np.datetime64(min(d for d, g in flat), 'ns').astype(np.int64)
+    start = data['started_at'].to_numpy(dtype='datetime64[ns]').astype(np.int64) - origin
+    end = data['ended_at'].to_numpy(dtype='datetime64[ns]').astype(np.int64) - origin
+    # Group of each day since origin, -1 for days in no group
+    day_groups = np.full(int((np.datetime64(max(d for d, g in flat), 'ns').astype(np.int64) - origin) // day) + 1, -1)
+    for d, g in flat:
+        day_groups[int((np.datetime64(d, 'ns').astype(np.int64) - origin) // day)] = g
+    trip_day = start // day
+    tick = start % day // length
+    valid = (start >= 0) & (trip_day < len(day_groups)) & (tick < 24 * tph)
+    valid &= data['started_at'].notna().to_numpy() & data['ended_at'].notna().to_numpy()
+    trip_day = np.where(valid, trip_day, 0)
+    groups = np.where(valid, day_groups[trip_day], -1)
+    groups[end > trip_day * day + (tick + 1) * length] = -1
+    return groups, tick
+
+
 def get_rate(data: pd.DataFrame, days: list[datetime], tph: int) -> np.array:
-    length = timedelta(hours=1 / tph)
-    num_rates = int(timedelta(days=1).total_seconds() / length.total_seconds())
-    total_arrivals = np.array([0 for tick in range(num_rates)])
+    # Mean trips of each tick over days
+    groups, ticks = bin_trips(data, [days], tph)
+    return np.bincount(ticks[groups == 0], minlength=24 * tph)[:24 * tph] / len(days)
 
-    for day in days:
-        intervals = cut(data, day, day + timedelta(days=1), length)
-        total_arrivals += np.array([len(df) for df in intervals])
-    total_arrivals = total_arrivals / len(days)
-    return total_arrivals
+
+def get_rates(data: pd.DataFrame, days: list[list[datetime]], tph: int, column='start_station_name') -> \
+        tuple[pd.Index, np.ndarray]:
+    """
+    get_rate of every station in data at once, for every group of days from the same pass over the trips
+    :param days: groups of days, like get_weekdays_and_weekends for weekday and weekend rates
+    :param column: column of the station a trip counts for
+    :return: the stations and their (groups, stations, 24 * tph) mean trips of each tick
+    """
+    num_ticks = 24 * tph
+    groups, ticks = bin_trips(data, days, tph)
+    codes, stations = pd.factorize(data[column])
+    counted = (groups >= 0) & (codes >= 0)
+    index = (groups[counted] * len(stations) + codes[counted]) * num_ticks + ticks[counted]
+    rates = np.bincount(index, minlength=len(days) * len(stations) * num_ticks).astype(float)
+    rates = rates.reshape((len(days), len(stations), num_ticks))
+    rates /= np.maximum([len(group) for group in days], 1)[:, None, None]
+    return pd.Index(stations), rates
 
 
 def get_transition(data: pd.DataFrame, days: list[datetime], tph: int, truncate=False, whitelist=None) -> \
@@ -165,30 +211,97 @@ def get_pickle_station(station: str, path: str) -> Station:
                    lat=station_data['lat'],
                    lon=station_data['lon'])
 
-def get_state_df(station_information: list[dict[str: str]], path: str):
+STATUS_COLUMNS = ('num_bikes_available', 'num_bikes_disabled', 'num_docks_available', 'num_docks_disabled')
+INFO_COLUMNS = ('name', 'capacity', 'station_id', 'lat', 'lon')
+
+
+def get_info_df(station_information, columns=INFO_COLUMNS) -> pd.DataFrame:
+    # GBFS station information (list of stations, the parsed feed or a StationRegistry) as a DataFrame
+    if isinstance(station_information, StationRegistry):
+        return pd.DataFrame({column: station_information.columns[column] for column in columns})
+    if isinstance(station_information, dict):
+        station_information = station_information['data']['stations']
+    df = pd.DataFrame.from_records(station_information, columns=list(columns))
+    df['station_id'] = df['station_id'].astype(str)
+    return df
+
+
+def match_status(info_ids: pd.Index, station_status) -> tuple[np.ndarray, dict[str: np.ndarray]]:
+    """
+    Joins a GBFS station_status feed to station information by station_id. Every row of the station information
+    gets the first status of its station_id, so rows with a duplicate station_id all get the same status
+    :param info_ids: Index of the station_ids of the station information
+    :param station_status: parsed station_status feed or its list of stations
+    :return: rows of the station information with a status in order, and the status columns of those rows
+    """
+    if isinstance(station_status, dict):
+        station_status = station_status['data']['stations']
+    status_ids = pd.Index([str(station['station_id']) for station in station_status])
+    first = np.flatnonzero(~status_ids.duplicated())
+    positions = status_ids[first].get_indexer(info_ids)
+    rows = np.flatnonzero(positions >= 0)
+    stations = [station_status[i] for i in first[positions[rows]]]
+    columns = {column: np.array([station.get(column, 0) for station in stations], dtype=int)
+               for column in STATUS_COLUMNS}
+    columns['operating'] = np.array([bool(station['is_renting'] and station['is_returning'] and
+                                          station['is_installed']) for station in stations], dtype=bool)
+    return rows, columns
+
+
+def join_status(info: pd.DataFrame, station_status) -> pd.DataFrame:
+    # One row per station of info with a status, in the order of info
+    rows, columns = match_status(pd.Index(info['station_id']), station_status)
+    df = info.iloc[rows].reset_index(drop=True)
+    for column, values in columns.items():
+        df[column] = values
+    return df
+
+
+def get_state_df(station_information, path: str):
     with open(path, 'r') as f:
         station_status = simplejson.load(f)
+    return join_status(get_info_df(station_information), station_status)
 
-    flat_data = []
-    for station in station_information:
-        for station_stat in station_status['data']['stations']:
-            if station['station_id'] == station_stat['station_id']:
-                flat_station = {
-                    'name': station['name'],
-                    'capacity': station['capacity'],
-                    'station_id': station['station_id'],
-                    'lat': station['lat'],
-                    'lon': station['lon'],
-                    'num_bikes_available': station_stat['num_bikes_available'],
-                    'num_bikes_disabled': station_stat['num_bikes_disabled'],
-                    'num_docks_available': station_stat['num_docks_available'],
-                    'num_docks_disabled': station_stat['num_docks_disabled'],
-                    'operating': station_stat['is_renting'] and station_stat['is_returning'] and station_stat[
-                        'is_installed'],
-                }
-                flat_data.append(flat_station)
-                break
-    df = pd.DataFrame(flat_data)
+
+def read_snapshot(file: str, info_ids: pd.Index) -> tuple[np.ndarray, dict[str: np.ndarray], float]:
+    # match_status of one saved station_status feed and its last_updated
+    with open(file, 'r') as f:
+        station_status = simplejson.load(f)
+    rows, columns = match_status(info_ids, station_status)
+    return rows, columns, station_status.get('last_updated', np.nan)
+
+
+def get_snapshots_df(station_information, directory: str, pattern='*', processes=1) -> pd.DataFrame:
+    """
+    Every station_status snapshot saved in directory as one table, built in a single pass at the end
+    :param station_information: see get_info_df
+    :param directory: directory of GBFS station_status files
+    :param pattern: glob of the snapshot files in directory
+    :param processes: number of processes parsing the files
+    :return: the columns of get_state_df, the snapshot file and the time of the snapshot (last_updated)
+    """
+    info = get_info_df(station_information)
+    info_ids = pd.Index(info['station_id'])
+    files = sorted(file for file in glob.glob(os.path.join(directory, pattern)) if os.path.isfile(file))
+    if not files:
+        df = join_status(info, [])
+        df['snapshot'] = np.array([], dtype=str)
+        df['time'] = pd.to_datetime(np.array([], dtype=float), unit='s')
+        return df
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            snapshots = list(executor.map(read_snapshot, files, [info_ids] * len(files),
+                                          chunksize=max(1, len(files) // (4 * processes))))
+    else:
+        snapshots = [read_snapshot(file, info_ids) for file in files]
+    rows = [snapshot_rows for snapshot_rows, _, _ in snapshots]
+    counts = [len(snapshot_rows) for snapshot_rows in rows]
+    df = info.iloc[np.concatenate(rows)].reset_index(drop=True)
+    for column in (*STATUS_COLUMNS, 'operating'):
+        df[column] = np.concatenate([columns[column] for _, columns, _ in snapshots])
+    df['snapshot'] = np.repeat(np.array([os.path.basename(file) for file in files]), counts)
+    updated = np.array([last_updated for _, _, last_updated in snapshots], dtype=float)
+    df['time'] = pd.to_datetime(np.repeat(updated, counts), unit='s')
     return df
 
 
@@ -198,33 +311,10 @@ def get_station_information(save=False):
     station_status = simplejson.load(
         urllib.request.urlopen('https://gbfs.lyft.com/gbfs/2.3/bkn/en/station_status.json'))
 
-    stations = station_information['data']['stations']
-    flat_data = []
-
-    for station in stations:
-        for station_stat in station_status['data']['stations']:
-            if station['station_id'] == station_stat['station_id']:
-                region_id = None
-                if 'region_id' in station:
-                    region_id = station['region_id']
-                flat_station = {
-                    'name': station['name'],
-                    'capacity': station['capacity'],
-                    'station_id': station['station_id'],
-                    'short_name': station['short_name'],
-                    'region_id': region_id,
-                    'lat': station['lat'],
-                    'lon': station['lon'],
-                    'num_bikes_available': station_stat['num_bikes_available'],
-                    'num_bikes_disabled': station_stat['num_bikes_disabled'],
-                    'num_docks_available': station_stat['num_docks_available'],
-                    'num_docks_disabled': station_stat['num_docks_disabled'],
-                    'operating': station_stat['is_renting'] and station_stat['is_returning'] and station_stat[
-                        'is_installed'],
-                }
-                flat_data.append(flat_station)
-                break
-    df = pd.DataFrame(flat_data)
+    info = get_info_df(station_information, columns=('name', 'capacity', 'station_id', 'short_name', 'region_id',
+                                                      'lat', 'lon'))
+    info['region_id'] = info['region_id'].astype(object).where(info['region_id'].notna(), None)
+    df = join_status(info, station_status)
     if save:
         now = datetime.now()
         path = f'data/station_data/status_at_time/{now.year}_{now.month}_{now.day}_{now.hour}:{now.minute}.csv'
@@ -0,0 +1,97 @@
+from time import perf_counter
+
+# get_dist and get_new_cluster run once or more per trip, their timers add about a perf_counter pair to each call
+PHASES = ('sim', 'sim_trips', 'sim_clusters', 'sim_departures', 'get_dist', 'get_new_cluster')
+
+
+class PhaseProfiler:
+    """
+    Wall time and call counts of the phases of ClusterModel.sim. Enabling it replaces the phase methods of one
+    model by timed wrappers on the instance, disabling it removes them, so a model that is not profiled runs the
+    plain methods. Times are inclusive; self time excludes the time spent in profiled phases called inside. Trips
+    are built inline, so Trip construction and the overhead of the get_dist and get_new_cluster timers are in the
+    self time of sim_trips and sim_departures. The wrappers are not pickled or copied, see
+    ClusterModel.__getstate__.
+    """
+    def __init__(self):
+        self.calls = {phase: 0 for phase in PHASES}
+        self.seconds = {phase: 0.0 for phase in PHASES}
+        self.self_seconds = {phase: 0.0 for phase in PHASES}
+        self.counters = {'departures_drawn': 0, 'reroute_attempts': 0, 'reroutes_failed': 0}
+        self.start_counts = {}  # Model counters when profiling started
+        self.end_counts = {}
+        self.children = []  # Stack of the time spent in profiled phases called by each running phase
+        self.model = None
+
+    def enable(self, model):
+        self.model = model
+        self.start_counts = self.get_counts(model)
+        for phase in PHASES:
+            setattr(model, phase, self.wrap(phase, getattr(model, phase)))
+
+    def disable(self):
+        for phase in PHASES:
+            self.model.__dict__.pop(phase, None)
+        self.end_counts = self.get_counts(self.model)
+        self.model = None
+
+    @staticmethod
+    def get_counts(model) -> dict:
+        return {'ticks': model.step, 'failures': model.failures, 'total_trips': model.total_trips,
+                'critical_failures': model.critical_failures}
+
+    def wrap(self, phase: str, method):
+        calls = self.calls
+        seconds = self.seconds
+        self_seconds = self.self_seconds
+        children = self.children
+        counters = self.counters
+
+        def timed(*args, **kwargs):
+            children.append(0.0)
+            start = perf_counter()
+            result = method(*args, **kwargs)
+            elapsed = perf_counter() - start
+            child = children.pop()
+            if children:
+                children[-1] += elapsed
+            calls[phase] += 1
+            seconds[phase] += elapsed
+            self_seconds[phase] += elapsed - child
+            if phase == 'sim_departures':
+                counters['departures_drawn'] += len(args[1]) if args[1] is not None else 0
+            elif phase == 'get_new_cluster':
+                counters['reroute_attempts'] += 1
+                counters['reroutes_failed'] += result < 0
+            return result
+        return timed
+
+    def report(self) -> dict:
+        """
+        :return: {'phases': {phase: {calls, seconds, self_seconds, mean_us, share}}, 'counters': {...}} where share
+        is the part of the sim time spent in the phase itself
+        """
+        end_counts = self.get_counts(self.model) if self.model is not None else self.end_counts
+        total = self.seconds['sim'] or sum(self.self_seconds.values())
+        phases = {}
+        for phase in PHASES:
+            phases[phase] = {'calls': self.calls[phase],
+                             'seconds': self.seconds[phase],
+                             'self_seconds': self.self_seconds[phase],
+                             'mean_us': 1e6 * self.seconds[phase] / self.calls[phase] if self.calls[phase] else 0.0,
+                             'share': self.self_seconds[phase] / total if total else 0.0}
+        counters = dict(self.counters)
+        for key in end_counts:
+            counters[key] = end_counts[key] - self.start_counts.get(key, 0)
+        return {'phases': phases, 'counters': counters, 'seconds': total}
+
+    def print_report(self):
+        report = self.report()
+        print(f"{'phase':<20}{'calls':>10}{'seconds':>10}{'self':>10}{'mean us':>10}{'share':>8}")
+        for phase in PHASES:
+            stats = report['phases'][phase]
+            print(f"{phase:<20}{stats['calls']:>10}{stats['seconds']:>10.3f}{stats['self_seconds']:>10.3f}"
+                  f"{stats['mean_us']:>10.2f}{stats['share']:>8.1%}")
+        for counter, value in report['counters'].items():
+            print(f'{counter}: {value}')
+
@@ -0,0 +1,72 @@
+class RerouteIndex:
+    """
+    Availability of the nearest neighbors of every cluster, kept as one bitmask per cluster and direction where
+    bit k is set when the k-th nearest neighbor can take a bike (not full) or give one (not empty). Clusters
+    report changes of their full/empty flags, which flip the matching bit of every cluster that has them as a
+    neighbor, so a reroute query only reads a mask.
+    """
+    def __init__(self, cluster_dict: dict, radius=4, choices=4, neighbors=None):
+        """
+        :param cluster_dict: {cluster_name (int) : StationCluster}
+        :param radius: number of nearest neighbors a reroute may go to
+        :param choices: a reroute picks uniformly among this many nearest available neighbors
+        :param neighbors: {cluster_name (int) : list of cluster names nearest first} replacing the nearest neighbors
+        of each cluster, e.g. ClusterModel.get_reroute_neighbors
+        """
+        self.radius = radius
+        self.choices = choices
+        self.neighbors = {}  # {cluster_name (int) : list of the nearest other cluster names}
+        self.reverse = {}  # {cluster_name (int) : list of (cluster_name, bit) that have it as a neighbor}
+        self.not_full = {}  # {cluster_name (int) : bitmask of neighbors with an open dock}
+        self.not_empty = {}  # {cluster_name (int) : bitmask of neighbors with a bike}
+        self.full = {}  # {cluster_name (int) : bool}
+        self.empty = {}
+        for name, cluster in cluster_dict.items():
+            if neighbors is None:
+                self.neighbors[name] = [neighbor for neighbor in cluster.nearest_neighbors
+                                        if neighbor != name and neighbor in cluster_dict][:radius]
+            else:
+                self.neighbors[name] = neighbors[name][:radius]
+            self.reverse[name] = []
+            self.full[name] = cluster.full
+            self.empty[name] = cluster.empty
+        for name, nearest in self.neighbors.items():
+            not_full = 0
+            not_empty = 0
+            for bit, neighbor in enumerate(nearest):
+                self.reverse[neighbor].append((name, bit))
+                if not self.full[neighbor]:
+                    not_full |= 1 << bit
+                if not self.empty[neighbor]:
+                    not_empty |= 1 << bit
+            self.not_full[name] = not_full
+            self.not_empty[name] = not_empty
+        for cluster in cluster_dict.values():
+            cluster.reroute_index = self
+
+    def update(self, name: int, full: bool, empty: bool):
+        if full != self.full[name]:
+            self.full[name] = full
+            for cluster, bit in self.reverse[name]:
+                self.not_full[cluster] ^= 1 << bit
+        if empty != self.empty[name]:
+            self.empty[name] = empty
+            for cluster, bit in self.reverse[name]:
+                self.not_empty[cluster] ^= 1 << bit
+
+    def find(self, name: int, uniform: float, method='arrival') -> int:
+        """
+        :param name: cluster the trip could not dock at or depart from
+        :param uniform: random number in [0, 1) choosing among the nearest available neighbors
+        :param method: 'arrival' looks for an open dock, 'departure' for a bike
+        :return: name of the new cluster, -1 when no neighbor within the radius is available
+        """
+        mask = self.not_full[name] if method == 'arrival' else self.not_empty[name]
+        candidates = []
+        while mask and len(candidates) < self.choices:
+            lowest = mask & -mask
+            candidates.append(lowest.bit_length() - 1)
+            mask ^= lowest
+        if not candidates:
+            return -1
+        return self.neighbors[name][candidates[int(uniform * len(candidates))]]
@@ -0,0 +1,130 @@
+import glob
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import simplejson
+
+import parameter
+
+
+class SnapshotStore:
+    """
+    Station status history as (snapshots, stations) arrays of bikes and open docks, -1 where a snapshot has no
+    status for the station, with the time of each snapshot in seconds since the epoch in increasing order. Each
+    array is a .npy loaded memory mapped, so a month of 1 minute snapshots opens instantly and only the rows read
+    are paged in.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: directory written by SnapshotStore.build
+        """
+        self.path = path
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            self.manifest = simplejson.load(f)
+        self.tz = self.manifest['tz']
+        # Plain ndarray views of the mappings, slicing np.memmap objects is slow
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r').view(np.ndarray)
+        self.station_id = load('station_id')
+        self.name = load('name')
+        self.times = load('times')  # (snapshots,) last_updated of each snapshot
+        self.bikes = load('bikes')  # (snapshots, stations) num_bikes_available
+        self.docks = load('docks')  # (snapshots, stations) num_docks_available
+        self.seconds = None  # (snapshots,) seconds since midnight in tz, see get_seconds
+
+    def __len__(self):
+        return len(self.times)
+
+    @staticmethod
+    def build(path: str, station_information, directory: str, pattern='*', processes=1, tz='America/New_York') \
+            -> 'SnapshotStore':
+        """
+        Converts saved GBFS station_status files to a store, written to a temporary directory and renamed
+        :param path: directory of the store, replaced when it exists
+        :param station_information: stations of the store, see parameter.get_info_df
+        :param directory: directory of the station_status files
+        :param pattern: glob of the snapshot files in directory
+        :param processes: number of processes parsing the files
+        :param tz: time zone the time of day of the snapshots is taken in
+        """
+        info = parameter.get_info_df(station_information)
+        info_ids = pd.Index(info['station_id'])
+        files = sorted(file for file in glob.glob(os.path.join(directory, pattern)) if os.path.isfile(file))
+        temp = f'{path.rstrip(os.sep)}.{os.getpid()}.tmp'
+        os.makedirs(temp, exist_ok=True)
+        shape = (len(files), len(info))
+        bikes = np.lib.format.open_memmap(os.path.join(temp, 'bikes.npy'), mode='w+', dtype=np.int16, shape=shape)
+        docks = np.lib.format.open_memmap(os.path.join(temp, 'docks.npy'), mode='w+', dtype=np.int16, shape=shape)
+        bikes[:] = -1
+        docks[:] = -1
+        times = np.zeros(len(files), dtype=np.int64)
+        executor = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+        try:
+            if executor is None:
+                snapshots = (parameter.read_snapshot(file, info_ids) for file in files)
+            else:
+                snapshots = executor.map(parameter.read_snapshot, files, [info_ids] * len(files),
+                                         chunksize=max(1, len(files) // (4 * processes)))
+            # Rows are written as they arrive, so the parsed files are never all in memory
+            for i, (rows, columns, last_updated) in enumerate(snapshots):
+                bikes[i, rows] = columns['num_bikes_available']
+                docks[i, rows] = columns['num_docks_available']
+                # Files without last_updated fall back to when they were saved
+                times[i] = os.path.getmtime(files[i]) if np.isnan(last_updated) else last_updated
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        bikes.flush()
+        docks.flush()
+        del bikes, docks
+        order = np.argsort(times, kind='stable')
+        if np.any(order != np.arange(len(order))):
+            for name in ('bikes', 'docks'):
+                SnapshotStore.reorder(os.path.join(temp, name + '.npy'), order)
+            times = times[order]
+        np.save(os.path.join(temp, 'times.npy'), times)
+        np.save(os.path.join(temp, 'station_id.npy'), info['station_id'].to_numpy(dtype=str))
+        np.save(os.path.join(temp, 'name.npy'), info['name'].to_numpy(dtype=str))
+        with open(os.path.join(temp, 'manifest.json'), 'w') as f:
+            simplejson.dump({'tz': tz, 'snapshots': shape[0], 'stations': shape[1], 'directory': directory}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(temp, path)
+        return SnapshotStore(path)
+
+    @staticmethod
+    def reorder(file: str, order: np.ndarray, chunk_rows=1024):
+        # Rows of a .npy in the given order, copied chunk by chunk to a new file so it is never all in memory
+        source = np.load(file, mmap_mode='r')
+        temp = file + '.sorted'
+        target = np.lib.format.open_memmap(temp, mode='w+', dtype=source.dtype, shape=source.shape)
+        for start in range(0, len(order), chunk_rows):
+            target[start:start + chunk_rows] = source[order[start:start + chunk_rows]]
+        target.flush()
+        del source, target
+        os.replace(temp, file)
+
+    def find(self, times) -> np.ndarray:
+        # Index of the snapshot closest to each time (seconds since the epoch)
+        times = np.asarray(times, dtype=np.int64)
+        if len(self.times) < 2:
+            return np.zeros(times.shape, dtype=int)
+        after = np.clip(np.searchsorted(self.times, times), 1, len(self.times) - 1)
+        before = after - 1
+        return np.where(np.abs(self.times[after] - times) < np.abs(times - self.times[before]), after, before)
+
+    def get_seconds(self) -> np.ndarray:
+        # Seconds since midnight in tz of every snapshot
+        if self.seconds is None:
+            local = pd.to_datetime(self.times, unit='s', utc=True).tz_convert(self.tz)
+            self.seconds = (local - local.normalize()).total_seconds().to_numpy().astype(np.int64)
+        return self.seconds
+
+    def get_state_df(self, i: int) -> pd.DataFrame:
+        # Snapshot i in the columns init_df_state and get_state take
+        reported = self.bikes[i] >= 0
+        return pd.DataFrame({'name': self.name[reported],
+                             'station_id': self.station_id[reported],
+                             'num_bikes_available': self.bikes[i, reported],
+                             'num_docks_available': self.docks[i, reported]})
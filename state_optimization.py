@@ -7,23 +7,34 @@ class StateOptimization:
     def __init__(self, model: ClusterModel):
         self.model = model
 
-    def optimize(self, length: timedelta, steps=1, min=2, time=None, path=None):
+    def optimize(self, length: timedelta, steps=1, min=2, time=None, path=None, seed=None):
         if path:
             if not time:
                 print("Time must be specified if path is specified")
             self.model.init_state(path, time=time)
-        origin_bike_state = {i: self.model.cluster_dict[i].curr_bikes for i in self.model.cluster_dict}
-        origin_time = self.model.curr_time
-        origin_in_transit = self.model.in_transit
+        origin = self.model.snapshot()
         end_time = self.model.curr_time + length
-        opt_state = origin_bike_state
+        opt_state = {i: self.model.cluster_dict[i].curr_bikes for i in self.model.cluster_dict}
+        # Steps draw one after another from their own generator, restoring origin would replay the same draws
+        if seed is None:
+            rng = np.random.default_rng()
+            rng.bit_generator.state = origin['rng']
+        else:
+            rng = np.random.default_rng(seed)
         for step in range(steps):
-            self.model.reset_state(bike_state=opt_state, in_transit=origin_in_transit, time=origin_time)
+            self.model.restore(origin)
+            self.model.rng = rng
+            self.model.load_bikes(opt_state)
+            self.model.reset_failures()
+            self.model.failures = 0
+            self.model.total_trips = 0
+            self.model.critical_failures = 0
             while self.model.curr_time < end_time:
                 self.model.sim()
             for i in self.model.cluster_dict:
                 sign = 1
-                change = len(self.model.cluster_dict[i].bad_departures) - len(self.model.cluster_dict[i].bad_arrivals)
+                cluster = self.model.cluster_dict[i]
+                change = int(cluster.departure_failures.sum() - cluster.arrival_failures.sum())
                 if change < 0:
                     sign = -1
                 opt_state[i] += int(abs(change) ** ((min*steps - step) / (min * steps))) * sign
@@ -33,7 +44,8 @@ class StateOptimization:
                 if opt_state[i] > self.model.cluster_dict[i].max_docks:
                     opt_state[i] = self.model.cluster_dict[i].max_docks
             print('Step', step + 1, 'of', steps, 'completed', self.model.failures, 'failures')
-        self.model.reset_state(bike_state=origin_bike_state, in_transit=origin_in_transit, time=origin_time)
+        # Back to the state and the generator of the caller
+        self.model.restore(origin)
         return opt_state
 
     def expected_change(self, num_ticks: int):
@@ -42,13 +54,16 @@ class StateOptimization:
         cluster_to_index = {cluster.name: i for i, cluster in enumerate(clusters)}
         expected_change = np.zeros(len(clusters))
         for tick in range(self.model.curr_tick, num_ticks + self.model.curr_tick):
-            rate_vector = np.array([cluster.rate[tick] if cluster.rate[tick] < cluster.curr_bikes
+            tick %= 24 * self.model.tph
+            rate_vector = np.array([cluster.tick_rate[tick] if cluster.tick_rate[tick] < cluster.curr_bikes
                                     else cluster.curr_bikes for cluster in clusters])
             transition_matrix = np.zeros((len(clusters), len(clusters)))
             for i, cluster in enumerate(clusters):
-                for end_cluster in cluster.transition[tick]:
-                    j = cluster_to_index[end_cluster]
-                    transition_matrix[j, i] = cluster.transition[tick][end_cluster]
+                probs = np.diff(cluster.transition_cdf[tick], prepend=0)
+                for end_cluster, prob in zip(cluster.transition_keys[tick], probs):
+                    if end_cluster not in cluster_to_index:
+                        continue
+                    transition_matrix[cluster_to_index[end_cluster], i] += prob
             expected_change += np.matmul(transition_matrix, rate_vector) - rate_vector
 
         return {cluster.name: expected_change[i] for i, cluster in enumerate(clusters)}
@@ -0,0 +1,113 @@
+import os
+import shutil
+
+import numpy as np
+import simplejson
+
+COLUMNS = ('station_id', 'name', 'short_name', 'region_id', 'lat', 'lon', 'capacity')
+
+
+class StationRegistry:
+    """
+    GBFS station information as columns with one row per station: station_id, name, short_name, region_id (str),
+    lat, lon (float) and capacity (int). Saved as one .npy per column, which load memory mapped, so opening a
+    saved registry skips parsing the JSON. Rows are found by station_id through a dict, the first row of an id
+    counts when it repeats.
+    """
+    def __init__(self, columns: dict[str: np.ndarray], last_updated=None):
+        """
+        :param columns: {column : array}, every column of COLUMNS
+        :param last_updated: last_updated of the GBFS feed the registry was built from
+        """
+        self.columns = columns
+        self.last_updated = last_updated
+        self.station_id = columns['station_id']
+        self.name = columns['name']
+        self.lat = columns['lat']
+        self.lon = columns['lon']
+        self.capacity = columns['capacity']
+        self.id_index = {}  # {station_id : first row with the station_id}
+        for i, station_id in enumerate(self.station_id.tolist()):
+            self.id_index.setdefault(station_id, i)
+        self.id_to_name = None  # {station_id : name}, see get_id_to_name
+
+    def __len__(self):
+        return len(self.station_id)
+
+    @classmethod
+    def from_gbfs(cls, station_information) -> 'StationRegistry':
+        """
+        :param station_information: path of a GBFS station_information.json, the parsed feed or its list of stations
+        """
+        if isinstance(station_information, str):
+            with open(station_information, 'r') as f:
+                station_information = simplejson.load(f)
+        last_updated = None
+        if isinstance(station_information, dict):
+            last_updated = station_information.get('last_updated')
+            station_information = station_information['data']['stations']
+        columns = {'station_id': np.array([str(station['station_id']) for station in station_information], dtype=str),
+                   'name': np.array([station['name'] for station in station_information], dtype=str),
+                   'short_name': np.array([station.get('short_name') or '' for station in station_information],
+                                          dtype=str),
+                   'region_id': np.array([station.get('region_id') or '' for station in station_information],
+                                         dtype=str),
+                   'lat': np.array([station['lat'] for station in station_information], dtype=float),
+                   'lon': np.array([station['lon'] for station in station_information], dtype=float),
+                   'capacity': np.array([station.get('capacity', 0) for station in station_information], dtype=int)}
+        return cls(columns, last_updated)
+
+    @classmethod
+    def load(cls, path: str) -> 'StationRegistry':
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            manifest = simplejson.load(f)
+        # Plain ndarray views of the mapping, slicing np.memmap objects is slow
+        columns = {column: np.load(os.path.join(path, column + '.npy'), mmap_mode='r').view(np.ndarray)
+                   for column in COLUMNS}
+        return cls(columns, manifest.get('last_updated'))
+
+    def save(self, path: str, source_mtime=None):
+        # Written to a temporary directory and renamed, so readers never see a partial registry
+        temp = f'{path.rstrip(os.sep)}.{os.getpid()}.tmp'
+        os.makedirs(temp, exist_ok=True)
+        for column in COLUMNS:
+            np.save(os.path.join(temp, column + '.npy'), np.ascontiguousarray(self.columns[column]), allow_pickle=False)
+        with open(os.path.join(temp, 'manifest.json'), 'w') as f:
+            simplejson.dump({'last_updated': self.last_updated, 'source_mtime': source_mtime, 'stations': len(self)}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(temp, path)
+
+    @classmethod
+    def open(cls, path: str, registry_path=None) -> 'StationRegistry':
+        """
+        Registry of a GBFS station_information.json. With registry_path it is converted once and saved there, then
+        loaded from there until the JSON file changes
+        :param path: station_information.json, or the directory of a saved registry
+        :param registry_path: directory the registry is saved to, None to only read the JSON
+        """
+        if os.path.isdir(path):
+            return cls.load(path)
+        if registry_path is None:
+            return cls.from_gbfs(path)
+        source_mtime = os.path.getmtime(path)
+        try:
+            with open(os.path.join(registry_path, 'manifest.json'), 'r') as f:
+                if simplejson.load(f).get('source_mtime') == source_mtime:
+                    return cls.load(registry_path)
+        except (OSError, ValueError):
+            pass
+        registry = cls.from_gbfs(path)
+        registry.save(registry_path, source_mtime)
+        return registry
+
+    def get_indices(self, station_ids) -> np.ndarray:
+        # First row of every station_id, -1 for ids not in the registry
+        get = self.id_index.get
+        return np.fromiter((get(station_id, -1) for station_id in station_ids), dtype=int, count=len(station_ids))
+
+    def get_id_to_name(self) -> dict[str: str]:
+        # Built once, the registry never changes
+        if self.id_to_name is None:
+            names = self.name.tolist()
+            self.id_to_name = {station_id: names[i] for station_id, i in self.id_index.items()}
+        return self.id_to_name
@@ -0,0 +1,66 @@
+from collections import deque
+
+import numpy as np
+import pytest
+
+from adjacency import ClusterAdjacency
+from benchmark.synthetic import make_station_data
+from cluster_model import ClusterModel
+
+
+def get_hops(names: list[int], horizontal_squares: int) -> dict[int: dict[int: int]]:
+    # Breadth first search over occupied squares sharing an edge
+    occupied = set(names)
+    hops = {}
+    for start in names:
+        distance = {start: 0}
+        queue = deque([start])
+        while queue:
+            name = queue.popleft()
+            x, y = name % horizontal_squares, name // horizontal_squares
+            for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                neighbor = nx + ny * horizontal_squares
+                if 0 <= nx < horizontal_squares and ny >= 0 and neighbor in occupied and neighbor not in distance:
+                    distance[neighbor] = distance[name] + 1
+                    queue.append(neighbor)
+        hops[start] = distance
+    return hops
+
+
+@pytest.mark.parametrize('horizontal_squares, vertical_squares, names', [
+    # The last square of a row and the first of the next are not adjacent, nor are the top and bottom rows
+    (4, 3, [3, 4, 7, 8, 0, 11, 2, 6, 10]),
+    (1, 5, [0, 1, 3, 4]),
+    (5, 1, [4, 0, 1, 3]),
+    (3, 3, [4]),
+])
+def test_neighborhoods_match_search(horizontal_squares, vertical_squares, names):
+    adjacency = ClusterAdjacency(names, horizontal_squares, vertical_squares)
+    hops = get_hops(names, horizontal_squares)
+    for k in (1, 2, 3):
+        expected = {name: sorted(neighbor for neighbor, hop in hops[name].items() if 0 < hop <= k) for name in names}
+        assert {name: sorted(ends) for name, ends in adjacency.to_dict(k).items()} == expected
+        assert all(sorted(adjacency.get_neighbors(name, k)) == expected[name] for name in names)
+        assert adjacency.get_neighborhood(k) is adjacency.get_neighborhood(k)
+    full = adjacency.get_hops()
+    for i, name in enumerate(names):
+        assert full[i].tolist() == [hops[name].get(end, -1) for end in names]
+    assert (adjacency.get_hops(1) <= 1).all()
+
+
+def test_empty_grid():
+    adjacency = ClusterAdjacency([], 3, 3)
+    assert adjacency.to_dict(2) == {} and adjacency.get_hops().shape == (0, 0)
+
+
+def test_model_adjacent_clusters_share_an_edge():
+    model = ClusterModel(make_station_data(scale=0.05, seed=1, dense=False), square_length=0.005)
+    names = list(model.cluster_dict)
+    hops = get_hops(names, model.horizontal_squares)
+    adjacent = model.get_adjacent_clusters()
+    assert {name: sorted(ends) for name, ends in adjacent.items()} == \
+        {name: sorted(end for end, hop in hops[name].items() if hop == 1) for name in names}
+    assert model.get_adjacency() is model.get_adjacency()
+    # Rows of the matrices follow cluster_index
+    assert model.get_adjacency().names.tolist() == list(model.cluster_index)
+    assert np.array_equal(model.get_adjacency().matrix.toarray(), model.get_adjacency().matrix.T.toarray())
@@ -0,0 +1,101 @@
+import os
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+import simplejson
+
+from backtest import Backtest
+from benchmark.synthetic import make_station_data
+from cluster_model import ClusterModel
+from snapshot_store import SnapshotStore
+from trip import Trip
+
+START = int(pd.Timestamp('2024-07-01 06:00', tz='America/New_York').timestamp())
+
+
+@pytest.fixture(scope='module')
+def archive(tmp_path_factory) -> tuple[ClusterModel, list[dict], list[np.ndarray], str]:
+    # Hour of 5 minute station_status files written out of time order, with stations missing at random
+    station_data = make_station_data(scale=0.05, seed=1, dense=False)
+    info = [{'station_id': f'id{i}', 'name': name, 'lat': data['lat'], 'lon': data['lon'],
+             'capacity': data['max_docks']} for i, (name, data) in enumerate(station_data.items())]
+    info.append({'station_id': 'extra', 'name': 'Not modelled', 'lat': 40.7, 'lon': -74.0, 'capacity': 5})
+    directory = tmp_path_factory.mktemp('status')
+    rng = np.random.default_rng(0)
+    bikes = []
+    for k in range(12):
+        counts = rng.integers(-1, 20, len(info))  # -1 is a station missing from the feed
+        stations = [{'station_id': station['station_id'], 'num_bikes_available': int(b), 'num_bikes_disabled': 0,
+                     'num_docks_available': 3, 'num_docks_disabled': 0, 'is_renting': True, 'is_returning': True,
+                     'is_installed': True} for station, b in zip(info, counts) if b >= 0]
+        with open(os.path.join(directory, f'{(k * 7) % 12:02d}.json'), 'w') as f:
+            simplejson.dump({'last_updated': START + k * 300, 'data': {'stations': stations}}, f)
+        bikes.append(counts)
+    store = SnapshotStore.build(str(tmp_path_factory.mktemp('store') / 'store'), info, str(directory))
+    return ClusterModel(station_data, square_length=0.005, seed=0), info, bikes, store.path
+
+
+def test_build_orders_snapshots_by_time(archive):
+    model, info, bikes, path = archive
+    store = SnapshotStore(path)
+    assert len(store) == 12
+    assert store.times.tolist() == [START + k * 300 for k in range(12)]
+    assert np.array_equal(store.bikes, np.array(bikes))
+    assert np.array_equal(store.docks, np.where(np.array(bikes) >= 0, 3, -1))
+    assert store.station_id.tolist() == [station['station_id'] for station in info]
+    assert store.get_seconds()[0] == 6 * 3600
+
+
+def test_reorder_copies_rows_in_order(tmp_path):
+    file = str(tmp_path / 'rows.npy')
+    rows = np.arange(30, dtype=np.int16).reshape((10, 3))
+    np.save(file, rows)
+    order = np.random.default_rng(0).permutation(10)
+    SnapshotStore.reorder(file, order, chunk_rows=3)
+    assert np.array_equal(np.load(file), rows[order])
+
+
+def test_find_picks_closest_snapshot(archive):
+    store = SnapshotStore(archive[3])
+    assert store.find([START - 1000, START + 149, START + 151, START + 10 ** 6]).tolist() == [0, 0, 1, 11]
+
+
+def test_state_df_matches_cluster_state(archive):
+    model, info, bikes, path = archive
+    store = SnapshotStore(path)
+    df = store.get_state_df(4)
+    reported = bikes[4] >= 0
+    assert df['station_id'].tolist() == [station['station_id'] for station, r in zip(info, reported) if r]
+    assert df['num_bikes_available'].tolist() == bikes[4][reported].tolist()
+    backtest = Backtest(model, store)
+    state = model.fork().get_state(df)
+    assert dict(zip(backtest.model.cluster_index, backtest.get_cluster_bikes([4])[0].tolist())) == \
+        {name: state[name] for name in backtest.model.cluster_index}
+
+
+def test_backtest_runs_and_summary(archive):
+    model, info, bikes, path = archive
+    store = SnapshotStore(path)
+    # Trips in transit on the model are not carried into the runs
+    model = model.fork()
+    names = list(model.cluster_dict)
+    model.in_transit = [Trip(names[0], names[1], model.curr_time, timedelta(minutes=20))]
+    backtest = Backtest(model, store)
+    assert not backtest.model.arrivals and model.arrivals
+    horizons = [timedelta(minutes=10), timedelta(minutes=30)]
+    runs = backtest.run([0, 3], horizons, seed=1, processes=1)
+    assert runs['start'].tolist() == [0, 0, 3, 3]
+    assert runs['end'].tolist() == [3, 6, 6, 9]  # Ticks of 15 minutes
+    assert runs['ticks'].tolist() == [1, 2, 1, 2]
+    start_bikes = backtest.get_cluster_bikes(runs['start'])
+    truth = backtest.get_cluster_bikes(runs['end'])
+    assert np.array_equal(backtest.truth, truth)
+    assert runs['persistence_mse'].tolist() == pytest.approx(((start_bikes - truth) ** 2).mean(axis=1).tolist())
+    assert runs['mse'].tolist() == pytest.approx(((backtest.predicted - truth) ** 2).mean(axis=1).tolist())
+    # Same seed, same runs
+    assert backtest.run([0, 3], horizons, seed=1, processes=1).equals(runs)
+    summary = Backtest.summary(runs)
+    assert summary.index.tolist() == [1, 2]
+    assert summary.loc[2, 'mae'] == pytest.approx(runs.loc[runs['ticks'] == 2, 'mae'].mean())
@@ -0,0 +1,51 @@
+import numpy as np
+
+from cluster import StationCluster, resample_rate
+
+
+def make_cluster(tph: int, rate=None) -> StationCluster:
+    # Data ticks of 15 minutes, each sending every trip to the cluster named after the data tick
+    rate = {tick: 1.0 for tick in range(96)} if rate is None else rate
+    transition = {tick: {tick: 1.0} for tick in range(96)}
+    return StationCluster(name=-1, neighbors_dist={}, max_docks=10, curr_bikes=5, rate=rate, transition=transition,
+                          lat=0, lon=0, tph=tph)
+
+
+def get_probs(cluster: StationCluster, tick: int) -> dict[int: float]:
+    probs = np.diff(cluster.transition_cdf[tick], prepend=0)
+    return dict(zip(cluster.transition_keys[tick].tolist(), probs.tolist()))
+
+
+def test_sampler_time_of_day_tph_3():
+    # 20 minute ticks mix the 15 minute data ticks they overlap, by minutes of overlap at a constant rate
+    cluster = make_cluster(tph=3)
+    assert len(cluster.transition_keys) == 72
+    for tick in range(72):
+        probs = get_probs(cluster, tick)
+        start, end = tick * 20, (tick + 1) * 20
+        expected = {data_tick: (min(end, (data_tick + 1) * 15) - max(start, data_tick * 15)) / 20
+                    for data_tick in range(start // 15, (end - 1) // 15 + 1)}
+        assert probs.keys() == expected.keys(), tick
+        assert np.allclose([probs[key] for key in expected], list(expected.values())), tick
+    assert get_probs(cluster, 36).keys() == {48, 49}  # 12:00
+    assert get_probs(cluster, 71).keys() == {94, 95}  # 23:40
+
+
+def test_sampler_weights_by_rate():
+    rate = {tick: 0.0 for tick in range(96)}
+    rate[48] = 1.0
+    cluster = make_cluster(tph=3, rate=rate)
+    probs = get_probs(cluster, 36)
+    assert {key: prob for key, prob in probs.items() if prob > 0} == {48: 1.0}
+
+
+def test_sampler_matches_rate_resampling():
+    # Every tick of the sampler covers the same minutes resample_rate sums for it
+    for tph in (1, 2, 3, 4, 5, 12):
+        cluster = make_cluster(tph=tph)
+        assert len(cluster.transition_keys) == len(cluster.tick_rate) == 24 * tph
+        assert np.isclose(cluster.tick_rate.sum(), resample_rate(np.ones(96), tph).sum())
+        for tick in range(24 * tph):
+            keys = cluster.transition_keys[tick]
+            assert keys.min() == tick * 60 // tph // 15
+            assert keys.max() == ((tick + 1) * 60 // tph - 1) // 15
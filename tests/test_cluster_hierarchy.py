@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from benchmark.synthetic import make_station_data
+from cluster_hierarchy import ClusterHierarchy
+from cluster_model import ClusterModel
+
+
+@pytest.fixture(scope='module')
+def station_data() -> dict:
+    return make_station_data(scale=0.05, seed=1, dense=False)
+
+
+@pytest.fixture(scope='module')
+def hierarchy(station_data) -> ClusterHierarchy:
+    return ClusterHierarchy(station_data, square_length=0.0025, levels=3)
+
+
+@pytest.mark.parametrize('level', [1, 2])
+def test_levels_match_models_built_from_scratch(station_data, hierarchy, level):
+    scratch = ClusterModel(station_data, square_length=hierarchy.square_lengths[level])
+    for key, expected in scratch.cluster_arrays.items():
+        array = hierarchy.arrays[level][key]
+        if expected.dtype.kind == 'f':
+            np.testing.assert_allclose(array, expected, rtol=0, atol=1e-9, err_msg=key)
+        else:
+            assert np.array_equal(array, expected), key
+    model = hierarchy.get_model(level, seed=1)
+    assert list(model.cluster_dict) == list(scratch.cluster_dict)
+    assert model.station_clusters == scratch.station_clusters
+    assert np.allclose(model.travel_minutes, scratch.travel_minutes, equal_nan=True)
+    # Same seed, same state, so the same run
+    scratch.rng = np.random.default_rng(1)
+    for sim in (model, scratch):
+        for cluster in sim.cluster_dict.values():
+            cluster.curr_bikes = cluster.max_docks // 2
+            cluster.update()
+        for _ in range(12 * sim.tph):
+            sim.sim()
+    assert (model.failures, model.total_trips) == (scratch.failures, scratch.total_trips)
+
+
+def test_levels_are_built_once_and_forked(hierarchy):
+    first = hierarchy.get_model(1)
+    assert hierarchy.get_model(1) is not first and hierarchy.models[1] is not first
+    assert first.cluster_dict[next(iter(first.cluster_dict))].tick_rate is \
+        hierarchy.models[1].cluster_dict[next(iter(first.cluster_dict))].tick_rate
+    assert hierarchy.get_level(0.005) == 1
+    with pytest.raises(ValueError):
+        hierarchy.get_level(0.003)
+
+
+def test_parents_contain_their_children(hierarchy):
+    for level in range(2):
+        parents = hierarchy.get_parents(level)
+        children = hierarchy.get_children(level + 1)
+        assert sorted(child for cells in children.values() for child in cells) == sorted(parents)
+        fine, coarse = hierarchy.arrays[level], hierarchy.arrays[level + 1]
+        lat_lon = dict(zip(fine['cells'].tolist(), fine['clusters_lat_lon'].tolist()))
+        coarse_lat_lon = dict(zip(coarse['cells'].tolist(), coarse['clusters_lat_lon'].tolist()))
+        half = coarse['grid_origin'][2] / 2
+        for child, parent in parents.items():
+            assert child in children[parent]
+            # The centre of a child square lies inside its parent square
+            assert np.all(np.abs(np.subtract(lat_lon[child], coarse_lat_lon[parent])) < half)
+        # Docks are summed, every station stays in the parent of its square
+        assert fine['max_docks'].sum() == coarse['max_docks'].sum()
+        assert np.array_equal(hierarchy.parents[level][fine['station_clusters']], coarse['station_clusters'])
@@ -0,0 +1,152 @@
+from datetime import timedelta
+
+import numpy as np
+import pytest
+
+from array_model import ArrayModel
+from benchmark.synthetic import make_station_data
+from cluster_model import ClusterModel
+from event_model import EventModel
+from trip import Trip
+
+
+@pytest.fixture(scope='module')
+def model() -> ClusterModel:
+    model = ClusterModel(make_station_data(scale=0.05, seed=1, dense=False), square_length=0.005, seed=0)
+    for cluster in model.cluster_dict.values():
+        cluster.curr_bikes = cluster.max_docks // 2
+        cluster.update()
+    return model
+
+
+def make_trips(model: ClusterModel, num_trips: int, seed: int) -> list[Trip]:
+    rng = np.random.default_rng(seed)
+    names = list(model.cluster_dict)
+    return [Trip(start_cluster=names[i], end_cluster=names[j], start_time=model.curr_time,
+                 trip_time=timedelta(minutes=float(minutes)))
+            for i, j, minutes in zip(rng.integers(0, len(names), num_trips), rng.integers(0, len(names), num_trips),
+                                     rng.random(num_trips) * 180)]
+
+
+def trips_only(model: ClusterModel) -> ClusterModel:
+    # Fork with no departures and room for every arrival, so the only change is trips docking
+    model = model.fork()
+    for cluster in model.cluster_dict.values():
+        cluster.tick_rate = np.zeros_like(cluster.tick_rate)
+        cluster.max_docks = 10 ** 6
+        cluster.update()
+    return model
+
+
+def test_arrival_buckets_match_trip_updates(model):
+    # The baseline sim_trips called Trip.update on every trip every tick and docked it once update returned True
+    trips = make_trips(model, 500, seed=1)
+    sim = trips_only(model)
+    sim.in_transit = trips
+    bikes = {name: cluster.curr_bikes for name, cluster in sim.cluster_dict.items()}
+    transit = [Trip(trip.start_cluster, trip.end_cluster, trip.start_time, trip.end_time - trip.start_time)
+               for trip in trips]
+    for _ in range(15 * sim.tph):
+        sim.sim()
+        remaining = []
+        for trip in transit:
+            if trip.update(timedelta(hours=1 / sim.tph)):
+                bikes[trip.end_cluster] += 1
+            else:
+                remaining.append(trip)
+        transit = remaining
+        assert {name: cluster.curr_bikes for name, cluster in sim.cluster_dict.items()} == bikes
+    assert sim.total_trips == len(trips) and not transit
+
+
+def test_array_model_docks_like_cluster_model(model):
+    sim = trips_only(model)
+    sim.in_transit = make_trips(model, 500, seed=2)
+    array = ArrayModel(sim.fork(), seed=0)
+    for _ in range(15 * sim.tph):
+        sim.sim()
+        array.sim()
+        assert array.curr_bikes.tolist() == [cluster.curr_bikes for cluster in sim.cluster_dict.values()]
+    assert array.total_trips == sim.total_trips
+
+
+def test_array_model_matches_cluster_model_on_average(model):
+    # Different random draws, so only the means over seeds are compared
+    seeds = range(6)
+    counts = {'object': [], 'array': []}
+    for seed in seeds:
+        sim = model.fork(seed=seed)
+        for _ in range(24 * sim.tph):
+            sim.sim()
+        counts['object'].append((sim.failures, sim.total_trips))
+        array = ArrayModel(model.fork(), seed=seed)
+        array.run(24 * array.tph)
+        counts['array'].append((array.failures, array.total_trips))
+    failures, total_trips = np.mean(counts['object'], axis=0)
+    array_failures, array_total_trips = np.mean(counts['array'], axis=0)
+    assert array_total_trips == pytest.approx(total_trips, rel=0.05)
+    assert array_failures == pytest.approx(failures, rel=0.15)
+
+
+def test_array_model_replicas_average_out_to_single_replica(model):
+    # Replicas share every table but draw separately, so their counts differ and average to single replica runs
+    replicas = 16
+    bikes = np.array([cluster.curr_bikes for cluster in model.cluster_dict.values()])
+    array = ArrayModel(model.fork(), seed=0, initial_bikes=np.tile(bikes, (replicas, 1)))
+    array.run(24 * array.tph)
+    assert len(np.unique(array.replica_failures)) > 1
+    assert array.replica_failures.sum() == array.failures - model.failures
+    assert array.replica_total_trips.sum() == array.total_trips - model.total_trips
+    single = []
+    for seed in range(replicas):
+        run = ArrayModel(model.fork(), seed=100 + seed)
+        run.run(24 * run.tph)
+        single.append((run.failures - model.failures, run.total_trips - model.total_trips))
+    failures, total_trips = np.mean(single, axis=0)
+    assert array.replica_total_trips.mean() == pytest.approx(total_trips, rel=0.05)
+    assert array.replica_failures.mean() == pytest.approx(failures, rel=0.15)
+
+
+def test_event_model_matches_cluster_model_on_average(model):
+    # Continuous time, so only the means over seeds are compared with the tick engine
+    seeds = range(6)
+    counts = {'object': [], 'event': []}
+    for seed in seeds:
+        sim = model.fork(seed=seed)
+        for _ in range(24 * sim.tph):
+            sim.sim()
+        counts['object'].append((sim.failures, sim.total_trips))
+        event = EventModel(model.fork(), seed=seed)
+        event.run(timedelta(hours=24))
+        counts['event'].append((event.failures, event.total_trips))
+    failures, total_trips = np.mean(counts['object'], axis=0)
+    event_failures, event_total_trips = np.mean(counts['event'], axis=0)
+    assert event_total_trips == pytest.approx(total_trips, rel=0.05)
+    assert event_failures == pytest.approx(failures, rel=0.15)
+
+
+def test_event_model_sync_writes_back_state(model):
+    sim = model.fork()
+    sim.in_transit = make_trips(model, 200, seed=3)
+    event = EventModel(sim, seed=0)
+    for _ in range(8 * sim.tph):
+        event.sim()
+    event.sync()
+    clusters = list(sim.cluster_dict.values())
+    assert [cluster.curr_bikes for cluster in clusters] == event.curr_bikes
+    assert np.array_equal(np.array([cluster.arrival_failures for cluster in clusters]).T, event.arrival_failures)
+    assert np.array_equal(np.array([cluster.departure_failures for cluster in clusters]).T, event.departure_failures)
+    # Every failure is counted in the tick it happened at, once
+    assert sum(cluster.num_failures() for cluster in clusters) == sim.failures - model.failures > 0
+    assert (sim.curr_tick, sim.curr_time, sim.total_trips) == (event.curr_tick, event.curr_time, event.total_trips)
+    # Trips in transit keep their destinations and remaining times
+    in_transit = sorted(sim.in_transit, key=lambda trip: trip.end_time)
+    assert len(in_transit) == len(event.events) > 0
+    for trip, (time, _, _, destination) in zip(in_transit, sorted(event.events)):
+        assert trip.end_cluster == event.names[destination]
+        assert (trip.end_time - trip.curr_time).total_seconds() / 60 == pytest.approx(time - event.time)
+    # The synced model starts a new engine in the same state
+    restarted = EventModel(sim, seed=0)
+    assert restarted.curr_bikes == event.curr_bikes
+    times = [arrival[0] for arrival in sorted(event.events)]
+    assert [arrival[0] for arrival in sorted(restarted.events)] == pytest.approx(times)
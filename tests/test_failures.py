@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from array_model import ArrayModel
+from benchmark.synthetic import make_station_data
+from cluster_model import ClusterModel
+from trip import Trip
+
+
+def make_model(keep_failed_trips=False) -> ClusterModel:
+    model = ClusterModel(make_station_data(scale=0.05, seed=1, dense=False), square_length=0.005, seed=0,
+                         keep_failed_trips=keep_failed_trips)
+    for cluster in model.cluster_dict.values():
+        cluster.curr_bikes = cluster.max_docks // 4
+        cluster.update()
+    return model
+
+
+def get_counts(model: ClusterModel) -> tuple[np.ndarray, np.ndarray]:
+    # (clusters, ticks) failed arrivals and departures
+    clusters = model.cluster_dict.values()
+    return (np.array([cluster.arrival_failures for cluster in clusters]),
+            np.array([cluster.departure_failures for cluster in clusters]))
+
+
+@pytest.fixture(scope='module')
+def model() -> ClusterModel:
+    return make_model()
+
+
+def test_failures_counted_in_their_tick(model):
+    sim = model.fork(seed=0)
+    for _ in range(12 * sim.tph):
+        failures = sim.failures
+        before = sum(get_counts(sim))
+        sim.sim()
+        change = sum(get_counts(sim)) - before
+        # Only the column of the tick just simulated changes, by the failures of the tick
+        assert not np.delete(change, sim.curr_tick, axis=1).any()
+        assert change[:, sim.curr_tick].sum() == sim.failures - failures
+    arrival_failures, departure_failures = get_counts(sim)
+    assert arrival_failures.sum() > 0 and departure_failures.sum() > 0
+    assert sum(cluster.num_failures() for cluster in sim.cluster_dict.values()) == sim.failures
+    # Failed trips are only counted unless they are asked for
+    assert not any(cluster.bad_arrivals or cluster.bad_departures for cluster in sim.cluster_dict.values())
+    sim.reset_failures()
+    assert not any(count.any() for count in get_counts(sim))
+
+
+def test_failed_trips_kept_when_asked():
+    sim = make_model(keep_failed_trips=True)
+    for _ in range(12 * sim.tph):
+        sim.sim()
+    arrival_failures, departure_failures = get_counts(sim)
+    clusters = list(sim.cluster_dict.values())
+    assert [len(cluster.bad_arrivals) for cluster in clusters] == arrival_failures.sum(axis=1).tolist()
+    assert [len(cluster.bad_departures) for cluster in clusters] == departure_failures.sum(axis=1).tolist()
+    assert all(isinstance(trip, Trip) for cluster in clusters for trip in cluster.bad_arrivals)
+    assert arrival_failures.sum() > 0 and departure_failures.sum() > 0
+    trip = next(trip for cluster in clusters for trip in cluster.bad_arrivals)
+    assert not hasattr(trip, '__dict__')  # Trips use __slots__
+
+
+def test_array_model_syncs_tick_counters(model):
+    sim = model.fork()
+    array = ArrayModel(sim, seed=0)
+    for _ in range(12 * sim.tph):
+        failures = array.failures
+        before = array.arrival_failures.sum(axis=1) + array.departure_failures.sum(axis=1)
+        array.sim()
+        change = array.arrival_failures.sum(axis=1) + array.departure_failures.sum(axis=1) - before
+        assert np.flatnonzero(change).tolist() in ([], [array.curr_tick])
+        assert change.sum() == array.failures - failures
+    array.sync()
+    arrival_failures, departure_failures = get_counts(sim)
+    assert np.array_equal(arrival_failures, array.arrival_failures.T)
+    assert np.array_equal(departure_failures, array.departure_failures.T)
+    assert arrival_failures.sum() + departure_failures.sum() == sim.failures > 0
@@ -0,0 +1,89 @@
+import asyncio
+import os
+
+import numpy as np
+import pytest
+import simplejson
+
+from gbfs_poller import DIFF_COLUMNS, GBFSPoller, ReplayServer, load_diffs, load_snapshots
+
+START = 1719828000
+
+
+@pytest.fixture()
+def feeds(tmp_path) -> tuple[str, str, list[dict]]:
+    # Station_status files where a few stations change each poll, one station only appears from the third
+    directory = tmp_path / 'feeds'
+    directory.mkdir()
+    rng = np.random.default_rng(0)
+    bikes = rng.integers(0, 10, 6)
+    feeds = []
+    for k in range(8):
+        bikes = np.where(rng.random(6) < 0.3, rng.integers(0, 10, 6), bikes)
+        stations = [{'station_id': f'id{i}', 'num_bikes_available': int(b), 'num_bikes_disabled': 0,
+                     'num_docks_available': 10 - int(b), 'num_docks_disabled': 0, 'is_renting': i != 2 or k < 4,
+                     'is_returning': True, 'is_installed': True} for i, b in enumerate(bikes) if i != 5 or k >= 2]
+        feed = {'last_updated': START + 60 * k, 'ttl': 0, 'data': {'stations': stations}}
+        with open(directory / f'{7 - k}.json', 'w') as f:
+            simplejson.dump(feed, f)
+        feeds.append(feed)
+    information = tmp_path / 'station_information.json'
+    with open(information, 'w') as f:
+        simplejson.dump({'data': {'stations': [{'station_id': f'id{i}'} for i in range(6)]}}, f)
+    return str(directory), str(information), feeds
+
+
+def poll(path: str, server: ReplayServer, polls: int) -> GBFSPoller:
+    poller = GBFSPoller(path, status_url=server.url + '/station_status.json',
+                        information_url=server.url + '/station_information.json', min_interval=0)
+    asyncio.run(poller.run(polls=polls))
+    return poller
+
+
+def check_snapshots(path: str, feeds: list[dict]):
+    stations, times, snapshots = load_snapshots(path)
+    assert times.tolist() == [feed['last_updated'] for feed in feeds]
+    for i, feed in enumerate(feeds):
+        expected = {station['station_id']: station for station in feed['data']['stations']}
+        for j, station_id in enumerate(stations):
+            station = expected.get(station_id)
+            bikes = snapshots['num_bikes_available'][i, j]
+            assert bikes == (-1 if station is None else station['num_bikes_available'])
+            if station is not None:
+                assert snapshots['num_docks_available'][i, j] == station['num_docks_available']
+                assert snapshots['operating'][i, j] == station['is_renting']
+
+
+def test_diffs_round_trip_through_replay(tmp_path, feeds):
+    directory, information, feeds = feeds
+    path = str(tmp_path / 'archive')
+    with ReplayServer(directory, information=information) as server:
+        # The last two polls get the last file again, which adds nothing
+        poller = poll(path, server, len(feeds) + 2)
+    assert server.served == len(feeds) + 2 and poller.status.connections == 1
+    assert os.path.isfile(os.path.join(path, 'station_information.json'))
+    stations, diffs = load_diffs(path)
+    assert stations == [f'id{i}' for i in range(6)]
+    # Only stations that changed since the poll before are written
+    first = len(feeds[0]['data']['stations'])
+    assert first < len(diffs) == poller.records < len(feeds) * 6
+    assert (diffs[:first, 0] == START).all() and diffs.shape[1] == len(DIFF_COLUMNS)
+    check_snapshots(path, feeds)
+
+
+def test_truncated_row_is_dropped_and_polling_resumes(tmp_path, feeds):
+    directory, information, feeds = feeds
+    path = str(tmp_path / 'archive')
+    with ReplayServer(directory, information=information) as server:
+        poll(path, server, 4)
+    # A crash while appending leaves part of a row
+    with open(os.path.join(path, 'diffs.bin'), 'ab') as f:
+        f.write(np.arange(3, dtype=np.int64).tobytes())
+    stations, diffs = load_diffs(path)
+    assert diffs[-1, 0] == START + 180
+    with ReplayServer(directory, information=information) as server:
+        # The server starts from the first file again, polls older than the archive are skipped
+        poller = poll(path, server, len(feeds))
+    assert poller.last_updated == START + 60 * (len(feeds) - 1)
+    assert os.path.getsize(os.path.join(path, 'diffs.bin')) % (len(DIFF_COLUMNS) * 8) == 0
+    check_snapshots(path, feeds)
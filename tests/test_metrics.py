@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from array_model import ArrayModel
+from benchmark.synthetic import make_station_data
+from cluster_model import ClusterModel
+from metrics import FIELDS, load_metrics
+
+
+@pytest.fixture(scope='module')
+def model() -> ClusterModel:
+    model = ClusterModel(make_station_data(scale=0.05, seed=1, dense=False), square_length=0.005, seed=0)
+    for cluster in model.cluster_dict.values():
+        cluster.curr_bikes = cluster.max_docks // 4
+        cluster.update()
+    return model
+
+
+def test_written_metrics_load_like_memory(model, tmp_path):
+    # Same seed with and without a file, 30 ticks in chunks of 8 leave a partial chunk
+    path = str(tmp_path / 'metrics.npz')
+    runs = []
+    for file in (path, None):
+        sim = model.fork(seed=0)
+        recorder = sim.start_recording(path=file, chunk_ticks=8)
+        for _ in range(30):
+            sim.sim()
+        sim.stop_recording()
+        runs.append((sim, recorder.to_arrays()))
+    (sim, written), (_, memory) = runs
+    loaded = load_metrics(path)
+    for key in FIELDS + ('steps', 'ticks', 'names'):
+        assert np.array_equal(loaded[key], memory[key]), key
+        assert np.array_equal(written[key], memory[key]), key
+    assert loaded['replicas'] == 1
+    assert loaded['names'].tolist() == list(sim.cluster_index)
+    assert loaded['steps'].tolist() == list(range(model.step + 1, model.step + 31))
+    assert loaded['ticks'].tolist() == [(model.curr_tick + i) % (24 * sim.tph) for i in range(1, 31)]
+    # Totals against the counters of the model
+    assert loaded['arrivals'].sum() == sim.total_trips - model.total_trips
+    assert loaded['failed_arrivals'].sum() + loaded['failed_departures'].sum() == sim.failures - model.failures > 0
+    assert loaded['bikes'][-1].tolist() == [sim.cluster_dict[name].curr_bikes for name in sim.cluster_index]
+
+
+def test_array_model_records_every_replica(model, tmp_path):
+    replicas = 3
+    bikes = np.array([cluster.curr_bikes for cluster in model.cluster_dict.values()])
+    array = ArrayModel(model.fork(), seed=0, initial_bikes=np.tile(bikes, (replicas, 1)))
+    array.start_recording(path=str(tmp_path / 'replicas.npz'), chunk_ticks=8)
+    array.run(30)
+    array.stop_recording()
+    loaded = load_metrics(str(tmp_path / 'replicas.npz'))
+    assert loaded['replicas'] == replicas and loaded['bikes'].shape == (30, replicas * len(array.names))
+    per_replica = {key: loaded[key].reshape((30, replicas, -1)).sum(axis=(0, 2)) for key in FIELDS}
+    assert per_replica['arrivals'].tolist() == array.replica_total_trips.tolist()
+    failures = per_replica['failed_arrivals'] + per_replica['failed_departures']
+    assert failures.tolist() == array.replica_failures.tolist() and failures.all()
+    assert np.array_equal(loaded['bikes'][-1], array.curr_bikes)
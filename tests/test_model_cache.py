@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+from benchmark.synthetic import make_station_data
+from cluster_model import ClusterModel
+from model_cache import ModelCache
+
+
+@pytest.fixture(scope='module')
+def station_data() -> dict:
+    return make_station_data(scale=0.05, seed=1, dense=False)
+
+
+def test_cached_model_matches_fresh_build(station_data, tmp_path):
+    fresh = ClusterModel(station_data, square_length=0.005)
+    ClusterModel(station_data, square_length=0.005, cache=str(tmp_path))
+    cached = ClusterModel(station_data, square_length=0.005, cache=str(tmp_path), tph=12)
+    assert len(os.listdir(tmp_path)) == 1
+    assert list(cached.cluster_dict) == list(fresh.cluster_dict)
+    assert np.allclose(cached.travel_minutes, fresh.travel_minutes)
+    for name, cluster in fresh.cluster_dict.items():
+        assert cached.cluster_dict[name].max_docks == cluster.max_docks
+        assert cached.cluster_dict[name].transition[40] == cluster.transition[40]
+
+
+def test_reinit_at_other_square_length(station_data, tmp_path):
+    # init_clusters keeps the squares already built, which must not be saved under the new square length
+    ClusterModel(station_data, square_length=0.005, cache=str(tmp_path)).init_clusters(square_length=0.01)
+    cached = ClusterModel(station_data, square_length=0.01, cache=str(tmp_path))
+    fresh = ClusterModel(station_data, square_length=0.01)
+    assert cached.square_length == 0.01
+    assert list(cached.cluster_dict) == list(fresh.cluster_dict)
+
+
+def test_stale_entries_are_removed(station_data, tmp_path):
+    cache = ModelCache(str(tmp_path))
+    ClusterModel(station_data, square_length=0.005, cache=cache)
+    key = cache.get_key(station_data, 0.005)
+    assert cache.load(key) is not None
+    # A truncated array
+    with open(os.path.join(cache.get_entry(key), 'rates.npy'), 'r+b') as f:
+        f.truncate(100)
+    assert cache.load(key) is None
+    assert not os.path.exists(cache.get_entry(key))
+    # An entry of another square length under the key
+    ClusterModel(station_data, square_length=0.01, cache=cache)
+    os.rename(cache.get_entry(cache.get_key(station_data, 0.01)), cache.get_entry(key))
+    manifest = os.path.join(cache.get_entry(key), 'manifest.json')
+    with open(manifest, 'r') as f:
+        text = f.read()
+    with open(manifest, 'w') as f:
+        f.write(text.replace(cache.get_key(station_data, 0.01), key))
+    model = ClusterModel(station_data, square_length=0.005, cache=cache)
+    assert model.square_length == 0.005
+    assert cache.load(key)['grid_origin'][2] == 0.005
+
+
+def test_least_recently_used_entries_are_evicted(station_data, tmp_path):
+    cache = ModelCache(str(tmp_path))
+    ClusterModel(station_data, square_length=0.005, cache=cache)
+    ClusterModel(station_data, square_length=0.01, cache=cache)
+    old, new = cache.get_key(station_data, 0.005), cache.get_key(station_data, 0.01)
+    os.utime(os.path.join(cache.get_entry(old), 'manifest.json'), (0, 0))
+    cache.max_bytes = cache.size() - 1
+    cache.evict()
+    assert [key for _, _, key in cache.entries()] == [new]
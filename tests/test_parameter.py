@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import parameter
+from benchmark.synthetic import make_station_data, make_trips
+
+
+def nested_loop_join(station_information: list[dict], station_status: list[dict]) -> pd.DataFrame:
+    # The join get_station_information did before match_status: every station gets its first status
+    flat_data = []
+    for station in station_information:
+        for station_stat in station_status:
+            if station['station_id'] == station_stat['station_id']:
+                flat_data.append({'name': station['name'],
+                                  'capacity': station['capacity'],
+                                  'station_id': station['station_id'],
+                                  'lat': station['lat'],
+                                  'lon': station['lon'],
+                                  'num_bikes_available': station_stat['num_bikes_available'],
+                                  'num_bikes_disabled': station_stat['num_bikes_disabled'],
+                                  'num_docks_available': station_stat['num_docks_available'],
+                                  'num_docks_disabled': station_stat['num_docks_disabled'],
+                                  'operating': station_stat['is_renting'] and station_stat['is_returning'] and
+                                  station_stat['is_installed']})
+                break
+    return pd.DataFrame(flat_data)
+
+
+def make_feeds(seed: int, num_stations=200) -> tuple[list[dict], list[dict]]:
+    # Station information with a duplicate station_id, and a shuffled status missing some stations and
+    # repeating others
+    rng = np.random.default_rng(seed)
+    info = [{'station_id': str(i), 'name': f'Station {i}', 'capacity': int(rng.integers(10, 40)),
+             'lat': 40.7 + rng.random() / 10, 'lon': -74 + rng.random() / 10} for i in range(num_stations)]
+    info.append(dict(info[3], name='Station 3 again'))
+    status = [{'station_id': str(i), 'num_bikes_available': int(rng.integers(0, 30)),
+               'num_bikes_disabled': int(rng.integers(0, 2)), 'num_docks_available': int(rng.integers(0, 30)),
+               'num_docks_disabled': 0, 'is_renting': bool(rng.random() > 0.1), 'is_returning': True,
+               'is_installed': True} for i in range(num_stations) if rng.random() > 0.05]
+    status += [dict(station, num_bikes_available=99) for station in status[:5]]
+    status.append(dict(status[0], station_id='unknown'))
+    order = rng.permutation(len(status) - 6)
+    status = [status[i] for i in order] + status[-6:]
+    return info, status
+
+
+def test_join_status_matches_nested_loop():
+    for seed in range(3):
+        info, status = make_feeds(seed)
+        expected = nested_loop_join(info, status)
+        joined = parameter.join_status(parameter.get_info_df(info), {'data': {'stations': status}})
+        pd.testing.assert_frame_equal(joined, expected, check_dtype=False)
+
+
+def test_match_status_duplicate_station_id():
+    info = [{'station_id': 'a', 'name': 'A', 'capacity': 10, 'lat': 0, 'lon': 0},
+            {'station_id': 'a', 'name': 'A again', 'capacity': 10, 'lat': 0, 'lon': 0}]
+    status = [{'station_id': 'a', 'num_bikes_available': 4, 'num_bikes_disabled': 0, 'num_docks_available': 6,
+               'num_docks_disabled': 0, 'is_renting': True, 'is_returning': True, 'is_installed': True}]
+    rows, columns = parameter.match_status(pd.Index(['a', 'a']), status)
+    assert rows.tolist() == [0, 1]
+    assert columns['num_bikes_available'].tolist() == [4, 4]
+    pd.testing.assert_frame_equal(parameter.join_status(parameter.get_info_df(info), status),
+                                  nested_loop_join(info, status), check_dtype=False)
+
+
+def cut_rate(data: pd.DataFrame, days: list[datetime], tph: int) -> np.ndarray:
+    # get_rate before bin_trips: one cut() per day, one select_time per tick
+    length = timedelta(hours=1 / tph)
+    total_arrivals = np.zeros(24 * tph)
+    for day in days:
+        total_arrivals += [len(df) for df in parameter.cut(data, day, day + timedelta(days=1), length)]
+    return total_arrivals / len(days)
+
+
+def test_get_rate_matches_cut():
+    station_data = make_station_data(scale=0.01, seed=2, dense=False)
+    start = datetime(2023, 6, 1)
+    weekdays, weekends = parameter.get_weekdays_and_weekends(start, start + timedelta(days=6))
+    names = sorted(station_data, key=lambda name: -sum(station_data[name]['rate'].values()))[:2]
+    data = pd.concat([make_trips(station_data, name, weekdays + weekends, seed=i) for i, name in enumerate(names)],
+                     ignore_index=True)
+    # Trips on days outside the range and trips ending after the tick they start in
+    data = pd.concat([data, data.assign(started_at=data['started_at'] + timedelta(days=20),
+                                        ended_at=data['ended_at'] + timedelta(days=20, minutes=30))],
+                     ignore_index=True)
+    for tph in (1, 3, 4):
+        for days in (weekdays, weekends):
+            assert np.array_equal(parameter.get_rate(data, days, tph), cut_rate(data, days, tph))
+        stations, rates = parameter.get_rates(data, [weekdays, weekends], tph)
+        assert rates.shape == (2, len(names), 24 * tph)
+        for i, name in enumerate(stations):
+            station_trips = data[data['start_station_name'] == name]
+            assert np.array_equal(rates[0, i], cut_rate(station_trips, weekdays, tph))
+            assert np.array_equal(rates[1, i], cut_rate(station_trips, weekends, tph))
@@ -0,0 +1,36 @@
+import pickle
+
+import pytest
+
+from benchmark.synthetic import make_station_data
+from cluster_model import ClusterModel
+from profiler import PHASES
+
+
+@pytest.fixture(scope='module')
+def model() -> ClusterModel:
+    model = ClusterModel(make_station_data(scale=0.05, seed=1, dense=False), square_length=0.005, seed=0)
+    for cluster in model.cluster_dict.values():
+        cluster.curr_bikes = cluster.max_docks // 4
+        cluster.update()
+    return model
+
+
+def test_profiler_counts_phases_and_reroutes(model):
+    sim = model.fork(seed=0)
+    profiler = sim.enable_profiling()
+    for _ in range(8 * sim.tph):
+        sim.sim()
+    report = profiler.report()
+    phases, counters = report['phases'], report['counters']
+    assert phases['sim']['calls'] == counters['ticks'] == 8 * sim.tph
+    assert phases['sim_departures']['calls'] == phases['sim']['calls'] * len(sim.cluster_dict)
+    # Every failure looks for a neighbor once, a failed search is always a critical failure
+    assert phases['get_new_cluster']['calls'] == counters['reroute_attempts'] == counters['failures'] > 0
+    assert counters['reroutes_failed'] <= counters['critical_failures']
+    assert phases['get_dist']['calls'] >= counters['departures_drawn'] > 0
+    assert sum(stats['self_seconds'] for stats in phases.values()) == pytest.approx(phases['sim']['seconds'])
+    # Pickles drop the wrappers, disabling removes them from the model
+    assert not any(phase in pickle.loads(pickle.dumps(sim)).__dict__ for phase in PHASES)
+    sim.disable_profiling()
+    assert not any(phase in sim.__dict__ for phase in PHASES)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from benchmark.synthetic import make_station_data
+from cluster_model import ClusterModel
+
+
+@pytest.fixture(scope='module')
+def model() -> ClusterModel:
+    return ClusterModel(make_station_data(scale=0.05, seed=1, dense=False), square_length=0.005, seed=0)
+
+
+def get_masks(model: ClusterModel) -> tuple[dict, dict]:
+    # Bitmasks of available neighbors from the current flags of the clusters
+    not_full, not_empty = {}, {}
+    for name, neighbors in model.reroute_index.neighbors.items():
+        not_full[name] = sum(1 << bit for bit, neighbor in enumerate(neighbors)
+                             if not model.cluster_dict[neighbor].full)
+        not_empty[name] = sum(1 << bit for bit, neighbor in enumerate(neighbors)
+                              if not model.cluster_dict[neighbor].empty)
+    return not_full, not_empty
+
+
+def test_flag_updates_match_rebuilt_masks(model):
+    sim = model.fork()
+    index = sim.reroute_index
+    assert index.neighbors == sim.get_reroute_neighbors()
+    rng = np.random.default_rng(0)
+    clusters = list(sim.cluster_dict.values())
+    for _ in range(20):
+        # Push random clusters to full, empty or in between
+        for cluster in rng.choice(clusters, 10):
+            cluster.curr_bikes = int(rng.choice([0, cluster.max_docks, cluster.max_docks // 2]))
+            cluster.update()
+        not_full, not_empty = get_masks(sim)
+        assert index.not_full == not_full and index.not_empty == not_empty
+        assert index.full == {name: cluster.full for name, cluster in sim.cluster_dict.items()}
+        assert index.empty == {name: cluster.empty for name, cluster in sim.cluster_dict.items()}
+
+
+def test_find_picks_among_nearest_available(model):
+    sim = model.fork()
+    index = sim.reroute_index
+    rng = np.random.default_rng(1)
+    for cluster in sim.cluster_dict.values():
+        cluster.curr_bikes = int(rng.choice([0, cluster.max_docks, 1]))
+        cluster.update()
+    for name, neighbors in index.neighbors.items():
+        for method, unavailable in (('arrival', 'full'), ('departure', 'empty')):
+            available = [neighbor for neighbor in neighbors
+                         if not getattr(sim.cluster_dict[neighbor], unavailable)][:index.choices]
+            for uniform in (0, 0.3, 0.6, 0.999):
+                expected = available[int(uniform * len(available))] if available else -1
+                assert index.find(name, uniform, method) == expected
+    # A cluster whose neighbors are all full has nowhere to send a bike
+    name, neighbors = next((name, neighbors) for name, neighbors in index.neighbors.items() if neighbors)
+    for neighbor in neighbors:
+        sim.cluster_dict[neighbor].curr_bikes = sim.cluster_dict[neighbor].max_docks
+        sim.cluster_dict[neighbor].update()
+    assert index.find(name, 0.5, 'arrival') == -1
+    # Forks rebuild their own index, the model keeps its own
+    assert model.reroute_index is not index
+    assert all(cluster.reroute_index is model.reroute_index for cluster in model.cluster_dict.values())
@@ -0,0 +1,68 @@
+from datetime import timedelta
+
+import numpy as np
+import pytest
+
+from benchmark.synthetic import make_station_data
+from cluster_model import ClusterModel
+from state_optimization import StateOptimization
+from trip import Trip
+
+
+@pytest.fixture(scope='module')
+def model() -> ClusterModel:
+    model = ClusterModel(make_station_data(scale=0.05, seed=1, dense=False), square_length=0.005, seed=0)
+    for cluster in model.cluster_dict.values():
+        cluster.curr_bikes = cluster.max_docks // 2
+        cluster.update()
+    names = list(model.cluster_dict)
+    model.in_transit = [Trip(names[0], names[1], model.curr_time, timedelta(minutes=40))]
+    return model
+
+
+def test_forks_do_not_share_state(model):
+    first, second = model.fork(seed=1), model.fork(seed=2)
+    bikes = [cluster.curr_bikes for cluster in model.cluster_dict.values()]
+    for _ in range(4 * first.tph):
+        first.sim()
+    name = next(iter(first.cluster_dict))
+    first.cluster_dict[name].curr_bikes += 5
+    first.cluster_dict[name].arrival_failures[0] += 1
+    assert [cluster.curr_bikes for cluster in second.cluster_dict.values()] == bikes
+    assert not any(cluster.num_failures() for cluster in second.cluster_dict.values())
+    # The trip in transit docked in the first fork only
+    scheduled = lambda sim: [trip for trips in sim.arrivals.values() for trip in trips]
+    trip, = scheduled(model)
+    assert trip not in scheduled(first) and scheduled(second) == [trip]
+    assert second.arrivals is not model.arrivals
+    assert (second.step, second.curr_time) == (model.step, model.curr_time)
+    # Static parameters are shared
+    assert first.cluster_dict[name].tick_rate is model.cluster_dict[name].tick_rate
+
+
+def test_restore_rejects_other_clusters(model):
+    other = model.fork()
+    snapshot = other.snapshot()
+    snapshot['names'] = snapshot['names'][::-1]
+    with pytest.raises(ValueError):
+        other.restore(snapshot)
+
+
+def test_optimize_draws_new_randoms_each_step(model):
+    sim = model.fork(seed=3)
+    state = sim.rng.bit_generator.state
+    draws = []
+    plain_sim = sim.sim
+
+    def sim_and_record():
+        if sim.curr_time == model.curr_time:
+            draws.append(sim.rng.bit_generator.state['state']['state'])
+        plain_sim()
+    sim.sim = sim_and_record
+    StateOptimization(sim).optimize(timedelta(hours=1), steps=3)
+    assert len(draws) == len(set(draws)) == 3
+    # The caller's generator and state are where they were
+    assert sim.rng.bit_generator.state == state
+    assert sim.curr_time == model.curr_time and len(sim.in_transit) == 1
+    assert np.array_equal([c.curr_bikes for c in sim.cluster_dict.values()],
+                          [c.curr_bikes for c in model.cluster_dict.values()])
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark.synthetic import make_station_data
+from cluster_model import ClusterModel
+from station_registry import StationRegistry
+
+
+@pytest.fixture(scope='module')
+def model() -> ClusterModel:
+    station_data = make_station_data(scale=0.05, seed=1, dense=False)
+    names = list(station_data)
+    # The last row repeats the station_id of the first for another station
+    info = [{'station_id': f'id{i}', 'name': name, 'lat': station_data[name]['lat'], 'lon': station_data[name]['lon'],
+             'capacity': station_data[name]['max_docks']} for i, name in enumerate(names)]
+    info.append(dict(info[1], station_id='id0'))
+    return ClusterModel(station_data, square_length=0.005, station_information=StationRegistry.from_gbfs(info))
+
+
+def test_state_by_station_id_with_repeated_id(model):
+    names = list(model.station_data)
+    rng = np.random.default_rng(0)
+    bikes = rng.integers(0, 20, len(names))
+    status = {'data': {'stations': [{'station_id': f'id{i}', 'num_bikes_available': int(b)}
+                                    for i, b in enumerate(bikes)] +
+                                   [{'station_id': 'unknown', 'num_bikes_available': 7}]}}
+    rows, station_bikes, unknown = model.get_station_bikes(status)
+    # id0 is the first station, the repeated row of the registry does not count
+    assert rows.tolist() == list(range(len(names))) + [-1]
+    assert unknown.tolist() == [False] * len(names) + [True]
+    by_name = model.get_state(pd.DataFrame({'name': names, 'num_bikes_available': bikes}))
+    assert model.get_state(status) == by_name
+    assert sum(by_name.values()) == bikes.sum()
+
+
+def test_station_id_to_name_keeps_first_row(model):
+    assert model.station_id_to_name['id0'] == list(model.station_data)[0]
+    assert model.station_id_to_name is model.station_id_to_name
+
+
+def test_dense_clusters_cover_every_square(model):
+    dense = model.get_dense_clusters()
+    assert len(dense) == model.horizontal_squares * model.vertical_squares
+    assert {i: stations for i, stations in enumerate(dense) if stations} == model.clusters
+    assert sum(len(stations) for stations in dense) == len(model.station_data)
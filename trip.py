@@ -2,6 +2,8 @@ from datetime import timedelta
 
 
 class Trip:
+    __slots__ = ('start_cluster', 'end_cluster', 'start_time', 'curr_time', 'end_time')
+
     def __init__(self,
                  start_cluster: int,
                  end_cluster: int,